@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Regression checks for *get_addresses_by_email* (case insensitive lookup)
+
+Needs a running development server.
+"""
+
+import time
+import uuid
+import pyjsonrpc
+
+
+# TEST ENVIRONMENT
+address_book = pyjsonrpc.HttpClient(
+    url = "http://localhost:8080/api/jsonrpc",
+    username = "test",
+    password = "test"
+)
+
+
+def lookup(emails, check, seconds = 10):
+    """
+    Repeats the lookup, until *check* is true (the email queries are
+    eventually consistent)
+    """
+
+    timeout = time.time() + seconds
+    while True:
+        result = address_book.get_addresses_by_email(emails = emails)
+        if check(result) or time.time() > timeout:
+            return result
+        time.sleep(0.5)
+
+
+try:
+    email = u"Max.{uid}@Example.com".format(uid = uuid.uuid4().hex[:8])
+    address = address_book.create_address(
+        kind = u"individual",
+        last_name = u"Mustermann",
+        email_items = [
+            {"label": u"Privat", "email": email},
+            {"label": u"Privat 2", "email": email.upper()}
+        ]
+    )
+    key_urlsafe = address["key_urlsafe"]
+
+    # One email address or a list; the keys are lower case
+    result = lookup(email.upper(), lambda result: result.get(email.lower()))
+    assert result == {email.lower(): [key_urlsafe]}, result
+
+    unknown = u"unknown-{uid}@example.com".format(uid = uuid.uuid4().hex[:8])
+    result = address_book.get_addresses_by_email(emails = [email, unknown])
+    assert result[email.lower()] == [key_urlsafe], result
+    assert result[unknown] == [], result
+
+    # Changed email address
+    new_email = u"new-{email}".format(email = email.lower())
+    address_book.save_address(
+        key_urlsafe = key_urlsafe,
+        email_items = [{"label": u"Privat", "email": new_email}]
+    )
+    result = lookup([email, new_email], lambda result: result.get(new_email) and not result.get(email.lower()))
+    assert result[email.lower()] == [], result
+    assert result[new_email] == [key_urlsafe], result
+
+    # Clean up
+    address_book.delete_address(key_urlsafe = key_urlsafe, force = True)
+    print "OK"
+
+except pyjsonrpc.JsonRpcError, err:
+    print err.code
+    print err.message
+    print err.data
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Regression checks for *save_address* (changed fields, history versions,
+search document writes)
+
+Needs a running development server in the "sync" index mode.
+"""
+
+import uuid
+import pyjsonrpc
+
+
+# TEST ENVIRONMENT
+address_book = pyjsonrpc.HttpClient(
+    url = "http://localhost:8080/api/jsonrpc",
+    username = "test",
+    password = "test"
+)
+
+
+def document_counts():
+    return address_book.get_info()["search_index_documents"]
+
+
+try:
+    last_name = u"History-{uid}".format(uid = uuid.uuid4().hex[:8])
+    address = address_book.create_address(
+        kind = u"individual",
+        first_name = u"Gerold",
+        last_name = last_name
+    )
+    key_urlsafe = address["key_urlsafe"]
+
+    # Internal fields are not returned
+    for fieldname in ("index_hash", "history_version", "emails"):
+        assert fieldname not in address, fieldname
+
+    # Changed field --> history version and search document write
+    written = document_counts()["written"]
+    result = address_book.save_address(
+        key_urlsafe = key_urlsafe,
+        first_name = u"Jörg",
+        return_changed_fields = True
+    )
+    assert result["changed_fields"]["fields"] == ["first_name"], result["changed_fields"]
+    assert result["address"]["first_name"] == u"Jörg"
+    assert document_counts()["written"] > written
+
+    # Same values --> nothing is written, no new version
+    counts = document_counts()
+    result = address_book.save_address(
+        key_urlsafe = key_urlsafe,
+        first_name = u"Jörg",
+        return_changed_fields = True
+    )
+    assert result["changed_fields"]["fields"] == [], result["changed_fields"]
+    assert document_counts() == counts
+
+    # Second change --> two versions, newest first
+    address_book.save_address(key_urlsafe = key_urlsafe, nickname = u"Halvar")
+    history = address_book.get_address_history(key_urlsafe = key_urlsafe)
+    versions = history["versions"]
+    assert [version["version"] for version in versions] == [2, 1], versions
+    assert versions[0]["address"]["first_name"] == u"Jörg"
+    assert versions[0]["address"]["nickname"] is None
+    assert versions[1]["address"]["first_name"] == u"Gerold"
+    assert "history_version" not in versions[1]["address"]
+
+    # Paging
+    history = address_book.get_address_history(key_urlsafe = key_urlsafe, limit = 1)
+    assert [version["version"] for version in history["versions"]] == [2]
+    assert history["more"]
+    history = address_book.get_address_history(
+        key_urlsafe = key_urlsafe, limit = 1, cursor = history["next_cursor"]
+    )
+    assert [version["version"] for version in history["versions"]] == [1]
+    assert not history["more"]
+
+    # Invalid cursor
+    try:
+        address_book.get_address_history(key_urlsafe = key_urlsafe, cursor = u"x")
+    except pyjsonrpc.JsonRpcError as err:
+        assert err.code == 1001, err.code
+    else:
+        raise AssertionError("Invalid cursor accepted")
+
+    # Clean up
+    address_book.delete_address(key_urlsafe = key_urlsafe, force = True)
+    print "OK"
+
+except pyjsonrpc.JsonRpcError, err:
+    print err.code
+    print err.message
+    print err.data
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Regression tests for *common.format_* (umlauts and word beginnings)
+
+Runs without App Engine SDK::
+
+    python _internal/unit_tests/python/test_format.py
+"""
+
+import os
+import sys
+import unittest
+
+THISDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(THISDIR, "..", "..", "..", "development", "application", "common"))
+
+import format_
+
+
+class FoldUmlautsTest(unittest.TestCase):
+
+    def test_unicode(self):
+        self.assertEqual(format_.fold_umlauts(u"Jörg Müßig"), u"Joerg Muessig")
+        self.assertEqual(format_.fold_umlauts(u"ÄÖÜ"), u"AeOeUe")
+
+    def test_without_umlauts(self):
+        self.assertIsNone(format_.fold_umlauts(u"Gerold"))
+        self.assertIsNone(format_.fold_umlauts("Gerold"))
+
+    def test_utf8_bytes(self):
+        self.assertEqual(format_.fold_umlauts(u"Käse".encode("utf-8")), u"Kaese")
+
+    def test_replace_umlauts(self):
+        self.assertEqual(format_.replace_umlauts(u"Größe"), u"Groesse")
+        self.assertEqual(format_.replace_umlauts(u"Size"), u"Size")
+        self.assertTrue(format_.has_umlauts(u"Tür"))
+        self.assertFalse(format_.has_umlauts(u"Door"))
+
+
+class EdgeNgramsTest(unittest.TestCase):
+
+    def test_split_words(self):
+        self.assertEqual(format_.split_words(u"GP-COM, Innsbruck"), [u"gp", u"com", u"innsbruck"])
+        self.assertEqual(format_.split_words(None), [])
+
+    def test_umlaut_variants(self):
+        self.assertEqual(
+            format_.edge_ngrams(u"Jörg"),
+            [u"j", u"jö", u"jör", u"jörg", u"jo", u"joe", u"joer", u"joerg"]
+        )
+
+    def test_unique(self):
+        self.assertEqual(format_.edge_ngrams(u"Max Maier"), [
+            u"m", u"ma", u"max", u"mai", u"maie", u"maier"
+        ])
+
+    def test_lengths(self):
+        self.assertEqual(
+            format_.edge_ngrams(u"Innsbruck", min_length = 3, max_length = 5),
+            [u"inn", u"inns", u"innsb"]
+        )
+        self.assertEqual(format_.edge_ngrams(u""), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,16 +10,31 @@ APPDIR = os.path.abspath(os.path.join(THISDIR, "application"))
 ZIPLIBSDIR = os.path.join(APPDIR, "ziplibs")
 EXTLIBSDIR = os.path.join(APPDIR, "extlibs")
 
+UNPACKEDLIBSDIR = os.path.join(APPDIR, "unpackedlibs")
+
 sys.path.insert(0, APPDIR)
 sys.path.insert(0, EXTLIBSDIR)
 
-sys.path.append(os.path.join(ZIPLIBSDIR, "pytz.zip"))
-sys.path.append(os.path.join(ZIPLIBSDIR, "six.py.zip"))
-sys.path.append(os.path.join(ZIPLIBSDIR, "bunch.zip"))
-sys.path.append(os.path.join(ZIPLIBSDIR, "cherrypy.zip"))
-sys.path.append(os.path.join(ZIPLIBSDIR, "pyjsonrpc.zip"))
-sys.path.append(os.path.join(ZIPLIBSDIR, "mako.zip"))
-sys.path.append(os.path.join(ZIPLIBSDIR, "webapp2.zip"))  # Workaround since 2016-05-13
+# Kaltstart-Messung (Import-Zeiten nur mit IMPORT_PROFILE)
+import common.import_profile
+common.import_profile.install()
+
+# Zip-Bibliotheken; entpackte Verzeichnisse (siehe *_unpack_ziplibs.py*)
+# werden bevorzugt, da *zipimport* beim Kaltstart langsamer ist.
+for zipname in [
+    "pytz.zip",
+    "six.py.zip",
+    "bunch.zip",
+    "cherrypy.zip",
+    "pyjsonrpc.zip",
+    "mako.zip",
+    "webapp2.zip",  # Workaround since 2016-05-13
+]:
+    unpacked_dir = os.path.join(UNPACKEDLIBSDIR, zipname[:-len(".zip")])
+    if os.path.isdir(unpacked_dir):
+        sys.path.append(unpacked_dir)
+    else:
+        sys.path.append(os.path.join(ZIPLIBSDIR, zipname))
 
 # sys.path.insert(0, os.path.join(ZIPLIBSDIR, "cloudstorage.zip"))
 # sys.path.insert(0, os.path.join(ZIPLIBSDIR, "urllib3.zip"))
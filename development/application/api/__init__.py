@@ -13,6 +13,8 @@ import cherrypy
 import logging
 import common.constants
 import common.email
+import common.authorization
+import common.import_profile
 import lib.constants
 import pyjsonrpc.rpcjson
 
@@ -20,6 +22,7 @@ import pyjsonrpc.rpcjson
 # Namespace-Imports
 import http_root
 import error_pages
+import warmup
 
 
 # Global: Activate encoder and decoder for DateTime-ISO strings and NDB keys
@@ -63,6 +66,21 @@ def email_tracebacks(severity = logging.CRITICAL):
 cherrypy.tools.email_tracebacks = cherrypy.Tool('before_error_response', email_tracebacks)
 
 
+def mark_first_response():
+    """
+    Merkt sich die Dauer des Kaltstarts bis zur ersten Antwort
+    """
+
+    common.import_profile.mark("first_response")
+    if common.import_profile.is_enabled():
+        logging.info(common.import_profile.format_report())
+
+    # Nur einmal pro Instanz
+    cherrypy.config.update({"tools.cold_start.on": False})
+
+cherrypy.tools.cold_start = cherrypy.Tool('on_end_request', mark_first_response)
+
+
 def get_app():
     """
     Gibt die Cherrypy-Application für die JSONRPC-Api zurück
@@ -79,6 +97,7 @@ def get_app():
         "request.show_tracebacks": False,
         "request.show_mismatched_params": False,
         "tools.email_tracebacks.on": True,
+        "tools.cold_start.on": True,
 
         # Encoding der auszuliefernden HTML-Seiten
         "tools.encode.on": True,
@@ -109,6 +128,9 @@ def get_app():
     app.merge(common.constants.COMMON_INIPATH)
     app.merge(lib.constants.SECURITY_INIPATH)
 
+    # Berechtigungen pro Benutzer (einmal nach dem Laden der Konfiguration)
+    common.authorization.compile_authorizations()
+
     # Logging per Email
     if cherrypy.config.get("tools.email_tracebacks.on"):
         # set up an SMTP handler to mail when the WARNING error occurs
@@ -124,5 +146,15 @@ def get_app():
     return app
 
 
+def get_warmup_app():
+    """
+    Gibt die Cherrypy-Application für den Warmup-Request (/_ah/warmup) zurück
+    """
+
+    return cherrypy.Application(warmup.Root(), "/_ah")
+
+
 app = get_app()
+warmup_app = get_warmup_app()
+common.import_profile.mark("api.app")
 
@@ -8,7 +8,7 @@ import os
 import cherrypy
 import logging
 import common.format_
-from mako.template import Template
+import lib.templates
 
 THISDIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -22,9 +22,8 @@ def error_page_500(status, message, traceback, version):
 
     try:
 
-        # Vorlage
-        template_path = os.path.join(THISDIR, "error_page_500.mako")
-        template = Template(filename = template_path)
+        # Vorlage (einmal kompiliert)
+        template = lib.templates.get_template("error_pages/error_page_500.mako")
 
         # Vorlage rendern
         rendered = template.render_unicode(
@@ -58,9 +57,8 @@ def error_page_404(status, message, traceback, version):
 
     try:
 
-        # Vorlage
-        template_path = os.path.join(THISDIR, "error_page_404.mako")
-        template = Template(filename = template_path)
+        # Vorlage (einmal kompiliert)
+        template = lib.templates.get_template("error_pages/error_page_404.mako")
 
         # Vorlage rendern
         rendered = template.render_unicode(
@@ -4,6 +4,7 @@
 # Namespace Imports
 import cronjobs
 import dev
+import export
 from jsonrpc import jsonrpc
 
 
@@ -98,6 +98,9 @@ def backup_database():
             "FreeDefinedField",
             "NamedValue",
             "DeletedAddress",
+            "PendingSearchDocument",
+            "CounterShard",
+            "FacetItem",
         ],
         filesystem = "gs",
         gs_bucket_name = "{bucket_name}/backups/{iso_year}/{iso_month}/{iso_day}".format(
@@ -2,20 +2,36 @@
 # coding: utf-8
 
 import os
+import sys
+import copy
+import time
+import datetime
 import logging
 import cherrypy
 import hashlib
 import threading
 import common.addresses
+import common.address_index
+import common.import_profile
+import common.format_
+import pyjsonrpc.rpcjson
 from pyjsonrpc.cp import CherryPyJsonRpc, rpcmethod
+from google.appengine.ext import ndb
 from google.appengine.ext import deferred
 from google.appengine.api import search
+from bunch import Bunch
 from common.model.address import (
-    Address
+    Address,
+    TelItem,
+    EmailItem,
+    FreeDefinedItem,
+    AnniversaryItem,
+    PREFIX_FIELD
 )
 
 
 THISDIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_INDEX_NAME = "AddressBenchmark"  # Search index with synthetic documents
 
 
 # Globale Variable um die Benutzer (threadübergreifend) zwischenzuspeichern
@@ -67,6 +83,274 @@ class JsonRpc(CherryPyJsonRpc):
         return True
 
 
+    @rpcmethod
+    def benchmark_address_page_fetch(self, page_size = 100, rounds = 5):
+        """
+        Compares the latency of one address page fetched with serial
+        *key.get()* calls against one batched *ndb.get_multi_async()* call.
+
+        Caches are disabled, so every round reads from the datastore.
+
+        :return: Average milliseconds per page for both variants
+        """
+
+        # Document ids of the first page
+        index = common.address_index.get_index()
+        query = search.Query(
+            query_string = u"",
+            options = search.QueryOptions(limit = page_size, ids_only = True)
+        )
+        doc_ids = [document.doc_id for document in index.search(query).results]
+
+        context = ndb.get_context()
+        context.set_cache_policy(False)
+        context.set_memcache_policy(False)
+
+        # Old: one round trip per address
+        serial_seconds = 0.0
+        for _ in range(rounds):
+            start = time.time()
+            for doc_id in doc_ids:
+                ndb.Key(urlsafe = doc_id).get()
+            serial_seconds += time.time() - start
+
+        # New: one batch request per page
+        batch_seconds = 0.0
+        for _ in range(rounds):
+            start = time.time()
+            common.addresses.get_addresses_by_keys(doc_ids)
+            batch_seconds += time.time() - start
+
+        # Finished
+        return dict(
+            page_size = len(doc_ids),
+            rounds = rounds,
+            serial_ms = round(serial_seconds / rounds * 1000, 2),
+            batch_ms = round(batch_seconds / rounds * 1000, 2)
+        )
+
+
+    @rpcmethod
+    def get_cold_start_report(self, limit = 50, sort_by = "cumulative"):
+        """
+        Returns the cold start milestones of this instance (milliseconds
+        since *appengine_config.py* was loaded, e.g. "api.app" and
+        "first_response") and the slowest imports.
+
+        The imports are only measured, if the environment variable
+        IMPORT_PROFILE is set (app.yaml: env_variables).
+
+        :param sort_by: "cumulative" or "self"
+        """
+
+        # Finished
+        return dict(
+            milestones = common.import_profile.get_cold_start_info(),
+            import_profile_enabled = common.import_profile.is_enabled(),
+            modules_loaded = len(sys.modules),
+            lazy_modules_loaded = sorted(
+                name for name in ("docutils", "mako", "pytz") if name in sys.modules
+            ),
+            slowest_imports = common.import_profile.get_report(
+                limit = limit, sort_by = sort_by
+            )
+        )
+
+
+    @rpcmethod
+    def benchmark_address_to_dict(self, limit = 100, rounds = 10):
+        """
+        Compares *Address.to_dict* with the former implementation
+        (*ndb._to_dict* + *copy.deepcopy* + cleanup passes).
+
+        Checks for every option combination, that both JSON outputs are
+        byte-identical.
+
+        :return: Milliseconds per page (old and new) and the check results
+        """
+
+        addresses = Address.query().fetch(limit)
+
+        option_combinations = [
+            dict(),
+            dict(exclude_creation_metadata = True, exclude_edit_metadata = True),
+            dict(exclude_empty_fields = True),
+            dict(
+                exclude_creation_metadata = True,
+                exclude_edit_metadata = True,
+                exclude_empty_fields = True
+            ),
+            dict(include = ["kind", "organization", "first_name", "last_name", "email_items"]),
+            dict(exclude = ["note_items", "journal_items"], exclude_empty_fields = True),
+        ]
+
+        results = []
+        for options in option_combinations:
+
+            # Identical output
+            identical = all(
+                pyjsonrpc.rpcjson.dumps(_to_dict_deepcopy(address, **copy.deepcopy(options))) ==
+                pyjsonrpc.rpcjson.dumps(address.to_dict(**copy.deepcopy(options)))
+                for address in addresses
+            )
+
+            # Old
+            start = time.time()
+            for _ in range(rounds):
+                for address in addresses:
+                    _to_dict_deepcopy(address, **copy.deepcopy(options))
+            old_seconds = time.time() - start
+
+            # New
+            start = time.time()
+            for _ in range(rounds):
+                for address in addresses:
+                    address.to_dict(**copy.deepcopy(options))
+            new_seconds = time.time() - start
+
+            results.append(dict(
+                options = options,
+                identical = identical,
+                old_ms = round(old_seconds / rounds * 1000, 2),
+                new_ms = round(new_seconds / rounds * 1000, 2),
+                speedup = round(old_seconds / new_seconds, 2) if new_seconds else None
+            ))
+
+        # Finished
+        return dict(
+            addresses = len(addresses),
+            rounds = rounds,
+            results = results
+        )
+
+
+    @rpcmethod
+    def benchmark_search_document_build(self, quantity = 10000):
+        """
+        Builds the search fields for *quantity* synthetic addresses (in
+        memory, nothing is saved) with the former builder (Bunch objects,
+        *find*/*replace* umlaut handling, *safe_ascii* per label) and with
+        *Address.get_search_fields*.
+
+        :return: Documents per second (old and new) and whether both
+            builders return the same fields
+        """
+
+        addresses = _synthetic_addresses(quantity)
+
+        # Old
+        start = time.time()
+        old_fields = [_search_fields_legacy(address) for address in addresses]
+        old_seconds = time.time() - start
+
+        # New
+        start = time.time()
+        new_fields = [address.get_search_fields() for address in addresses]
+        new_seconds = time.time() - start
+
+        def _simplify(fields):
+            # The prefix tokens are not built by the former builder
+            return [
+                (field.__class__.__name__, field.name, field.value) for field in fields
+                if field.name != PREFIX_FIELD
+            ]
+
+        identical = all(
+            _simplify(old) == _simplify(new) for old, new in zip(old_fields, new_fields)
+        )
+
+        # Finished
+        return dict(
+            quantity = quantity,
+            identical = identical,
+            old_documents_per_second = round(quantity / old_seconds, 1) if old_seconds else None,
+            new_documents_per_second = round(quantity / new_seconds, 1) if new_seconds else None,
+            speedup = round(old_seconds / new_seconds, 2) if new_seconds else None
+        )
+
+
+    @rpcmethod
+    def start_fill_benchmark_index(self, quantity = 50000):
+        """
+        Fills the search index "AddressBenchmark" with synthetic documents
+        (deferred). The datastore and the "Address" index are not touched.
+        """
+
+        deferred.defer(_fill_benchmark_index, quantity = quantity)
+
+        # Finished
+        return True
+
+
+    @rpcmethod
+    def benchmark_count_modes(
+        self,
+        index_name = BENCHMARK_INDEX_NAME,
+        query_string = u"",
+        order_by = "last_name",
+        page_size = 20,
+        rounds = 5,
+        count_modes = None
+    ):
+        """
+        Compares the latency of one result page for the count modes
+        ("exact", "approximate:<n>", "none").
+
+        Fill the benchmark index before with *start_fill_benchmark_index*
+        (e.g. 50000 documents). The result cache is not used.
+
+        :return: Average milliseconds per query and number found for every mode
+        """
+
+        index = search.Index(name = index_name)
+        count_modes = count_modes or ["exact", "approximate:1000", "approximate:100", "none"]
+        sort_options = None
+        if order_by:
+            sort_options = search.SortOptions(
+                expressions = [search.SortExpression(
+                    expression = order_by.lstrip("-"),
+                    direction = (
+                        search.SortExpression.DESCENDING if order_by.startswith("-")
+                        else search.SortExpression.ASCENDING
+                    )
+                )],
+                limit = search.MAXIMUM_SORTED_DOCUMENTS
+            )
+
+        results = []
+        for count_mode in count_modes:
+            number_found_accuracy = common.addresses.get_number_found_accuracy(count_mode)
+            query = search.Query(
+                query_string = query_string or u"",
+                options = search.QueryOptions(
+                    limit = page_size,
+                    number_found_accuracy = number_found_accuracy,
+                    sort_options = sort_options,
+                    ids_only = True
+                )
+            )
+
+            # Warm up, then measure
+            index.search(query)
+            start = time.time()
+            for _ in range(rounds):
+                search_result = index.search(query)
+            seconds = time.time() - start
+
+            results.append(dict(
+                count_mode = count_mode,
+                ms = round(seconds / rounds * 1000, 2),
+                number_found = search_result.number_found if number_found_accuracy else None
+            ))
+
+        # Finished
+        return dict(
+            index_name = index_name,
+            rounds = rounds,
+            results = results
+        )
+
+
 # Json-Rpc-Schnittstelle aktivieren
 jsonrpc = JsonRpc()
 jsonrpc.exposed = True
@@ -82,6 +366,256 @@ def _do_iteration():
     pass
 
 
+def _synthetic_addresses(quantity, start = 0):
+    """
+    Returns unsaved addresses with typical values (for benchmarks)
+
+    :param start: Number of the first address (key id - 1)
+    """
+
+    utcnow = datetime.datetime.utcnow()
+    first_names = [u"Gerold", u"Jürgen", u"Ömer", u"Anna", u"Lukas", u"Sören"]
+    last_names = [u"Penz", u"Müller", u"Schröder", u"Huber", u"Weiß", u"Maier"]
+    cities = [u"Innsbruck", u"Wörgl", u"München", u"Kufstein", u"Schwaz"]
+
+    addresses = []
+    for number in xrange(start, start + quantity):
+        item_metadata = dict(uid = unicode(number), ct = utcnow, cu = u"bench", et = utcnow, eu = u"bench")
+        addresses.append(Address(
+            key = ndb.Key(Address, number + 1),
+            uid = unicode(number),
+            owner = u"bench",
+            ct = utcnow,
+            cu = u"bench",
+            et = utcnow,
+            eu = u"bench",
+            kind = u"individual",
+            organization = u"Bäckerei {0}".format(number % 100),
+            first_name = first_names[number % len(first_names)],
+            last_name = last_names[number % len(last_names)],
+            street = u"Hauptstraße {0}".format(number % 200),
+            postcode = unicode(6000 + number % 300),
+            city = cities[number % len(cities)],
+            country = u"Österreich",
+            gender = u"m",
+            category_items = [u"Kunde", u"Lieferant"][:number % 3],
+            tag_items = [u"Newsletter"],
+            phone_items = [TelItem(label = u"Mobil", number = u"+43 660 {0}".format(number), **item_metadata)],
+            email_items = [EmailItem(label = u"Privat", email = u"user{0}@example.com".format(number), **item_metadata)],
+            free_defined_items = [
+                FreeDefinedItem(group = u"Daten", label = u"Schuhgröße", text = u"45", **item_metadata),
+                FreeDefinedItem(group = u"Daten", label = u"Bemerkung", text = u"Grüße aus Tirol", **item_metadata),
+            ],
+            anniversary_items = [
+                AnniversaryItem(label = u"Geburtstag", year = 1970 + number % 40, month = 1 + number % 12, day = 1 + number % 28, **item_metadata)
+            ],
+        ))
+
+    # Finished
+    return addresses
+
+
+def _fill_benchmark_index(quantity, start = 0):
+    """
+    Writes synthetic search documents into the benchmark index
+    (chains itself by deferred)
+    """
+
+    task_start = time.time()
+    index = search.Index(name = BENCHMARK_INDEX_NAME)
+
+    while start < quantity and time.time() - task_start < 60:
+        addresses = _synthetic_addresses(min(search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST, quantity - start), start)
+        index.put([address.get_search_document() for address in addresses])
+        start += len(addresses)
+
+    if start < quantity:
+        deferred.defer(_fill_benchmark_index, quantity = quantity, start = start)
+    else:
+        logging.info(u"Benchmark index: {quantity} documents".format(quantity = quantity))
+
+
+def _has_umlauts_legacy(text):
+    if not text:
+        return False
+    for umlaut in u"öäüÖÄÜß":
+        if text.find(umlaut) > -1:
+            return True
+    return False
+
+
+def _replace_umlauts_legacy(text):
+    if not text:
+        return text
+    for umlaut, replacement in (
+        (u"ö", u"oe"), (u"ä", u"ae"), (u"ü", u"ue"),
+        (u"Ö", u"Oe"), (u"Ä", u"Ae"), (u"Ü", u"Ue"), (u"ß", u"ss"),
+    ):
+        text = text.replace(umlaut, replacement)
+    return text
+
+
+def _safe_ascii_legacy(text):
+    text = _replace_umlauts_legacy(common.format_.safe_unicode(text))
+    text_tmp = u""
+    for char in text:
+        if char in common.format_.ALLLOWED_ASCII_CHARS:
+            text_tmp += char
+    return text_tmp
+
+
+def _search_fields_legacy(address):
+    """
+    Former search document builder (for the benchmark)
+    """
+
+    fields = []
+
+    for field_def in [
+        Bunch(val = address.ct, name = u"creation_timestamp", ftype = search.DateField, repluml = False, char1 = False),
+        Bunch(val = address.cu, name = u"creation_user", ftype = search.TextField, repluml = False, char1 = False),
+        Bunch(val = address.et, name = u"edit_timestamp", ftype = search.DateField, repluml = False, char1 = False),
+        Bunch(val = address.eu, name = u"edit_user", ftype = search.TextField, repluml = False, char1 = False),
+        Bunch(val = address.owner, name = u"owner", ftype = search.AtomField, repluml = False, char1 = False),
+        Bunch(val = address.get_visibility(), name = u"visibility", ftype = search.AtomField, repluml = False, char1 = False),
+        Bunch(val = address.kind, name = u"kind", ftype = search.AtomField, repluml = False, char1 = False),
+        Bunch(val = address.organization, name = u"organization", ftype = search.TextField, repluml = True, char1 = False),
+        Bunch(val = address.position, name = u"position", ftype = search.TextField, repluml = True, char1 = True),
+        Bunch(val = address.salutation, name = u"salutation", ftype = search.TextField, repluml = True, char1 = True),
+        Bunch(val = address.first_name, name = u"first_name", ftype = search.TextField, repluml = True, char1 = True),
+        Bunch(val = address.last_name, name = u"last_name", ftype = search.TextField, repluml = True, char1 = True),
+        Bunch(val = address.nickname, name = u"nickname", ftype = search.TextField, repluml = True, char1 = True),
+        Bunch(val = address.street, name = u"street", ftype = search.TextField, repluml = True, char1 = True),
+        Bunch(val = address.postcode, name = u"postcode", ftype = search.TextField, repluml = False, char1 = True),
+        Bunch(val = address.city, name = u"city", ftype = search.TextField, repluml = True, char1 = True),
+        Bunch(val = address.district, name = u"district", ftype = search.TextField, repluml = True, char1 = False),
+        Bunch(val = address.land, name = u"land", ftype = search.TextField, repluml = True, char1 = False),
+        Bunch(val = address.country, name = u"country", ftype = search.TextField, repluml = True, char1 = False),
+        Bunch(val = address.gender, name = u"gender", ftype = search.AtomField, repluml = False, char1 = False),
+        Bunch(val = address.category_items, name = u"category", ftype = search.AtomField, repluml = False, char1 = False),
+        Bunch(val = address.tag_items, name = u"tag", ftype = search.AtomField, repluml = False, char1 = False),
+        Bunch(val = address.business_items, name = u"business", ftype = search.AtomField, repluml = False, char1 = False),
+    ]:
+        values = field_def.val
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            if value is not None:
+                fields.append(field_def.ftype(name = field_def.name, value = value))
+                if field_def.repluml and _has_umlauts_legacy(value):
+                    fields.append(field_def.ftype(name = field_def.name, value = _replace_umlauts_legacy(value)))
+                if field_def.char1 and len(value) > 0:
+                    fields.append(search.AtomField(name = field_def.name + u"_char1", value = value[0].lower()))
+
+    for phone_item in address.phone_items:
+        if phone_item.number is not None:
+            fields.append(search.TextField(name = u"phone", value = phone_item.number))
+    for email_item in address.email_items:
+        if email_item.email is not None:
+            fields.append(search.TextField(name = u"email", value = email_item.email))
+    for url_item in address.url_items:
+        if url_item.url is not None:
+            fields.append(search.TextField(name = u"url", value = url_item.url))
+
+    for free_defined_item in address.free_defined_items:
+        name = _safe_ascii_legacy(free_defined_item.label.lower().replace(" ", "_").replace("-", "_"))
+        if name in cherrypy.config["search_index.address.free_defined_fields.exceptions"]:
+            continue
+        value = free_defined_item.text
+        if value is not None and value:
+            if free_defined_item.value_type == u"unicode":
+                fields.append(search.TextField(name = name, value = value))
+                if _has_umlauts_legacy(free_defined_item.text):
+                    fields.append(search.TextField(name = name, value = _replace_umlauts_legacy(value)))
+            elif free_defined_item.value_type == u"int":
+                fields.append(search.NumberField(name = name, value = int(value)))
+            elif free_defined_item.value_type == u"float":
+                fields.append(search.NumberField(name = name, value = float(value)))
+            elif free_defined_item.value_type == u"date":
+                fields.append(search.DateField(name = name, value = common.format_.string_to_date(value)))
+
+    for anniversary_item in address.anniversary_items:
+        name = _safe_ascii_legacy(anniversary_item.label.lower().replace(" ", "_").replace("-", "_"))
+        value = u""
+        if anniversary_item.year and anniversary_item.month and anniversary_item.day:
+            value = datetime.date(int(anniversary_item.year), int(anniversary_item.month), int(anniversary_item.day))
+            fields.append(search.DateField(name = name, value = value))
+        else:
+            if anniversary_item.year:
+                value += unicode(anniversary_item.year) + "-"
+            if anniversary_item.month:
+                value += unicode(anniversary_item.month).rjust(2, "0") + "-"
+            if anniversary_item.day:
+                value += unicode(anniversary_item.day).rjust(2, "0")
+            value = value.rstrip("-")
+            fields.append(search.TextField(name = name, value = value))
+
+    return fields
+
+
+def _to_dict_deepcopy(
+    address,
+    include = None,
+    exclude = None,
+    exclude_creation_metadata = None,
+    exclude_edit_metadata = None,
+    exclude_empty_fields = None
+):
+    """
+    Former implementation of *Address.to_dict* (for the benchmark)
+    """
+
+    exclude = exclude or []
+    if exclude_creation_metadata:
+        exclude.extend(["ct", "cu"])
+    if exclude_edit_metadata:
+        exclude.extend(["et", "eu"])
+
+    address_dict = address._to_dict(include = include, exclude = exclude)
+    address_dict = copy.deepcopy(address_dict)
+    address_dict["key_urlsafe"] = address.key.urlsafe()
+
+    for fieldname in [
+        "phone_items",
+        "email_items",
+        "url_items",
+        "note_items",
+        "journal_items",
+        "agreement_items",
+        "free_defined_items",
+        "anniversary_items",
+    ]:
+        if fieldname not in address_dict:
+            continue
+
+        for field_item in address_dict.get(fieldname, []):
+            if exclude_creation_metadata:
+                if "ct" in field_item:
+                    del field_item["ct"]
+                if "cu" in field_item:
+                    del field_item["cu"]
+            if exclude_edit_metadata:
+                if "et" in field_item:
+                    del field_item["et"]
+                if "eu" in field_item:
+                    del field_item["eu"]
+
+        if exclude_empty_fields:
+            field = address_dict.get(fieldname, [])
+            if not field:
+                del address_dict[fieldname]
+
+    if exclude_empty_fields:
+        for key, value in address_dict.items():
+            if value is None:
+                del address_dict[key]
+            elif key in ["category_items", "business_items", "tag_items"]:
+                if not value:
+                    del address_dict[key]
+
+    return address_dict
+
+
 
 
 
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Bulk export of the address book (newline delimited JSON)
+"""
+
+import logging
+import cherrypy
+import hashlib
+import threading
+import common.errors
+import common.addresses
+import common.authorization
+import pyjsonrpc.rpcjson
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+
+
+# Globale Variable um die Benutzer (threadübergreifend) zwischenzuspeichern
+_users = None
+_users_lock = threading.Lock()
+
+
+def _security_users():
+    """
+    Returns the users (security.ini)
+    """
+
+    global _users
+
+    if _users:
+        return _users
+
+    with _users_lock:
+        _users = {}
+        for key, value in cherrypy.config["users"].items():
+            _users[key] = hashlib.md5(value).hexdigest()
+
+    return _users
+
+
+def _to_bool(value):
+    """
+    Converts a query string value ("1", "true", "yes") to bool
+    """
+
+    if isinstance(value, basestring):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def _to_list(value):
+    """
+    Converts a query string value ("a,b" or repeated parameters) to a list
+    """
+
+    if not value:
+        return None
+    if isinstance(value, basestring):
+        value = [value]
+    return [item.strip() for items in value for item in items.split(",") if item.strip()]
+
+
+def _ndjson_line(obj):
+    return pyjsonrpc.rpcjson.dumps(obj) + "\n"
+
+
+@cherrypy.expose
+def addresses(
+    cursor = None,
+    batch_size = None,
+    max_seconds = None,
+    include = None,
+    exclude = None,
+    exclude_creation_metadata = None,
+    exclude_edit_metadata = None,
+    exclude_empty_fields = None
+):
+    """
+    Streams all addresses as newline delimited JSON (one address per line)
+
+    After every batch a line with the cursor is written::
+
+        {"next_cursor": "<cursor string>", "more": true|false}
+
+    If the connection breaks or *max_seconds* is reached, the export can be
+    resumed with the last *next_cursor*.
+
+    Only the addresses, which the user may read, are exported.
+
+    :param cursor: Cursor string to resume the export
+    :param batch_size: Addresses per datastore batch (maximum: 1000)
+    :param max_seconds: Maximum runtime of the request
+    :param include: Comma separated field names (see *get_addresses*)
+    :param exclude: Comma separated field names (see *get_addresses*)
+    """
+
+    try:
+        batch_size = int(batch_size or cherrypy.config.get(
+            "export.batch_size", common.addresses.EXPORT_BATCH_SIZE
+        ))
+        max_seconds = float(max_seconds or cherrypy.config.get("export.max_seconds", 50))
+        if cursor:
+            ndb.Cursor(urlsafe = cursor)
+    except (ValueError, TypeError, datastore_errors.BadValueError):
+        raise cherrypy.HTTPError(400, "Invalid cursor, batch_size or max_seconds")
+    batch_size = min(max(batch_size, 1), common.addresses.EXPORT_MAX_BATCH_SIZE)
+    max_seconds = max(max_seconds, 1)
+    include = _to_list(include)
+    exclude = _to_list(exclude)
+    exclude_creation_metadata = _to_bool(exclude_creation_metadata)
+    exclude_edit_metadata = _to_bool(exclude_edit_metadata)
+    exclude_empty_fields = _to_bool(exclude_empty_fields)
+
+    # Only the addresses, which the user may read
+    user = cherrypy.request.login
+    try:
+        common.authorization.get_user_authorizations(user)
+    except common.errors.UserNotExistsError:
+        raise cherrypy.HTTPError(403, "Unknown user")
+
+    cherrypy.response.headers["Content-Type"] = "application/x-ndjson; charset=utf-8"
+    cherrypy.response.headers["Cache-Control"] = "no-cache"
+
+    def generate():
+        quantity = 0
+        for batch, next_cursor, more in common.addresses.iter_address_batches(
+            cursor = cursor,
+            batch_size = batch_size,
+            max_seconds = max_seconds,
+            user = user
+        ):
+            chunk = []
+            for address in batch:
+                chunk.append(_ndjson_line(address.to_dict(
+                    include = include,
+                    exclude = list(exclude or []),
+                    exclude_creation_metadata = exclude_creation_metadata,
+                    exclude_edit_metadata = exclude_edit_metadata,
+                    exclude_empty_fields = exclude_empty_fields
+                )))
+            chunk.append(_ndjson_line({"next_cursor": next_cursor, "more": more}))
+            quantity += len(batch)
+            yield "".join(chunk)
+
+        logging.info(u"Export: {quantity} addresses".format(quantity = quantity))
+
+    # Finished
+    return generate()
+
+addresses._cp_config = {
+    "response.stream": True,
+    "tools.encode.on": False,
+    "tools.basic_auth.on": True,
+    "tools.basic_auth.realm": "GAE-Address-Book - Export",
+    "tools.basic_auth.users": _security_users
+}
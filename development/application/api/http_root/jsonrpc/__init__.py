@@ -2,29 +2,39 @@
 # coding: utf-8
 
 import os
+import json
+import Queue
+import logging
 import cherrypy
 import hashlib
 import threading
 import inspect
-import docutils
-import docutils.core
 import datetime
 import common.constants
 import common.format_
 import common.addresses
+import common.address_index
+import common.address_history
 import common.authorization
 import common.tag_items
 import common.category_items
 import common.business_items
 import common.free_defined_fields
-from mako.template import Template
+import lib.templates
 from pyjsonrpc import JsonRpcError
 from google.appengine.api import search
+from google.appengine.api import memcache
 from pyjsonrpc.cp import CherryPyJsonRpc, rpcmethod
 
 
 THISDIR = os.path.dirname(os.path.abspath(__file__))
 QUERY_ERROR = 1001
+INTERNAL_ERROR = -32603  # JSON-RPC 2.0
+BATCH_THREADS = 6  # Concurrent calls of one JSON-RPC batch request
+HELP_PAGE_MEMCACHE_PREFIX = "jsonrpc_help:"
+
+# Gerenderte Hilfe-Seite (einmal pro Instanz)
+_help_page = None
 
 
 
@@ -62,6 +72,8 @@ def rest2html(
     subtitle, and docinfo.
     """
 
+    import docutils.core  # Erst bei Bedarf laden (Kaltstart)
+
     if not isinstance(input_string, unicode):
         if callable(input_string):
             input_string = str(input_string())
@@ -114,11 +126,38 @@ def extract_documentation(python_object, name):
 def jronsrpc_help(*args, **kwargs):
     """
     Gibt eine Hilfe-Seite zurück
+
+    Die Seite wird nur einmal pro deployter Version gerendert und
+    im Instanz-Speicher und im Memcache zwischengespeichert.
+    """
+
+    global _help_page
+
+    # Cache get (instance)
+    if _help_page:
+        return _help_page
+
+    # Cache get (memcache)
+    memcache_key = HELP_PAGE_MEMCACHE_PREFIX + os.environ.get(
+        "CURRENT_VERSION_ID", common.constants.VERSION
+    )
+    rendered = memcache.get(memcache_key)
+    if rendered is None:
+        rendered = _render_help_page()
+        memcache.set(memcache_key, rendered)
+
+    # Finished
+    _help_page = rendered
+    return rendered
+
+
+def _render_help_page():
+    """
+    Rendert die Hilfe-Seite (docutils für alle Docstrings)
     """
 
-    # Vorlage
-    template_path = os.path.join(THISDIR, "help.mako")
-    template = Template(filename = template_path)
+    # Vorlage (einmal kompiliert)
+    template = lib.templates.get_template("http_root/jsonrpc/help.mako")
     rendered = template.render_unicode(
         version = common.constants.VERSION,
         appname = cherrypy.config["APPNAME"],
@@ -132,6 +171,9 @@ def jronsrpc_help(*args, **kwargs):
             extract_documentation(JsonRpc.delete_address, u"delete_address"),
             extract_documentation(JsonRpc.get_addresses, u"get_addresses"),
             extract_documentation(JsonRpc.search_addresses, u"search_addresses"),
+            extract_documentation(JsonRpc.suggest_addresses, u"suggest_addresses"),
+            extract_documentation(JsonRpc.get_addresses_by_email, u"get_addresses_by_email"),
+            extract_documentation(JsonRpc.get_address_history, u"get_address_history"),
 
             extract_documentation(JsonRpc.get_category_items, u"get_category_items"),
             extract_documentation(JsonRpc.get_business_items, u"get_business_items"),
@@ -144,8 +186,11 @@ def jronsrpc_help(*args, **kwargs):
             extract_documentation(JsonRpc.get_free_defined_fields, u"get_free_defined_fields"),
 
             extract_documentation(JsonRpc.start_refresh_index, u"start_refresh_index"),
+            extract_documentation(JsonRpc.get_refresh_index_status, u"get_refresh_index_status"),
             extract_documentation(JsonRpc.start_delete_all_addresses, u"start_delete_all_addresses"),
             extract_documentation(JsonRpc.start_delete_all_search_indexes, u"start_delete_all_search_indexes"),
+            extract_documentation(JsonRpc.start_compact_address_histories, u"start_compact_address_histories"),
+            extract_documentation(JsonRpc.start_update_computed_properties, u"start_update_computed_properties"),
 
             extract_documentation(JsonRpc.get_search_index_fieldnames, u"get_search_index_fieldnames"),
 
@@ -171,17 +216,102 @@ class JsonRpc(CherryPyJsonRpc):
     index = CherryPyJsonRpc.request_handler
 
 
+    def call(self, json_request):
+        """
+        Dispatches the calls of a JSON-RPC batch request concurrently
+
+        A fixed pool of *jsonrpc.batch_threads* threads works through the
+        calls, so the blocking datastore and search RPCs of the calls
+        overlap. Every call runs with the current CherryPy request and an
+        own response object, so results, errors and response headers stay
+        isolated; an unexpected exception becomes an error response with
+        the id of the call.
+        Single requests are handled as usual.
+        """
+
+        try:
+            requests = json.loads(json_request)
+        except ValueError:
+            requests = None
+        if not isinstance(requests, list) or len(requests) < 2:
+            return CherryPyJsonRpc.call(self, json_request)
+
+        request = cherrypy.serving.request
+        results = [None] * len(requests)
+        calls = Queue.Queue()
+        for index, request_dict in enumerate(requests):
+            calls.put((index, request_dict))
+
+        def _call(index, request_dict):
+            # Own response object; headers, status and cookies of one call
+            # must not change the other calls
+            cherrypy.serving.load(request, cherrypy._cprequest.Response())
+            try:
+                results[index] = CherryPyJsonRpc.call(self, json.dumps(request_dict))
+            except Exception as err:
+                logging.exception(u"JSON-RPC batch call")
+                request_id = request_dict.get("id") if isinstance(request_dict, dict) else None
+                if request_id is not None:
+                    results[index] = json.dumps({
+                        "jsonrpc": "2.0",
+                        "id": request_id,
+                        "error": {
+                            "code": INTERNAL_ERROR,
+                            "message": u"Internal error",
+                            "data": common.format_.safe_errormessage(err)
+                        }
+                    })
+
+        def _worker():
+            while True:
+                try:
+                    index, request_dict = calls.get_nowait()
+                except Queue.Empty:
+                    return
+                _call(index, request_dict)
+
+        threads_count = max(min(
+            int(cherrypy.config.get("jsonrpc.batch_threads", BATCH_THREADS)),
+            len(requests)
+        ), 1)
+        threads = [threading.Thread(target = _worker) for _ in xrange(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Finished (notifications have no response)
+        results = [result for result in results if result]
+        if results:
+            return "[" + ",".join(results) + "]"
+
+
     @rpcmethod
     def get_info(self):
         """
         Returns informations about the address book
+
+        *search_index_lag* is the age (in seconds) of the oldest search
+        document, which is not written yet ("deferred" index mode; cached
+        for some seconds). In the "sync" index mode it is always 0.
+
+        *search_index_documents* counts the written search documents and
+        the skipped ones (indexed content unchanged)::
+
+            {"written": <Number>, "skipped": <Number>}
         """
 
         # Finished
         return dict(
             appname = cherrypy.config["APPNAME"],
             label = cherrypy.config["LABEL"],
-            addresses_count = common.addresses.get_address_quantity_cached()
+            addresses_count = common.addresses.get_address_quantity_cached(),
+            search_index_lag = (
+                common.address_index.get_index_lag()
+                if common.address_index.get_index_mode() == common.address_index.INDEX_MODE_DEFERRED
+                else 0
+            ),
+            search_index_documents = common.address_index.get_document_counts()
         )
 
 
@@ -212,7 +342,8 @@ class JsonRpc(CherryPyJsonRpc):
         free_defined_items = None,
         business_items = None,
         anniversary_items = None,
-        gender = None
+        gender = None,
+        private = None
     ):
         """
         Creates a new address
@@ -341,6 +472,9 @@ class JsonRpc(CherryPyJsonRpc):
             N stands for "none or not applicable",
             U stands for "unknown"
 
+        :param private: If `True`, the address is only visible for the owner
+            and for users with the "private_address.read" authorization.
+
         :return: New address (dictionary)
         """
 
@@ -426,7 +560,8 @@ class JsonRpc(CherryPyJsonRpc):
             free_defined_items = free_defined_items,
             business_items = business_items,
             anniversary_items = anniversary_items,
-            gender = gender
+            gender = gender,
+            private = private
         )
 
         # Finished
@@ -461,7 +596,9 @@ class JsonRpc(CherryPyJsonRpc):
         filter_by_city_char1 = None,
         filter_by_business_items = None,
         filter_by_category_items = None,
-        filter_by_tag_items = None
+        filter_by_tag_items = None,
+        fields_from_index = None,
+        count_mode = None
     ):
         """
         Returns a dictionary with the count of addresses and one page of addresses
@@ -499,16 +636,43 @@ class JsonRpc(CherryPyJsonRpc):
 
         :param filter_by_business_items: List with *case sensitive* items.
 
+        :param fields_from_index: If `True`, the addresses will built directly
+            from the search index, without reading the datastore. This works
+            only, if all requested fields (*include*) are stored in the search
+            index: "cu", "eu", "kind", "organization", "position", "salutation",
+            "first_name", "last_name", "nickname", "street", "postcode", "city",
+            "district", "land", "country", "gender", "category_items",
+            "tag_items", "business_items".
+            Without *include* (all fields) or with other fields, the
+            addresses will loaded from the datastore.
+
+        :param count_mode: Accuracy of the total quantity:
+
+            - "exact" (default): Exact up to 25000 addresses (slowest)
+            - "approximate:<n>": Exact up to <n> addresses, above an estimate
+            - "none": No total quantity (fastest, e.g. for infinite scrolling)
+
         :return: Dictionary with total quantity and one page with addresses::
 
             {
-                "total_quantity": <Quantity>,
+                "total_quantity": <Quantity> | null,
+                "total_exact": true | false,
                 "addresses": [<Address>, ...]
             }
         """
 
         addresses = []
 
+        # Fields, which can be served directly from the search index
+        returned_fields = None
+        if fields_from_index:
+            returned_fields = common.addresses.get_index_returned_fields(
+                include = include,
+                exclude = exclude,
+                exclude_creation_metadata = exclude_creation_metadata,
+                exclude_edit_metadata = exclude_edit_metadata
+            )
+
         try:
             fetched_result = common.addresses.get_addresses_by_search(
                 page = page,
@@ -531,7 +695,10 @@ class JsonRpc(CherryPyJsonRpc):
                 filter_by_city_char1 = filter_by_city_char1,
                 filter_by_business_items = filter_by_business_items,
                 filter_by_category_items = filter_by_category_items,
-                filter_by_tag_items = filter_by_tag_items
+                filter_by_tag_items = filter_by_tag_items,
+                returned_fields = returned_fields,
+                user = cherrypy.request.login,
+                count_mode = count_mode
             )
         except search.Error as err:
             raise JsonRpcError(
@@ -539,7 +706,14 @@ class JsonRpc(CherryPyJsonRpc):
                 code = QUERY_ERROR
             )
 
-        for address in fetched_result["addresses"]:
+        for address_dict in fetched_result.get("address_dicts", []):
+            if exclude_empty_fields:
+                for key, value in address_dict.items():
+                    if value is None or value == []:
+                        del address_dict[key]
+            addresses.append(address_dict)
+
+        for address in fetched_result.get("addresses", []):
             addresses.append(address.to_dict(
                 include = include,
                 exclude = exclude,
@@ -551,6 +725,7 @@ class JsonRpc(CherryPyJsonRpc):
         # Finished
         return dict(
             total_quantity = fetched_result["total_quantity"],
+            total_exact = fetched_result["total_exact"],
             addresses = addresses
         )
 
@@ -583,7 +758,8 @@ class JsonRpc(CherryPyJsonRpc):
 
         address = common.addresses.get_address(
             key_urlsafe = key_urlsafe,
-            address_uid = address_uid
+            address_uid = address_uid,
+            user = cherrypy.request.login
         )
         if not address:
             return None
@@ -600,10 +776,119 @@ class JsonRpc(CherryPyJsonRpc):
         return address_dict
 
 
+    @rpcmethod
+    def get_address_history(
+        self,
+        key_urlsafe = None,
+        address_uid = None,
+        limit = None,
+        cursor = None
+    ):
+        """
+        Returns the earlier versions of the address, newest first
+
+        :param limit: Maximal number of versions (default: 20)
+
+        :param cursor: *next_cursor* of the previous call
+
+        :return: Dictionary::
+
+            {
+                "versions": [
+                    {
+                        "version": <version number>,
+                        "ct": <timestamp of the change>,
+                        "cu": <user who changed the address>,
+                        "address": {<address before the change>}
+                    },
+                    ...
+                ],
+                "next_cursor": <cursor> | None,
+                "more": true | false
+            }
+        """
+
+        address = common.addresses.get_address(
+            key_urlsafe = key_urlsafe,
+            address_uid = address_uid,
+            user = cherrypy.request.login
+        )
+        if not address:
+            return None
+
+        try:
+            address_history = common.address_history.get_address_history(
+                address,
+                limit = limit,
+                cursor = cursor
+            )
+        except ValueError as err:
+            raise JsonRpcError(
+                message = common.format_.safe_errormessage(err),
+                code = QUERY_ERROR
+            )
+
+        # Finished
+        return address_history
+
+
+    @rpcmethod
+    def get_addresses_by_email(self, emails):
+        """
+        Finds the addresses by email address (exact, case insensitive)
+
+        :param emails: List with email addresses or one email address
+
+        :return: Dictionary with the email addresses (lower case) and the
+            keys of the found addresses::
+
+                {"max@example.com": [<KeyUrlsafe>, ...], ...}
+        """
+
+        # Finished
+        return common.addresses.get_addresses_by_email(
+            emails = emails,
+            user = cherrypy.request.login
+        )
+
+
+    @rpcmethod
+    def start_update_computed_properties(self):
+        """
+        Saves all addresses again (deferred), so that the email lookup
+        (*get_addresses_by_email*) also finds addresses of older releases.
+        """
+
+        common.addresses.start_update_computed_properties()
+
+        # Finished
+        return True
+
+
+    @rpcmethod
+    def start_compact_address_histories(self):
+        """
+        Converts the histories of all addresses to numbered versions
+        with deltas (deferred)
+
+        Needed once for histories of older releases, which are not
+        returned by *get_address_history()* before. Every address is
+        compacted in small steps (own tasks); do not start it again,
+        before all tasks are finished.
+        """
+
+        common.address_history.start_compact_histories()
+
+        # Finished
+        return True
+
+
     @rpcmethod
     def start_refresh_index(self):
         """
         Starts the refreshing of the index in a query (deferred)
+
+        The progress can be requested with *get_refresh_index_status()*.
         """
 
         # Address index refresh
@@ -613,6 +898,29 @@ class JsonRpc(CherryPyJsonRpc):
         return True
 
 
+    @rpcmethod
+    def get_refresh_index_status(self):
+        """
+        Returns the progress of the last index refresh
+
+        :return: Dictionary::
+
+            {
+                "phase": "documents" | "orphans",
+                "documents": <Written documents>,
+                "deleted_documents": <Deleted documents of not existing addresses>,
+                "failed_documents": <Documents, which could not be written or deleted>,
+                "failed_ids": [<Document id>, ...] (the first 100),
+                "documents_per_second": <Throughput>,
+                "started": <ISO-Timestamp>,
+                "finished": <ISO-Timestamp> | None,
+                ...
+            }
+        """
+
+        return common.addresses.get_rebuild_index_status()
+
+
     @rpcmethod
     def save_address(
         self,
@@ -643,7 +951,9 @@ class JsonRpc(CherryPyJsonRpc):
         free_defined_items = None,
         business_items = None,
         anniversary_items = None,
-        gender = None
+        gender = None,
+        private = None,
+        return_changed_fields = None
     ):
         """
         Saves one address
@@ -775,6 +1085,23 @@ class JsonRpc(CherryPyJsonRpc):
             N stands for "none or not applicable",
             U stands for "unknown"
 
+        :param private: If `True`, the address is only visible for the owner
+            and for users with the "private_address.read" authorization.
+
+        :param return_changed_fields: If `True`, the saved address and the
+            changes are returned::
+
+                {
+                    "address": {<address>},
+                    "changed_fields": {
+                        "fields": [<field name>, ...],
+                        "item_uids": [<uid of a new, changed or removed item>, ...]
+                    }
+                }
+
+            If nothing has changed, the address is not saved and
+            both lists are empty.
+
         :return: Saved address (dictionary)
         """
 
@@ -840,7 +1167,7 @@ class JsonRpc(CherryPyJsonRpc):
             ]
 
         # Saving
-        address = common.addresses.save_address(
+        address, changes = common.addresses.save_address(
             user = user,
             key_urlsafe = key_urlsafe,
             address_uid = address_uid,
@@ -869,41 +1196,66 @@ class JsonRpc(CherryPyJsonRpc):
             free_defined_items = free_defined_items,
             business_items = business_items,
             anniversary_items = anniversary_items,
-            gender = gender
+            gender = gender,
+            private = private,
+            return_changed_fields = True
         )
 
         address_dict = address.to_dict()
 
         # Finished
+        if return_changed_fields:
+            return {"address": address_dict, "changed_fields": changes}
         return address_dict
 
 
     @rpcmethod
-    def get_category_items(self):
+    def get_category_items(self, with_counts = None):
         """
         Returns all used category items as unordered list.
+
+        :param with_counts: If `True`, returns a dictionary with the
+            items as keys and the number of addresses as values. The values
+            are `null`, until the counts are built the first time.
         """
 
+        if with_counts:
+            return common.category_items.get_category_item_counts()
+
         # Finished
         return list(common.category_items.get_category_items_cached())
 
 
     @rpcmethod
-    def get_business_items(self):
+    def get_business_items(self, with_counts = None):
         """
         Returns all used business items as unordered list.
+
+        :param with_counts: If `True`, returns a dictionary with the
+            items as keys and the number of addresses as values. The values
+            are `null`, until the counts are built the first time.
         """
 
+        if with_counts:
+            return common.business_items.get_business_item_counts()
+
         # Finished
         return list(common.business_items.get_business_items_cached())
 
 
     @rpcmethod
-    def get_tag_items(self):
+    def get_tag_items(self, with_counts = None):
         """
         Returns cached tag items as unordered list.
+
+        :param with_counts: If `True`, returns a dictionary with the
+            items as keys and the number of addresses as values. The values
+            are `null`, until the counts are built the first time.
         """
 
+        if with_counts:
+            return common.tag_items.get_tag_item_counts()
+
         # Finished
         return list(common.tag_items.get_tag_items_cached())
 
@@ -914,7 +1266,8 @@ class JsonRpc(CherryPyJsonRpc):
         query_string,
         page = None,
         page_size = None,
-        returned_fields = None
+        returned_fields = None,
+        count_mode = None
     ):
         """
         Searches for addresses in the "Address" index
@@ -963,23 +1316,40 @@ class JsonRpc(CherryPyJsonRpc):
                         },
                         ...
                     ],
-                    "number_found": <quantity>
+                    "number_found": <quantity> | null,
+                    "number_found_exact": true | false
                 }
 
+        :param count_mode: "exact", "approximate:<n>" (default: "approximate:100")
+            or "none". See *get_addresses()*.
         """
 
         # Search
-        search_result = common.addresses.search_addresses(
-            query_string = query_string,
-            page = page or 1,
-            page_size = page_size or 20,
-            returned_fields = returned_fields
-        )
+        try:
+            search_result = common.addresses.search_addresses(
+                query_string = query_string,
+                page = page or 1,
+                page_size = page_size or 20,
+                returned_fields = returned_fields,
+                user = cherrypy.request.login,
+                count_mode = count_mode
+            )
+        except search.Error as err:
+            raise JsonRpcError(
+                message = common.format_.safe_errormessage(err),
+                code = QUERY_ERROR
+            )
 
         # Prepare result for converting to JSON
+        number_found_accuracy = common.addresses.get_number_found_accuracy(
+            count_mode or common.addresses.SEARCH_ADDRESSES_COUNT_MODE
+        )
         result = dict(
             results = [],
-            number_found = search_result.number_found
+            number_found = search_result.number_found if number_found_accuracy else None,
+            number_found_exact = bool(
+                number_found_accuracy and search_result.number_found <= number_found_accuracy
+            )
         )
         for scored_document in search_result.results:
             fields = []
@@ -1002,6 +1372,35 @@ class JsonRpc(CherryPyJsonRpc):
         return result
 
 
+    @rpcmethod
+    def suggest_addresses(self, prefix, limit = None):
+        """
+        Type-as-you-go search over first name, last name, nickname,
+        organization and city (beginnings of words, umlauts optional)
+
+        Example: "max mü" finds "Max Müller" and "Maximilian Mueller".
+
+        :param prefix: Typed text
+        :param limit: Maximum quantity of addresses (default: 10)
+
+        :return: List with ids and display names::
+
+            [{"key_urlsafe": <KeyUrlsafe>, "display_name": <Name>}, ...]
+        """
+
+        try:
+            return common.addresses.suggest_addresses(
+                prefix = prefix,
+                limit = limit,
+                user = cherrypy.request.login
+            )
+        except search.Error as err:
+            raise JsonRpcError(
+                message = common.format_.safe_errormessage(err),
+                code = QUERY_ERROR
+            )
+
+
     @rpcmethod
     def delete_address(
         self,
@@ -1247,7 +1646,9 @@ class JsonRpc(CherryPyJsonRpc):
         filter_by_city_char1 = None,
         filter_by_business_items = None,
         filter_by_category_items = None,
-        filter_by_tag_items = None
+        filter_by_tag_items = None,
+        fields_from_index = None,
+        count_mode = None
     ):
         """
         Returns a dictionary with the count of addresses and one page of addresses
@@ -1287,11 +1688,19 @@ class JsonRpc(CherryPyJsonRpc):
 
         :param filter_by_business_items: List with *case sensitive* items.
 
+        :param fields_from_index: If `True`, the addresses will built directly
+            from the search index, without reading the datastore (only with
+            *include*). See *get_addresses()*.
+
+        :param count_mode: "exact" (default), "approximate:<n>" or "none".
+            See *get_addresses()*.
+
         :return: Dictionary with total quantity, cursor-string and one page
             with addresses::
 
                 {
-                    "total_quantity": <Quantity>,
+                    "total_quantity": <Quantity> | null,
+                    "total_exact": true | false,
                     "next_cursor": <CursorString>
                     "addresses": [<Address>, ...]
                 }
@@ -1299,6 +1708,16 @@ class JsonRpc(CherryPyJsonRpc):
 
         addresses = []
 
+        # Fields, which can be served directly from the search index
+        returned_fields = None
+        if fields_from_index:
+            returned_fields = common.addresses.get_index_returned_fields(
+                include = include,
+                exclude = exclude,
+                exclude_creation_metadata = exclude_creation_metadata,
+                exclude_edit_metadata = exclude_edit_metadata
+            )
+
         try:
             fetched_result = common.addresses.get_addresses_for_iteration(
                 cursor = cursor,
@@ -1321,7 +1740,10 @@ class JsonRpc(CherryPyJsonRpc):
                 filter_by_city_char1 = filter_by_city_char1,
                 filter_by_business_items = filter_by_business_items,
                 filter_by_category_items = filter_by_category_items,
-                filter_by_tag_items = filter_by_tag_items
+                filter_by_tag_items = filter_by_tag_items,
+                returned_fields = returned_fields,
+                user = cherrypy.request.login,
+                count_mode = count_mode
             )
         except search.Error as err:
             raise JsonRpcError(
@@ -1329,7 +1751,14 @@ class JsonRpc(CherryPyJsonRpc):
                 code = QUERY_ERROR
             )
 
-        for address in fetched_result["addresses"]:
+        for address_dict in fetched_result.get("address_dicts", []):
+            if exclude_empty_fields:
+                for key, value in address_dict.items():
+                    if value is None or value == []:
+                        del address_dict[key]
+            addresses.append(address_dict)
+
+        for address in fetched_result.get("addresses", []):
             addresses.append(address.to_dict(
                 include = include,
                 exclude = exclude,
@@ -1346,6 +1775,7 @@ class JsonRpc(CherryPyJsonRpc):
 
         return dict(
             total_quantity = fetched_result["total_quantity"],
+            total_exact = fetched_result["total_exact"],
             next_cursor = next_cursor,
             addresses = addresses
         )
@@ -1367,23 +1797,24 @@ class JsonRpc(CherryPyJsonRpc):
         :param address_keys: List with keys or string with one key
 
         :param categories: List with category names or string with one category
+
+        :return: Dictionary with the result for each address key::
+
+            {<KeyUrlsafe>: "changed" | "unchanged" | "not_found" | "not_authorized", ...}
         """
 
         # Username
         user = cherrypy.request.login
 
         # Working
-        common.addresses.add_categories(
+        results = common.addresses.add_categories(
             user = user,
             address_keys = address_keys,
             categories = categories
         )
 
-        # Kategorien zum Cache hinzufügen
-        common.category_items.add_category_items_to_cache(categories)
-
         # Finished
-        return True
+        return results
 
 
     @rpcmethod
@@ -1402,20 +1833,24 @@ class JsonRpc(CherryPyJsonRpc):
         :param address_keys: List with keys or string with one key
 
         :param categories: List with category names or string with one category
+
+        :return: Dictionary with the result for each address key::
+
+            {<KeyUrlsafe>: "changed" | "unchanged" | "not_found" | "not_authorized", ...}
         """
 
         # Username
         user = cherrypy.request.login
 
         # Working
-        common.addresses.delete_categories(
+        results = common.addresses.delete_categories(
             user = user,
             address_keys = address_keys,
             categories = categories
         )
 
         # Finished
-        return True
+        return results
 
 
     @rpcmethod
@@ -1434,23 +1869,24 @@ class JsonRpc(CherryPyJsonRpc):
         :param address_keys: List with keys or string with one key
 
         :param tags: List with tag names or string with one tag
+
+        :return: Dictionary with the result for each address key::
+
+            {<KeyUrlsafe>: "changed" | "unchanged" | "not_found" | "not_authorized", ...}
         """
 
         # Username
         user = cherrypy.request.login
 
         # Working
-        common.addresses.add_tags(
+        results = common.addresses.add_tags(
             user = user,
             address_keys = address_keys,
             tags = tags
         )
 
-        # Tag-Items zum Cache hinzufügen
-        common.tag_items.add_tag_items_to_cache(tags)
-
         # Finished
-        return True
+        return results
 
 
     @rpcmethod
@@ -1469,20 +1905,24 @@ class JsonRpc(CherryPyJsonRpc):
         :param address_keys: List with keys or string with one key
 
         :param tags: List with tag names or string with one tag
+
+        :return: Dictionary with the result for each address key::
+
+            {<KeyUrlsafe>: "changed" | "unchanged" | "not_found" | "not_authorized", ...}
         """
 
         # Username
         user = cherrypy.request.login
 
         # Working
-        common.addresses.delete_tags(
+        results = common.addresses.delete_tags(
             user = user,
             address_keys = address_keys,
             tags = tags
         )
 
         # Finished
-        return True
+        return results
 
 
 
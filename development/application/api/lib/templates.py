@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Shared Mako template lookup
+
+The templates are compiled once per instance and kept (as Python modules)
+in the in-process cache of the lookup. The file system of App Engine is
+read only, so no *module_directory* is used.
+
+Mako is imported with the first template, not at instance start.
+"""
+
+import threading
+from constants import APIDIR
+
+
+_lookup = None
+_lookup_lock = threading.Lock()
+
+
+def get_lookup():
+    """
+    Returns the shared TemplateLookup
+
+    Template names are relative to the api directory,
+    e.g. "error_pages/error_page_500.mako"
+    """
+
+    global _lookup
+
+    if _lookup:
+        return _lookup
+
+    with _lookup_lock:
+        if not _lookup:
+            from mako.lookup import TemplateLookup
+            _lookup = TemplateLookup(
+                directories = [APIDIR],
+                filesystem_checks = False,
+                collection_size = 50
+            )
+
+    return _lookup
+
+
+def get_template(name):
+    """
+    Returns the compiled template
+
+    :param name: Template path relative to the api directory
+    """
+
+    return get_lookup().get_template(name)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Warmup-Request (/_ah/warmup)
+
+Füllt die Instanz-Caches, bevor die Instanz Benutzer-Requests bekommt.
+"""
+
+import time
+import logging
+import cherrypy
+import common.http
+import common.format_
+import common.authorization
+import common.address_index
+import common.addresses
+import common.category_items
+import common.tag_items
+import common.business_items
+import common.import_profile
+import lib.templates
+from google.appengine.api import memcache
+
+
+def _security_users():
+    # Benutzer der Api-Zugänge (MD5-Tabellen)
+    from http_root.jsonrpc import _security_users as jsonrpc_users
+    from http_root.export import _security_users as export_users
+    jsonrpc_users()
+    export_users()
+
+
+def _templates():
+    # Mako laden und Vorlagen kompilieren
+    lib.templates.get_template("error_pages/error_page_404.mako")
+    lib.templates.get_template("error_pages/error_page_500.mako")
+
+
+def _memcache():
+    # Verbindung zum Memcache
+    memcache.get("warmup")
+
+
+def _search_index():
+    # Name des Suchindex (NamedValue) und Index-Objekt
+    common.address_index.get_index()
+
+    # Veralteten Suchindex (Dokument-Schema) neu aufbauen
+    common.addresses.start_schema_rebuild()
+
+
+def _address_quantity():
+    common.addresses.get_address_quantity_cached()
+
+
+def _facet_items():
+    # Kategorien, Tags und Branchen (NamedValue und Memcache)
+    common.category_items.get_category_items_cached()
+    common.tag_items.get_tag_items_cached()
+    common.business_items.get_business_items_cached()
+
+
+WARMUP_STEPS = [
+    ("security_users", _security_users),
+    ("authorizations", common.authorization.compile_authorizations),
+    ("templates", _templates),
+    ("memcache", _memcache),
+    ("search_index", _search_index),
+    ("address_quantity", _address_quantity),
+    ("facet_items", _facet_items),
+]
+
+
+def warmup():
+    """
+    Führt alle Warmup-Schritte aus
+
+    Ein fehlgeschlagener Schritt wird geloggt; die anderen Schritte
+    werden trotzdem ausgeführt.
+
+    :return: Liste mit (<Schritt>, <Millisekunden>, <Fehler oder None>)
+    """
+
+    results = []
+    for name, function in WARMUP_STEPS:
+        start = time.time()
+        error = None
+        try:
+            function()
+        except Exception as err:
+            error = common.format_.safe_unicode(err)
+            logging.warning(u"Warmup {name}: {error}".format(name = name, error = error))
+        results.append((name, (time.time() - start) * 1000, error))
+
+    # Finished
+    return results
+
+
+class Root(object):
+
+    @cherrypy.expose
+    def warmup(self):
+        """
+        Warmup-Handler (app.yaml: inbound_services: warmup)
+        """
+
+        start = time.time()
+        results = warmup()
+        total_ms = (time.time() - start) * 1000
+        common.import_profile.mark("warmup")
+
+        lines = [u"Warmup: {ms:.0f} ms".format(ms = total_ms)]
+        for name, ms, error in results:
+            lines.append(u"  {name}: {ms:.0f} ms{error}".format(
+                name = name,
+                ms = ms,
+                error = u" ({0})".format(error) if error else u""
+            ))
+        report = u"\n".join(lines)
+        logging.info(report)
+
+        # Finished
+        common.http.set_content_type_text()
+        return report
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Address history with field-level deltas
+
+Every edit of an address writes one AddressHistory entity with the state
+before the edit. The key id is the version number (1 = oldest version).
+The version is allocated in the same transaction, which saves the address
+(see *put_address()*).
+
+Only every n-th version (*address_history.snapshot_interval*) stores the
+whole address. All other versions store the fields, which differ from the
+next newer version (reverse delta). A version is rebuilt by starting with
+the current address (or the next newer snapshot) and applying the deltas
+down to the requested version.
+"""
+
+import time
+import logging
+import cherrypy
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from model.address import Address, INTERNAL_FIELDS
+from model.address_history import AddressHistory
+
+SNAPSHOT_INTERVAL = 10  # Every n-th version holds the whole address
+HISTORY_PAGE_SIZE = 20
+HISTORY_EXCLUDED_FIELDS = sorted(INTERNAL_FIELDS)  # Not stored in the history
+COMPACT_BATCH_SIZE = 100  # Address keys per query
+COMPACT_CHUNK_SIZE = 25  # History entries per compaction transaction
+COMPACT_TASK_SECONDS = 60  # Runtime of one compact task, before the next is chained
+
+
+def get_snapshot_interval():
+    return int(cherrypy.config.get("address_history.snapshot_interval") or SNAPSHOT_INTERVAL)
+
+
+def get_history_dict(address):
+    """
+    Returns the address as dictionary, like it will be stored in the history
+    """
+
+    return address.to_dict(exclude = HISTORY_EXCLUDED_FIELDS)
+
+
+def get_delta(old_dict, new_dict):
+    """
+    Returns the fields, which are needed to get *old_dict* from *new_dict*
+
+    :return: {"set": {<field>: <old value>, ...}, "unset": [<field>, ...]}
+    """
+
+    changed = {}
+    for key, value in old_dict.iteritems():
+        if key not in new_dict or new_dict[key] != value:
+            changed[key] = value
+    removed = [key for key in new_dict if key not in old_dict]
+
+    # Finished
+    return {"set": changed, "unset": removed}
+
+
+def apply_delta(delta, new_dict):
+    """
+    Returns the older address dictionary (*new_dict* is not changed)
+    """
+
+    old_dict = dict(new_dict)
+    for key in delta.get("unset") or []:
+        old_dict.pop(key, None)
+    old_dict.update(delta.get("set") or {})
+
+    # Finished
+    return old_dict
+
+
+def _rebuild(history, new_dict):
+    """
+    Returns the address dictionary of one history entry
+
+    :param new_dict: Dictionary of the next newer version
+    """
+
+    if history is None:
+        return None
+    if history.address_dict is not None:
+        return dict(history.address_dict)
+    if new_dict is None or history.delta is None:
+        return None
+    return apply_delta(history.delta, new_dict)
+
+
+def new_history(address, user, old_dict, new_dict = None):
+    """
+    Creates the history entity of the next version (not saved)
+
+    Increments *address.history_version*, so the address must be saved
+    after the history entity.
+
+    :param old_dict: Result of *get_history_dict()* before the edit
+    :param new_dict: Result of *get_history_dict()* after the edit
+    """
+
+    version = (address.history_version or 0) + 1
+    address.history_version = version
+
+    history = AddressHistory(id = version, parent = address.key, cu = user)
+    if version % get_snapshot_interval() == 0:
+        history.address_dict = old_dict
+    else:
+        if new_dict is None:
+            new_dict = get_history_dict(address)
+        history.delta = get_delta(old_dict, new_dict)
+
+    # Finished
+    return history
+
+
+@ndb.tasklet
+def _new_history_from_stored(address, user):
+    """
+    Creates the history entity of the next version from the stored address
+
+    Must be called in a transaction, so that concurrent saves never get
+    the same version number.
+    """
+
+    stored = yield address.key.get_async(use_cache = False)
+    address.history_version = (stored.history_version or 0) if stored else 0
+    old_dict = get_history_dict(stored) if stored else {}
+    raise ndb.Return(new_history(address, user, old_dict))
+
+
+def put_address(address, user):
+    """
+    Saves the address and the history entry of the stored version in one
+    transaction and updates the search index after the commit
+    """
+
+    search_fields = address.get_search_fields()
+    index_changed = address.set_index_hash(search_fields)
+
+    put_address_async(address, user).get_result()
+
+    # Not in the transaction (other entity groups, not retriable)
+    address.write_search_document(search_fields, index_changed)
+
+
+@ndb.transactional_tasklet
+def put_address_async(address, user):
+    """
+    Saves the address and the history entry of the stored version in one
+    transaction (tasklet)
+
+    Only the entity group of the address is written; the search index is
+    not updated.
+    """
+
+    history = yield _new_history_from_stored(address, user)
+    yield ndb.put_multi_async([history, address])
+
+
+def _get_histories(address_key, versions):
+    """
+    Loads the history entries with one *get_multi*
+
+    :return: {<version>: <AddressHistory> | None, ...}
+    """
+
+    keys = [ndb.Key(AddressHistory, version, parent = address_key) for version in versions]
+    return dict(zip(versions, ndb.get_multi(keys)))
+
+
+def parse_cursor(cursor):
+    """
+    Returns the version number of a *next_cursor*
+
+    Raises a `ValueError`, if the cursor is invalid.
+    """
+
+    try:
+        version = int(cursor)
+    except (TypeError, ValueError):
+        version = None
+    if version is None or version < 1:
+        raise ValueError(u"Invalid cursor: {cursor!r}".format(cursor = cursor))
+
+    # Finished
+    return version
+
+
+def get_address_history(address, limit = HISTORY_PAGE_SIZE, cursor = None):
+    """
+    Returns the rebuilt versions of the address, newest first
+
+    :param address: Address-Object (current version)
+    :param limit: Maximal number of versions
+    :param cursor: *next_cursor* of the previous call (`ValueError`, if invalid)
+
+    :return: Dictionary::
+
+        {
+            "versions": [
+                {"version": <version>, "ct": <datetime>, "cu": <user>, "address": {...}},
+                ...
+            ],
+            "next_cursor": <cursor> | None,
+            "more": True | False
+        }
+    """
+
+    latest = address.history_version or 0
+    start = min(parse_cursor(cursor), latest) if cursor else latest
+    stop = max(start - (limit or HISTORY_PAGE_SIZE), 0)
+    interval = get_snapshot_interval()
+
+    # Newer versions up to the next snapshot
+    newer = {}
+    top = latest
+    version = start + 1
+    while version <= latest:
+        chunk = range(version, min(version + interval, latest + 1))
+        newer.update(_get_histories(address.key, chunk))
+        snapshots = [
+            chunk_version for chunk_version in chunk
+            if newer[chunk_version] is not None and newer[chunk_version].address_dict is not None
+        ]
+        if snapshots:
+            top = snapshots[0]
+            break
+        version += interval
+
+    address_dict = get_history_dict(address) if top == latest else None
+    for version in xrange(top, start, -1):
+        address_dict = _rebuild(newer[version], address_dict)
+
+    # Requested versions
+    versions = []
+    histories = _get_histories(address.key, range(start, stop, -1))
+    for version in xrange(start, stop, -1):
+        history = histories[version]
+        address_dict = _rebuild(history, address_dict)
+        if history is None:
+            continue
+        versions.append({
+            "version": version,
+            "ct": history.ct,
+            "cu": history.cu,
+            "address": address_dict
+        })
+
+    # Finished
+    return {
+        "versions": versions,
+        "next_cursor": unicode(stop) if stop else None,
+        "more": bool(stop)
+    }
+
+
+def _get_legacy_ids(address_key, history_version):
+    """
+    Returns the ids of the entries of older releases, oldest first
+
+    Entries of older releases have automatic ids, which are always greater
+    than the newest version number.
+    """
+
+    legacy = [
+        (history.ct, history.key.id())
+        for history in AddressHistory.query(ancestor = address_key).iter(
+            batch_size = COMPACT_CHUNK_SIZE
+        )
+        if history.key.id() > history_version
+    ]
+
+    # Finished
+    return [legacy_id for ct, legacy_id in sorted(legacy)]
+
+
+def compact_history(address_key):
+    """
+    Starts the conversion of the entries of older releases (automatic ids,
+    full copies) to numbered versions with deltas
+
+    The entries of older releases are older than all numbered versions.
+    So the numbered versions are moved up first (newest first), then the
+    old entries get the versions 1..n (oldest first). Every step is one
+    small transaction, which chains the next step as transactional task.
+    The address can be edited between the steps.
+
+    :return: `True`, if the compaction was started
+    """
+
+    address = address_key.get()
+    if not address:
+        return False
+    legacy_ids = _get_legacy_ids(address_key, address.history_version or 0)
+    if not legacy_ids:
+        return False
+
+    @ndb.transactional
+    def _start():
+        address = address_key.get()
+        numbered_top = address.history_version or 0
+        if legacy_ids[0] <= numbered_top:
+            return False
+
+        # New versions are written above the moved numbered versions
+        # (the search fields are not changed)
+        address.history_version = numbered_top + len(legacy_ids)
+        ndb.Model.put(address)
+
+        if numbered_top:
+            deferred.defer(
+                _move_versions, address_key.urlsafe(), legacy_ids, numbered_top,
+                _transactional = True
+            )
+        else:
+            deferred.defer(
+                _convert_legacy, address_key.urlsafe(), legacy_ids, 0,
+                _transactional = True
+            )
+        return True
+
+    # Finished
+    return _start()
+
+
+def _move_versions(address_key_urlsafe, legacy_ids, position):
+    """
+    Moves the numbered versions *position* and below (one chunk) up by the
+    number of entries of older releases
+
+    This function will started by deferred and chains itself.
+    """
+
+    address_key = ndb.Key(urlsafe = address_key_urlsafe)
+    offset = len(legacy_ids)
+    versions = range(position, max(position - COMPACT_CHUNK_SIZE, 0), -1)
+
+    @ndb.transactional
+    def _move():
+        histories = _get_histories(address_key, versions)
+        moved = []
+        missing = []
+        for version in versions:
+            target_key = ndb.Key(AddressHistory, version + offset, parent = address_key)
+            history = histories[version]
+            if history is None:
+                missing.append(target_key)
+                continue
+            moved.append(AddressHistory(
+                key = target_key,
+                ct = history.ct,
+                cu = history.cu,
+                address_dict = history.address_dict,
+                delta = history.delta
+            ))
+        ndb.put_multi(moved)
+        ndb.delete_multi(missing)
+
+        # Next step (the versions below are overwritten by the next steps)
+        next_position = versions[-1] - 1
+        if next_position > 0:
+            deferred.defer(
+                _move_versions, address_key_urlsafe, legacy_ids, next_position,
+                _transactional = True
+            )
+        else:
+            deferred.defer(
+                _convert_legacy, address_key_urlsafe, legacy_ids, 0,
+                _transactional = True
+            )
+
+    _move()
+
+
+def _convert_legacy(address_key_urlsafe, legacy_ids, index):
+    """
+    Converts one chunk of entries of older releases (oldest first) to the
+    versions *index + 1* and up
+
+    This function will started by deferred and chains itself.
+    """
+
+    address_key = ndb.Key(urlsafe = address_key_urlsafe)
+    interval = get_snapshot_interval()
+    chunk_ids = legacy_ids[index:index + COMPACT_CHUNK_SIZE]
+
+    # One more entry: the next newer version of the last entry
+    load_ids = legacy_ids[index:index + COMPACT_CHUNK_SIZE + 1]
+
+    @ndb.transactional
+    def _convert():
+        legacy = ndb.get_multi([
+            ndb.Key(AddressHistory, legacy_id, parent = address_key) for legacy_id in load_ids
+        ])
+        address_dicts = []
+        for history in legacy:
+            address_dict = dict(history.address_dict or {}) if history else None
+            if address_dict is not None:
+                for fieldname in HISTORY_EXCLUDED_FIELDS:
+                    address_dict.pop(fieldname, None)
+            address_dicts.append(address_dict)
+
+        entries = []
+        for position, history in enumerate(legacy[:len(chunk_ids)]):
+            version = index + position + 1
+            entry = AddressHistory(
+                id = version,
+                parent = address_key,
+                ct = history.ct if history else None,
+                cu = history.cu if history else u""
+            )
+            old_dict = address_dicts[position] or {}
+            new_dict = address_dicts[position + 1] if position + 1 < len(address_dicts) else None
+            if version == len(legacy_ids) or version % interval == 0 or new_dict is None:
+                entry.address_dict = old_dict
+            else:
+                entry.delta = get_delta(old_dict, new_dict)
+            entries.append(entry)
+        ndb.put_multi(entries)
+        ndb.delete_multi([
+            ndb.Key(AddressHistory, legacy_id, parent = address_key) for legacy_id in chunk_ids
+        ])
+
+        # Next step
+        if index + len(chunk_ids) < len(legacy_ids):
+            deferred.defer(
+                _convert_legacy, address_key_urlsafe, legacy_ids, index + len(chunk_ids),
+                _transactional = True
+            )
+
+    _convert()
+
+
+def _compact_address(address_key_urlsafe):
+    """
+    Compacts the history of one address (re-queued after an error)
+    """
+
+    compact_history(ndb.Key(urlsafe = address_key_urlsafe))
+
+
+def start_compact_histories():
+    """
+    Starts the compaction of all address histories (deferred)
+    """
+
+    deferred.defer(_compact_histories)
+
+
+def _compact_histories(cursor = None, addresses = 0, compacted = 0):
+    """
+    Compacts the histories of all addresses
+
+    This function will started by deferred and chains itself.
+    """
+
+    task_start = time.time()
+    cursor = ndb.Cursor(urlsafe = cursor) if cursor else ndb.Cursor()
+
+    while time.time() - task_start < COMPACT_TASK_SECONDS:
+        address_keys, next_cursor, more = Address.query().fetch_page(
+            page_size = COMPACT_BATCH_SIZE,
+            start_cursor = cursor,
+            keys_only = True
+        )
+        for address_key in address_keys:
+            addresses += 1
+            try:
+                if compact_history(address_key):
+                    compacted += 1
+            except Exception as err:
+                # Again in an own task (retried by the task queue)
+                logging.warning(u"compact_history {key}: {err}".format(
+                    key = address_key.urlsafe(), err = err
+                ))
+                deferred.defer(_compact_address, address_key.urlsafe())
+
+        if not (more and next_cursor):
+            logging.info(
+                u"compact_histories: {addresses} addresses, "
+                u"compaction of {compacted} histories started".format(
+                    addresses = addresses, compacted = compacted
+                )
+            )
+            return
+
+        cursor = next_cursor
+
+    # Next step
+    deferred.defer(
+        _compact_histories,
+        cursor = cursor.urlsafe(),
+        addresses = addresses,
+        compacted = compacted
+    )
@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Writes the documents of the "Address" search index
+
+Two modes are available (INI-setting *search_index.address.mode*):
+
+- "sync": The search document is written directly after saving the address.
+
+- "deferred": Saving the address only marks the document id as pending and
+  enqueues a task. The task collects all pending document ids and updates the
+  search index with batched requests.
+
+The name of the active search index (e.g. "Address_v7") is saved in the
+NamedValue "address_index". While the search index is rebuilt, a second
+("shadow") index is filled. All writes go to both indexes until the shadow
+index is activated.
+"""
+
+import time
+import hashlib
+import logging
+import datetime
+import cherrypy
+from google.appengine.ext import ndb
+from google.appengine.api import search
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from model.pending_search_document import PendingSearchDocument
+import named_values
+import search_cache
+
+INDEX_MODE_SYNC = "sync"
+INDEX_MODE_DEFERRED = "deferred"
+
+SEARCH_INDEX_BATCH_SIZE = 200  # Maximum documents per search.Index.put
+INDEX_QUEUE = "searchindex"
+INDEX_WINDOW_SECONDS = 5  # Pending documents are collected in this time window
+INDEX_PENDING_RETRIES = 2  # Retries, if the query finds no pending documents (yet)
+INDEX_LAG = "address_index:lag"
+INDEX_LAG_CACHE_SECONDS = 10
+
+ADDRESS_INDEX = "address_index"
+DEFAULT_INDEX_NAME = "Address"
+INDEX_NAME_CACHE_SECONDS = 10  # The active index names are cached per instance
+
+# Version of the search document fields. Increment it, if new fields must be
+# filled by a rebuild before they can be used in queries.
+# 2: "owner" and "visibility"
+# 3: "prefix" (edge n-grams for *suggest_addresses*)
+DOCUMENT_SCHEMA = 3
+
+# Memcache counters for the document writes
+WRITTEN_DOCUMENTS = "address_index:written"
+SKIPPED_DOCUMENTS = "address_index:skipped"
+
+# Cached active index names: (index names, timestamp)
+_index_names_cache = (None, 0)
+
+
+def get_index_mode():
+    """
+    Returns the configured mode: "sync" (default) or "deferred"
+    """
+
+    return cherrypy.config.get("search_index.address.mode") or INDEX_MODE_SYNC
+
+
+def _chunks(items, size):
+    """
+    Splits a list into lists with maximal *size* items
+    """
+
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_index_names(local_cache = True):
+    """
+    Returns the names of the active and the shadow search index::
+
+        {
+            "active": <Name>,
+            "shadow": <Name> | None,
+            "version": <Number>,
+            "schema": <Document schema of the active index>,
+            "shadow_schema": <Document schema of the shadow index>,
+            "epoch": <Incremented, when the index was emptied>
+        }
+
+    :param local_cache: If `False`, the per instance cache of the named
+        values is skipped.
+    """
+
+    index_names = named_values.get_value(name = ADDRESS_INDEX, local_cache = local_cache)
+    if not index_names:
+        index_names = _default_index_names()
+
+    # Own copy; the named value can be shared by the per instance cache
+    index_names = dict(index_names)
+    index_names.setdefault("schema", 1)
+
+    # Finished
+    return index_names
+
+
+def _get_active_index_names():
+    """
+    Returns the index names (cached per instance for some seconds)
+    """
+
+    global _index_names_cache
+
+    index_names, timestamp = _index_names_cache
+    if index_names and time.time() - timestamp < INDEX_NAME_CACHE_SECONDS:
+        return index_names
+
+    index_names = get_index_names()
+    _index_names_cache = (index_names, time.time())
+
+    # Finished
+    return index_names
+
+
+def get_index_name():
+    """
+    Returns the name of the active search index (for reading)
+    """
+
+    return _get_active_index_names()["active"]
+
+
+def get_index_schema():
+    """
+    Returns the document schema of the active search index
+    (see *DOCUMENT_SCHEMA*)
+    """
+
+    return _get_active_index_names()["schema"]
+
+
+def get_index():
+    """
+    Returns the active search index (for reading)
+    """
+
+    return search.Index(name = get_index_name())
+
+
+def get_write_index_names():
+    """
+    Returns the names of all search indexes, which must be written
+    (the active index and, during a rebuild, the shadow index)
+    """
+
+    index_names = get_index_names(local_cache = False)
+    write_index_names = [index_names["active"]]
+    if index_names["shadow"]:
+        write_index_names.append(index_names["shadow"])
+
+    # Finished
+    return write_index_names
+
+
+def _default_index_names():
+    return dict(active = DEFAULT_INDEX_NAME, shadow = None, version = 0)
+
+
+def _update_index_names(function):
+    """
+    Changes the index names in a transaction (read and write)
+
+    :param function: Gets a copy of the current index names and returns
+        the new index names.
+    """
+
+    def _update(index_names):
+        index_names = dict(index_names or _default_index_names())
+        index_names.setdefault("schema", 1)
+        return function(index_names)
+
+    # Finished
+    return named_values.update_value(name = ADDRESS_INDEX, function = _update).value
+
+
+def create_shadow_index():
+    """
+    Creates the name of a new, empty shadow index and registers it for writing.
+
+    :return: Tuple with the new shadow index name and the name of a replaced
+        (unfinished) shadow index
+    """
+
+    replaced = {}
+
+    def _create(index_names):
+        replaced["shadow"] = index_names["shadow"]
+        version = index_names["version"] + 1
+        return dict(
+            active = index_names["active"],
+            shadow = u"{name}_v{version}".format(name = DEFAULT_INDEX_NAME, version = version),
+            version = version,
+            schema = index_names["schema"],
+            shadow_schema = DOCUMENT_SCHEMA,
+            epoch = index_names.get("epoch", 0)
+        )
+
+    index_names = _update_index_names(_create)
+
+    # Finished
+    return index_names["shadow"], replaced["shadow"]
+
+
+def activate_shadow_index(shadow_index_name):
+    """
+    Switches the active search index to the shadow index.
+
+    :return: Name of the previous active index or `None`, if the shadow
+        index was replaced meanwhile
+    """
+
+    global _index_names_cache
+
+    previous = {}
+
+    def _activate(index_names):
+        previous["active"] = None
+        if index_names["shadow"] != shadow_index_name:
+            return index_names
+        previous["active"] = index_names["active"]
+        return dict(
+            active = shadow_index_name,
+            shadow = None,
+            version = index_names["version"],
+            schema = index_names.get("shadow_schema", DOCUMENT_SCHEMA),
+            epoch = index_names.get("epoch", 0)
+        )
+
+    index_names = _update_index_names(_activate)
+    if previous["active"]:
+        _index_names_cache = (dict(index_names), time.time())
+
+    # Finished
+    return previous["active"]
+
+
+def get_fields_hash(fields):
+    """
+    Returns the fingerprint of the search fields of one address
+
+    All indexed fields are part of the fingerprint (also "edit_timestamp"
+    and "edit_user", which are used for sorting and filtering).
+    """
+
+    # The fingerprints change with the active index and after the index
+    # was emptied (see *invalidate_fields_hashes()*)
+    index_names = get_index_names(local_cache = False)
+    parts = [u"{schema}:{language}:{index_name}:{epoch}".format(
+        schema = DOCUMENT_SCHEMA,
+        language = cherrypy.config.get("LANGUAGE"),
+        index_name = index_names["active"],
+        epoch = index_names.get("epoch", 0)
+    )]
+    for field in fields:
+        parts.append(u"{name}\x1f{type}\x1f{value!r}".format(
+            name = field.name,
+            type = field.__class__.__name__,
+            value = field.value
+        ))
+
+    # Finished
+    return hashlib.md5(u"\x1e".join(parts).encode("utf-8")).hexdigest()
+
+
+def invalidate_fields_hashes(index_name):
+    """
+    Invalidates the fingerprints of all addresses (*Address.index_hash*),
+    after the active or the shadow index was emptied. So the next save
+    writes the document again.
+    """
+
+    def _invalidate(index_names):
+        if index_name in (index_names["active"], index_names["shadow"]):
+            index_names["epoch"] = index_names.get("epoch", 0) + 1
+        return index_names
+
+    _update_index_names(_invalidate)
+
+
+def _count_documents(name, quantity):
+    if quantity:
+        memcache.incr(name, delta = quantity, initial_value = 0)
+
+
+def count_skipped_documents(quantity):
+    """
+    Counts the search documents, which were not written (content unchanged)
+    """
+
+    _count_documents(SKIPPED_DOCUMENTS, quantity)
+
+
+def get_document_counts():
+    """
+    Returns the number of written and skipped search documents
+    (since the last memcache flush)::
+
+        {"written": <Number>, "skipped": <Number>}
+    """
+
+    counts = memcache.get_multi([WRITTEN_DOCUMENTS, SKIPPED_DOCUMENTS])
+
+    # Finished
+    return dict(
+        written = int(counts.get(WRITTEN_DOCUMENTS) or 0),
+        skipped = int(counts.get(SKIPPED_DOCUMENTS) or 0)
+    )
+
+
+def put_documents(addresses, index_names = None, documents = None):
+    """
+    Writes the search documents of the addresses in batches
+
+    :param index_names: Names of the search indexes. Default: active and
+        shadow index.
+
+    :param documents: Already built search documents of the addresses
+    """
+
+    if not addresses:
+        return
+
+    if documents is None:
+        documents = [address.get_search_document() for address in addresses]
+    for index_name in (index_names or get_write_index_names()):
+        index = search.Index(name = index_name)
+        for documents_chunk in _chunks(documents, SEARCH_INDEX_BATCH_SIZE):
+            index.put(documents_chunk)
+        _count_documents(WRITTEN_DOCUMENTS, len(documents))
+
+    # Cached search results are invalid now
+    search_cache.bump_generation()
+
+
+def delete_documents(document_ids, index_names = None):
+    """
+    Deletes search documents in batches
+
+    :param index_names: Names of the search indexes. Default: active and
+        shadow index.
+    """
+
+    if not document_ids:
+        return
+
+    for index_name in (index_names or get_write_index_names()):
+        index = search.Index(name = index_name)
+        for document_ids_chunk in _chunks(document_ids, SEARCH_INDEX_BATCH_SIZE):
+            index.delete(document_ids_chunk)
+
+    # Cached search results are invalid now
+    search_cache.bump_generation()
+
+
+def update_documents(addresses, documents = None):
+    """
+    Updates the search documents of the saved addresses.
+
+    Depending on the mode, the documents are written directly or
+    the update is enqueued.
+
+    :param documents: Already built search documents of the addresses
+        (only used in the "sync" mode)
+    """
+
+    if not addresses:
+        return
+
+    if get_index_mode() == INDEX_MODE_DEFERRED:
+        enqueue([address.key for address in addresses])
+    else:
+        put_documents(addresses, documents = documents)
+
+
+def enqueue(address_keys):
+    """
+    Marks the documents of the addresses as pending and starts a task
+    for the current time window.
+    """
+
+    utcnow = datetime.datetime.utcnow()
+
+    # Mark pending documents
+    ndb.put_multi([
+        PendingSearchDocument(id = address_key.urlsafe(), ct = utcnow)
+        for address_key in address_keys
+    ])
+
+    # One task per time window collects all pending documents
+    window = int(time.time() / INDEX_WINDOW_SECONDS)
+    try:
+        deferred.defer(
+            process_pending_documents,
+            _queue = INDEX_QUEUE,
+            _name = "address-index-{window}".format(window = window),
+            _countdown = INDEX_WINDOW_SECONDS
+        )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # The task for this time window is already enqueued
+        pass
+
+
+def _defer_pending_documents(limit, retries = 0, countdown = 0):
+    deferred.defer(
+        process_pending_documents,
+        limit = limit,
+        retries = retries,
+        _queue = INDEX_QUEUE,
+        _countdown = countdown
+    )
+
+
+def process_pending_documents(limit = 1000, retries = 0):
+    """
+    Updates the search index with all pending documents.
+
+    The query for the pending markers is eventually consistent. So the task
+    is enqueued again, while markers remain (or if no marker was found yet).
+
+    This function will started by deferred.
+    """
+
+    start = time.time()
+
+    pending_documents = PendingSearchDocument.query().order(
+        PendingSearchDocument.ct
+    ).fetch(limit)
+    if not pending_documents:
+        # The new markers may not be visible for the query yet
+        if retries < INDEX_PENDING_RETRIES:
+            _defer_pending_documents(limit, retries + 1, INDEX_WINDOW_SECONDS)
+        return
+
+    # Load addresses
+    address_keys = [
+        ndb.Key(urlsafe = pending_document.key.id())
+        for pending_document in pending_documents
+    ]
+    addresses = ndb.get_multi(address_keys)
+
+    # Update documents of existing addresses, remove documents of deleted addresses
+    put_documents([address for address in addresses if address])
+    delete_documents([
+        address_key.urlsafe() for address_key, address in zip(address_keys, addresses)
+        if not address
+    ])
+
+    # Remove pending markers. Markers which are written again meanwhile
+    # are kept, so the newer change will be indexed, too.
+    current_documents = ndb.get_multi([
+        pending_document.key for pending_document in pending_documents
+    ])
+    done_keys = [
+        current_document.key
+        for pending_document, current_document in zip(pending_documents, current_documents)
+        if current_document and current_document.ct == pending_document.ct
+    ]
+    ndb.delete_multi(done_keys)
+
+    # Index lag
+    lag = (datetime.datetime.utcnow() - pending_documents[0].ct).total_seconds()
+    logging.info(
+        u"process_pending_documents: {quantity} documents, "
+        u"index lag {lag:.1f} s, duration {duration:.1f} s".format(
+            quantity = len(pending_documents),
+            lag = lag,
+            duration = time.time() - start
+        )
+    )
+
+    # More pending documents
+    if len(pending_documents) >= limit:
+        _defer_pending_documents(limit)
+    elif len(done_keys) < len(pending_documents):
+        # Markers were written again meanwhile
+        _defer_pending_documents(limit, countdown = INDEX_WINDOW_SECONDS)
+    else:
+        # Markers, which the query did not return yet
+        done_keys = set(done_keys)
+        remaining = [
+            key for key in PendingSearchDocument.query().fetch(limit, keys_only = True)
+            if key not in done_keys
+        ]
+        if remaining:
+            _defer_pending_documents(limit, countdown = INDEX_WINDOW_SECONDS)
+
+
+def get_index_lag():
+    """
+    Returns the age of the oldest pending search document in seconds.
+
+    0 means, that the search index is up to date. The result is cached
+    for *INDEX_LAG_CACHE_SECONDS* (one datastore query).
+    """
+
+    lag = memcache.get(INDEX_LAG)
+    if lag is not None:
+        return lag
+
+    oldest = PendingSearchDocument.query().order(PendingSearchDocument.ct).get()
+    if oldest:
+        lag = (datetime.datetime.utcnow() - oldest.ct).total_seconds()
+    else:
+        lag = 0
+
+    # Cache set
+    memcache.set(INDEX_LAG, lag, time = INDEX_LAG_CACHE_SECONDS)
+
+    # Finished
+    return lag
@@ -2,33 +2,121 @@
 # coding: utf-8
 
 import uuid
+import time
+import collections
 import datetime
 import logging
+import errors
 import authorization
+import counters
 import named_values
+import address_index
+import facet_items
+import address_history
+import search_cache
+import format_
 from google.appengine.ext import ndb
 from google.appengine.api import search
+from google.appengine.api import memcache
 from google.appengine.ext import deferred
 from bunch import Bunch
 from model.address import (
     Address,
     TelItem, EmailItem, UrlItem, NoteItem, JournalItem,
-    AgreementItem, FreeDefinedItem, AnniversaryItem
+    AgreementItem, FreeDefinedItem, AnniversaryItem,
+    PREFIX_FIELD, PREFIX_MAX_LENGTH
 )
 from model.address_history import AddressHistory
 from model.deleted_address import DeletedAddress
-from . business_items import add_business_items_to_cache
-from . category_items import (
-    add_category_items_to_cache,
-    get_category_items_cached
-)
-from . tag_items import (
-    add_tag_items_to_cache,
-    get_tag_items_cached
-)
+from . category_items import get_category_items_cached
+from . tag_items import get_tag_items_cached
 
 ADDRESS_QUANTITY = "address_quantity"
 
+# Address fields which are stored in the "Address" search index
+# (address field name --> search index field name).
+# "eu" is not served from the index: a save which changes only the edit
+# metadata does not rewrite the search document.
+INDEX_STORED_FIELDS = {
+    "cu": u"creation_user",
+    "eu": u"edit_user",
+    "kind": u"kind",
+    "organization": u"organization",
+    "position": u"position",
+    "salutation": u"salutation",
+    "first_name": u"first_name",
+    "last_name": u"last_name",
+    "nickname": u"nickname",
+    "street": u"street",
+    "postcode": u"postcode",
+    "city": u"city",
+    "district": u"district",
+    "land": u"land",
+    "country": u"country",
+    "gender": u"gender",
+    "category_items": u"category",
+    "tag_items": u"tag",
+    "business_items": u"business",
+}
+INDEX_STORED_REPEATED_FIELDS = {"category_items", "tag_items", "business_items"}
+
+# Search index rebuild
+ADDRESS_INDEX_REBUILD = "address_index_rebuild"
+REBUILD_PHASE_DOCUMENTS = "documents"
+REBUILD_PHASE_ORPHANS = "orphans"
+REBUILD_TASK_SECONDS = 60  # Runtime of one rebuild task, before the next is chained
+REBUILD_FAILED_IDS_MAX = 100  # Saved ids of failed documents
+# Old search indexes are emptied after the caches of the index names
+# (per instance named value and index name cache) expired, plus one minute
+# for running requests
+OLD_INDEX_DELETE_COUNTDOWN = (
+    named_values.LOCAL_CACHE_SECONDS + address_index.INDEX_NAME_CACHE_SECONDS + 60
+)
+SCHEMA_REBUILD_LOCK = "address_index:schema_rebuild"
+SCHEMA_REBUILD_LOCK_SECONDS = 3600  # Automatic rebuilds are started at most once per hour
+RECONCILE_BATCH_SIZE = 1000  # Keys per query while counting the addresses
+
+# Bulk editing
+BULK_BATCH_SIZE = 200  # Addresses per get_multi/put_multi
+BULK_CHANGED = "changed"
+BULK_UNCHANGED = "unchanged"
+BULK_NOT_FOUND = "not_found"
+BULK_NOT_AUTHORIZED = "not_authorized"
+
+# Export
+EXPORT_BATCH_SIZE = 500  # Addresses per datastore batch
+EXPORT_MAX_BATCH_SIZE = 1000  # Upper limit for *batch_size*
+
+# Lookup by email address
+EMAIL_LOOKUP_BATCH_SIZE = 100  # Concurrent keys-only queries
+
+# Count modes of the address searches: "exact", "approximate:<n>", "none"
+COUNT_MODE_EXACT = "exact"
+COUNT_MODE_APPROXIMATE = "approximate"
+COUNT_MODE_NONE = "none"
+SEARCH_ADDRESSES_COUNT_MODE = "approximate:100"
+
+# Type-as-you-go search (see *suggest_addresses*)
+SUGGEST_LIMIT = 10
+SUGGEST_RETURNED_FIELDS = ["organization", "first_name", "last_name"]
+
+# Deep pagination with stored page cursors (see *_get_page_cursors*)
+CURSOR_MAP_OFFSET = 200  # From this offset on, pages are fetched with cursors
+CURSOR_MAP_PREFETCH_PAGES = 20  # Pages, which are mapped in the background
+CURSOR_MAP_WALK_SIZE = 1000  # Documents per request while mapping the pages
+
+# Fields compared by *save_address* (edit metadata and index hash are not compared)
+SAVE_COMPARED_FIELDS = (
+    "owner", "private", "kind", "organization", "position", "salutation",
+    "first_name", "last_name", "nickname", "street", "postcode", "city",
+    "district", "land", "country", "gender",
+    "business_items", "category_items", "tag_items",
+)
+SAVE_COMPARED_ITEM_FIELDS = (
+    "phone_items", "email_items", "url_items", "note_items", "journal_items",
+    "agreement_items", "free_defined_items", "anniversary_items",
+)
+
 
 def create(
     user,
@@ -56,7 +144,8 @@ def create(
     free_defined_items = None,
     business_items = None,
     anniversary_items = None,
-    gender = None
+    gender = None,
+    private = None
 ):
     """
     Creates a new Address
@@ -180,6 +269,9 @@ def create(
         n stands for "none or not applicable",
         u stands for "unknown"
 
+    :param private: If `True`, the address is only visible for the owner
+        and for users with the "private_address.read" authorization.
+
     :return: New created and saved Address-Object
 
     :rtype: model.address.Address
@@ -310,6 +402,8 @@ def create(
         gender = gender.lower()
         assert gender in "mfonu"
         address.gender = gender
+    if private is not None:
+        address.private = bool(private)
 
     # Save
     address.put()
@@ -317,17 +411,8 @@ def create(
     # Increment Quantity
     increment_address_quantity_in_cache()
 
-    # Update cached Business-Items
-    if address.business_items:
-        add_business_items_to_cache(address.business_items)
-
-    # Update cached Category-Items
-    if address.category_items:
-        add_category_items_to_cache(address.category_items)
-
-    # Update cached Tag-Items
-    if address.tag_items:
-        add_tag_items_to_cache(address.tag_items)
+    # Update Business-, Category- and Tag-Items
+    facet_items.update_address_facets({}, facet_items.get_address_facets(address))
 
     # Finished
     return address
@@ -523,22 +608,152 @@ def create(
 #     )
 
 
-def get_address(key_urlsafe = None, address_uid = None):
+def get_address(key_urlsafe = None, address_uid = None, user = None):
     """
     Returns one address
+
+    :param user: If given, the read authorization of the user is checked.
     """
 
     assert key_urlsafe or address_uid
 
     if key_urlsafe:
         key = ndb.Key(urlsafe = key_urlsafe)
-        return key.get(deadline = 30)
+        address = key.get(deadline = 30)
     else:
         addresses = Address.query(Address.uid == address_uid).fetch(
             deadline = 30  # seconds
         )
-        if addresses:
-            return addresses[0]
+        address = addresses[0] if addresses else None
+
+    # Check authorization
+    if address and user:
+        authorization.check_address_authorization(user, address, "read")
+
+    # Finished
+    return address
+
+
+def get_addresses_by_keys(keys_urlsafe):
+    """
+    Returns the addresses for the given keys with one batch request
+
+    The order of the keys is kept. Not existing addresses are skipped.
+
+    :param keys_urlsafe: List with urlsafe keys (e.g. search document ids)
+    """
+
+    keys = [ndb.Key(urlsafe = key_urlsafe) for key_urlsafe in keys_urlsafe]
+    futures = ndb.get_multi_async(keys)
+
+    addresses = []
+    for future in futures:
+        address = future.get_result()
+        if address:
+            addresses.append(address)
+
+    # Finished
+    return addresses
+
+
+def get_addresses_by_email(emails, user = None):
+    """
+    Finds the addresses with exactly these email addresses (case insensitive)
+
+    Uses the indexed property *Address.emails*. For every email address one
+    keys-only query is started; the queries of a batch run concurrently.
+
+    :param emails: List with email addresses or one email address
+
+    :param user: If given, only addresses, which the user may read, are returned.
+
+    :return: Dictionary with the email addresses (lower case) and the keys
+        of the found addresses::
+
+            {<email>: [<KeyUrlsafe>, ...], ...}
+    """
+
+    if isinstance(emails, basestring):
+        emails = [emails]
+    emails = sorted(set(email.strip().lower() for email in emails if email and email.strip()))
+
+    # Keys-only queries
+    email_keys = {}
+    for emails_chunk in _chunks(emails, EMAIL_LOOKUP_BATCH_SIZE):
+        futures = [
+            Address.query(Address.emails == email).fetch_async(keys_only = True)
+            for email in emails_chunk
+        ]
+        for email, future in zip(emails_chunk, futures):
+            email_keys[email] = future.get_result()
+
+    # Read authorization (the addresses are only loaded, if the user
+    # may not read all addresses)
+    if user and not authorization.may_read_all_addresses(user):
+        keys = list(set(key for keys in email_keys.values() for key in keys))
+        readable_keys = set(
+            address.key for address in
+            authorization.filter_readable_addresses(user, ndb.get_multi(keys))
+        )
+        for email, keys in email_keys.items():
+            email_keys[email] = [key for key in keys if key in readable_keys]
+
+    # Finished
+    return dict(
+        (email, [key.urlsafe() for key in keys]) for email, keys in email_keys.items()
+    )
+
+
+def _get_save_values(address):
+    """
+    Returns the compared values of the address (before saving)
+    """
+
+    values = {}
+    for fieldname in SAVE_COMPARED_FIELDS + SAVE_COMPARED_ITEM_FIELDS:
+        value = getattr(address, fieldname)
+        if isinstance(value, list):
+            value = list(value)
+        values[fieldname] = value
+    return values
+
+
+def _get_save_changes(old_values, address):
+    """
+    Compares the old values with the edited address
+
+    Empty values (None, "", [], False) are treated as equal.
+
+    :return: Dictionary with the changed field names and the uids of
+        the new, changed and removed items::
+
+            {"fields": [...], "item_uids": [...]}
+    """
+
+    changed_fields = []
+    changed_item_uids = []
+
+    for fieldname in SAVE_COMPARED_FIELDS:
+        if (old_values[fieldname] or None) != (getattr(address, fieldname) or None):
+            changed_fields.append(fieldname)
+
+    for fieldname in SAVE_COMPARED_ITEM_FIELDS:
+        old_items = old_values[fieldname]
+        new_items = getattr(address, fieldname)
+        old_items_by_uid = dict((item.uid, item) for item in old_items)
+        new_uids = set()
+        item_uids = []
+        for item in new_items:
+            new_uids.add(item.uid)
+            if old_items_by_uid.get(item.uid) != item:
+                item_uids.append(item.uid)
+        item_uids.extend(item.uid for item in old_items if item.uid not in new_uids)
+        if item_uids or [item.uid for item in old_items] != [item.uid for item in new_items]:
+            changed_fields.append(fieldname)
+            changed_item_uids.extend(item_uids)
+
+    # Finished
+    return {"fields": changed_fields, "item_uids": changed_item_uids}
 
 
 def save_address(
@@ -570,12 +785,18 @@ def save_address(
     free_defined_items = None,
     business_items = None,
     anniversary_items = None,
-    gender = None
+    gender = None,
+    private = None,
+    return_changed_fields = False
 ):
     """
     Saves one address
 
-    The original address will saved before into the *address_history*-table.
+    The original address will saved before into the *address_history*-table
+    (as delta to the new version, see *common.address_history*).
+
+    If the submitted values are equal to the stored values, nothing is
+    written (no history, no put, no search index update).
 
     :param user: Username
     :param owner: Username of the owner
@@ -697,6 +918,17 @@ def save_address(
         n stands for "none or not applicable",
         u stands for "unknown"
 
+    :param private: If `True`, the address is only visible for the owner
+        and for users with the "private_address.read" authorization.
+
+    :param return_changed_fields: If `True`, a tuple with the address and
+        the changes is returned::
+
+            (<Address>, {"fields": [<field name>, ...], "item_uids": [<uid>, ...]})
+
+        "item_uids" contains the uids of the new, changed and removed items.
+        Empty lists mean: nothing was saved.
+
     :return: Edited Address-Object
 
     :rtype: model.address.Address
@@ -708,26 +940,15 @@ def save_address(
     address = get_address(key_urlsafe = key_urlsafe, address_uid = address_uid)
 
     # Check authorization
-    if address.owner == user:
-        authorization.check_authorization(user, authorization.OWN_ADDRESS_EDIT)
-    else:
-        authorization.check_authorization(user, authorization.PUBLIC_ADDRESS_EDIT)
+    authorization.check_address_authorization(user, address, "edit")
 
-    # Save original address to *address_history*.
-    address_history = AddressHistory(
-        parent = address.key,
-        cu = user,
-        address_dict = address.to_dict()
-    )
-    address_history.put()
+    # Remember the original values
+    old_values = _get_save_values(address)
+    old_facets = facet_items.get_address_facets(address)
 
     # Now
     utcnow = datetime.datetime.utcnow()
 
-    # Change *et* and *eu*
-    address.et = utcnow
-    address.eu = user
-
     # Check arguments and set values
     if owner is not None:
         address.owner = owner
@@ -1009,22 +1230,44 @@ def save_address(
         gender = gender.lower()
         assert gender in "mfonu"
         address.gender = gender
+    if private is not None:
+        address.private = bool(private)
 
-    # save changes
-    address.put()
+    # Nothing changed --> nothing to write
+    changes = _get_save_changes(old_values, address)
+    if not changes["fields"]:
+        if return_changed_fields:
+            return address, changes
+        return address
+
+    # Change *et* and *eu*
+    address.et = utcnow
+    address.eu = user
+
+    # Save changes and the original address to *address_history*
+    # (delta to the new version; one transaction)
+    address_history.put_address(address, user)
+
+    # Update Business-, Category- and Tag-Items
+    facet_items.update_address_facets(old_facets, facet_items.get_address_facets(address))
 
     # Return saved address
+    if return_changed_fields:
+        return address, changes
     return address
 
 
-def delete_all_search_indexes():
+def delete_all_search_indexes(index_name = None):
     """
     Deletes all documents in the "Address" search index
+
+    :param index_name: Name of the search index. Default: active index.
     """
 
     logging.info(u"delete_all_search_indexes: BEGIN")
 
-    index = search.Index("Address")
+    index_name = index_name or address_index.get_index_name()
+    index = search.Index(name = index_name)
     while True:
         document_ids = [
             document.doc_id for document in
@@ -1034,6 +1277,9 @@ def delete_all_search_indexes():
             break
         index.delete(document_ids)
 
+    # The next save of an address must write its document again
+    address_index.invalidate_fields_hashes(index_name)
+
     logging.info(u"delete_all_search_indexes: END")
 
 
@@ -1047,39 +1293,225 @@ def start_delete_all_search_indexes():
 
 def start_refresh_index():
     """
-    Loads every Address and saves it again.
+    Rebuilds the search documents of all addresses (deferred).
+    """
+
+    start_rebuild_index()
+
+
+def start_rebuild_index():
     """
+    Starts a new rebuild of the "Address" search index.
+
+    The documents are written into a new shadow index, while the active
+    index keeps serving all searches. After the rebuild the shadow index
+    becomes the active index and the old index will emptied (delayed by
+    *OLD_INDEX_DELETE_COUNTDOWN* seconds).
+
+    The rebuild runs in a chain of deferred tasks. The progress is saved
+    in the NamedValue "address_index_rebuild", so a task which was
+    interrupted resumes at the last saved cursor.
+    """
+
+    rebuild_id = unicode(uuid.uuid4())
 
-    # Start helper function with deferred
-    deferred.defer(_refresh_index)
+    # New shadow index, which will receive all writes from now on
+    index_name, replaced_index_name = address_index.create_shadow_index()
+    if replaced_index_name:
+        # Clean up the shadow index of an unfinished rebuild
+        deferred.defer(
+            delete_all_search_indexes,
+            index_name = replaced_index_name,
+            _countdown = OLD_INDEX_DELETE_COUNTDOWN
+        )
+
+    named_values.set_value(name = ADDRESS_INDEX_REBUILD, value = dict(
+        rebuild_id = rebuild_id,
+        index_name = index_name,
+        phase = REBUILD_PHASE_DOCUMENTS,
+        cursor = None,
+        start_id = None,
+        documents = 0,
+        deleted_documents = 0,
+        failed_documents = 0,
+        failed_ids = [],
+        seconds = 0.0,
+        started = datetime.datetime.utcnow(),
+        finished = None
+    ))
+
+    deferred.defer(_rebuild_index, rebuild_id = rebuild_id)
+
+    # Finished
+    return rebuild_id
 
 
-def _refresh_index():
+def get_rebuild_index_status():
     """
-    This function will started by defered
+    Returns the progress of the last search index rebuild
     """
 
-    # Delete full search index
-    delete_all_search_indexes()
+    status = named_values.get_value(name = ADDRESS_INDEX_REBUILD)
+    if not status:
+        return None
 
-    # Resave all addresses
-    logging.info(u"refresh_indexes: BEGIN")
+    status = dict(status)
+    if status["seconds"]:
+        status["documents_per_second"] = round(status["documents"] / status["seconds"], 1)
+    else:
+        status["documents_per_second"] = None
 
-    query = Address().query()
-    for address in query.iter(batch_size = 200):
-        address.put()
+    # Finished
+    return status
 
-    logging.info(u"refresh_indexes: END")
+
+def _add_rebuild_error(status, document_id, err):
+    """
+    Logs a failed document of the rebuild and counts it in the status
+    """
+
+    logging.warning(u"rebuild_index: document {document_id}: {err}".format(
+        document_id = document_id, err = err
+    ))
+    status["failed_documents"] = status.get("failed_documents", 0) + 1
+    failed_ids = status.setdefault("failed_ids", [])
+    if len(failed_ids) < REBUILD_FAILED_IDS_MAX:
+        failed_ids.append(document_id)
+
+
+def _rebuild_index(rebuild_id):
+    """
+    One step of the search index rebuild.
+
+    This function will started by deferred. It works until
+    *REBUILD_TASK_SECONDS* are reached and chains the next step.
+    """
+
+    status = named_values.get_value(name = ADDRESS_INDEX_REBUILD, local_cache = False)
+    if not status or status["rebuild_id"] != rebuild_id or status["finished"]:
+        # Replaced by a newer rebuild or already finished
+        return
+
+    task_start = time.time()
+    index_name = status["index_name"]
+    index = search.Index(name = index_name)
+
+    while time.time() - task_start < REBUILD_TASK_SECONDS:
+        batch_start = time.time()
+
+        if status["phase"] == REBUILD_PHASE_DOCUMENTS:
+            # Write the documents of the next addresses
+            # (without saving the addresses again)
+            if status["cursor"]:
+                cursor = ndb.Cursor(urlsafe = status["cursor"])
+            else:
+                cursor = ndb.Cursor()
+            addresses, next_cursor, more = Address.query().fetch_page(
+                page_size = address_index.SEARCH_INDEX_BATCH_SIZE,
+                start_cursor = cursor
+            )
+
+            # Failed documents are logged and counted; the rebuild goes on
+            failed_documents = status.get("failed_documents", 0)
+            documents = []
+            for address in addresses:
+                try:
+                    documents.append(address.get_search_document())
+                except Exception as err:
+                    _add_rebuild_error(status, address.key.urlsafe(), err)
+            try:
+                address_index.put_documents(
+                    addresses, index_names = [index_name], documents = documents
+                )
+            except search.PutError as err:
+                for result in err.results:
+                    if result.code != search.OperationResult.OK:
+                        _add_rebuild_error(status, result.id, result.message)
+            except search.Error as err:
+                for document in documents:
+                    _add_rebuild_error(status, document.doc_id, err)
+
+            status["documents"] += (
+                len(addresses) - (status.get("failed_documents", 0) - failed_documents)
+            )
+            if more and next_cursor:
+                status["cursor"] = next_cursor.urlsafe()
+            else:
+                status["phase"] = REBUILD_PHASE_ORPHANS
+
+        else:
+            # Delete documents of not existing addresses
+            documents = index.get_range(
+                start_id = status["start_id"],
+                include_start_object = False,
+                limit = address_index.SEARCH_INDEX_BATCH_SIZE,
+                ids_only = True
+            )
+            document_ids = [document.doc_id for document in documents]
+            if document_ids:
+                addresses = ndb.get_multi(
+                    [ndb.Key(urlsafe = document_id) for document_id in document_ids]
+                )
+                orphan_ids = [
+                    document_id for document_id, address in zip(document_ids, addresses)
+                    if not address
+                ]
+                if orphan_ids:
+                    try:
+                        index.delete(orphan_ids)
+                    except search.Error as err:
+                        for document_id in orphan_ids:
+                            _add_rebuild_error(status, document_id, err)
+                        orphan_ids = []
+                status["deleted_documents"] += len(orphan_ids)
+                status["start_id"] = document_ids[-1]
+            else:
+                status["finished"] = datetime.datetime.utcnow()
+
+        # Checkpoint
+        status["seconds"] += time.time() - batch_start
+        named_values.set_value(name = ADDRESS_INDEX_REBUILD, value = status)
+
+        if status["finished"]:
+            break
+
+    # Throughput
+    if status["seconds"]:
+        logging.info(
+            u"rebuild_index: {documents} documents, {documents_per_second:.1f} documents/s".format(
+                documents = status["documents"],
+                documents_per_second = status["documents"] / status["seconds"]
+            )
+        )
+
+    # Next step
+    if not status["finished"]:
+        deferred.defer(_rebuild_index, rebuild_id = rebuild_id)
+        return
+
+    # Switch to the new index and empty the old one
+    previous_index_name = address_index.activate_shadow_index(index_name)
+    if previous_index_name:
+        # Not before all instances read from the new index
+        deferred.defer(
+            delete_all_search_indexes,
+            index_name = previous_index_name,
+            _countdown = OLD_INDEX_DELETE_COUNTDOWN
+        )
+
+    logging.info(u"rebuild_index: END")
 
 
 def search_addresses(
     query_string,
     page,
     page_size = 20,
-    returned_fields = None
+    returned_fields = None,
+    user = None,
+    count_mode = SEARCH_ADDRESSES_COUNT_MODE
 ):
     """
-    Searches for addresses in the "Address" index
+    Searches for addresses in the active "Address" index
 
     :param query_string: Search string
 
@@ -1114,10 +1546,16 @@ def search_addresses(
         - journal
         - agreement
         - anniversary
+
+    :param user: If given, only addresses, which the user may read, are found.
+
+    :param count_mode: "exact", "approximate:<n>" (default: "approximate:100")
+        or "none". See *get_number_found_accuracy()*.
     """
 
-    index = search.Index("Address")
+    index = address_index.get_index()
     offset = (page - 1) * page_size
+    number_found_accuracy = get_number_found_accuracy(count_mode or SEARCH_ADDRESSES_COUNT_MODE)
 
     if not returned_fields:
         returned_fields = [
@@ -1128,11 +1566,13 @@ def search_addresses(
 
     query_options = search.QueryOptions(
         limit = page_size,
+        number_found_accuracy = number_found_accuracy,
         offset = offset,
         returned_fields = returned_fields
     )
 
-    # Search
+    # Search (only readable addresses)
+    query_string = _add_read_clause(user, query_string or u"")
     query = search.Query(query_string = query_string, options = query_options)
     result = index.search(query)
 
@@ -1140,6 +1580,78 @@ def search_addresses(
     return result
 
 
+def _get_display_name(address_dict):
+    """
+    Returns "<first name> <last name>", the organization or both
+    """
+
+    name = u" ".join(
+        value for value in (address_dict.get("first_name"), address_dict.get("last_name")) if value
+    )
+    organization = address_dict.get("organization")
+    if name and organization:
+        return u"{name} ({organization})".format(name = name, organization = organization)
+
+    # Finished
+    return name or organization or u""
+
+
+def suggest_addresses(prefix, limit = SUGGEST_LIMIT, user = None):
+    """
+    Type-as-you-go search: Returns the addresses, whose first name, last name,
+    nickname, organization or city begin with the words of *prefix*
+
+    Uses the "prefix" field of the search index (edge n-grams, also without
+    umlauts). Only ids and the display names are read from the index.
+
+    :param prefix: Beginning of one or more words, e.g. "max mü"
+    :param limit: Maximum quantity of addresses
+    :param user: If given, only addresses, which the user may read, are found.
+
+    :return: [{"key_urlsafe": <KeyUrlsafe>, "display_name": <Name>}, ...]
+    """
+
+    words = format_.split_words(prefix)
+    if not words:
+        return []
+
+    index = address_index.get_index()
+    if address_index.get_index_schema() >= 3:
+        query_string = u" ".join(
+            u"{field}:{token}".format(field = PREFIX_FIELD, token = word[:PREFIX_MAX_LENGTH])
+            for word in words
+        )
+    else:
+        # Index without prefix tokens (not rebuilt yet): whole words only
+        query_string = u" ".join(words)
+    query_string = _add_read_clause(user, query_string)
+    limit = limit or SUGGEST_LIMIT
+
+    # Cached result
+    signature = search_cache.get_signature("suggest", index.name, query_string, limit)
+    suggestions, generation = search_cache.get_result(signature)
+    if suggestions is not None:
+        return suggestions
+
+    # Search
+    query_options = search.QueryOptions(
+        limit = limit,
+        returned_fields = _get_index_field_names(SUGGEST_RETURNED_FIELDS)
+    )
+    search_result = index.search(search.Query(query_string = query_string, options = query_options))
+    suggestions = []
+    for document in search_result.results:
+        address_dict = document_to_address_dict(document, SUGGEST_RETURNED_FIELDS)
+        suggestions.append({
+            "key_urlsafe": document.doc_id,
+            "display_name": _get_display_name(address_dict)
+        })
+    search_cache.set_result(signature, generation, suggestions)
+
+    # Finished
+    return suggestions
+
+
 def delete_address(user, key_urlsafe = None, address_uid = None, force = False):
     """
     Deletes one address
@@ -1152,16 +1664,17 @@ def delete_address(user, key_urlsafe = None, address_uid = None, force = False):
 
     assert key_urlsafe or address_uid
 
-    if force and key_urlsafe:
-        address = None
+    # Load address
+    address = get_address(
+        key_urlsafe = key_urlsafe,
+        address_uid = address_uid
+    )
+    if address:
+        key = address.key
+    elif force and key_urlsafe:
         key = ndb.Key(urlsafe = key_urlsafe)
     else:
-        # Load address
-        address = get_address(
-            key_urlsafe = key_urlsafe,
-            address_uid = address_uid
-        )
-        key = address.key
+        return
 
     key_urlsafe = key_urlsafe or key.urlsafe()
 
@@ -1183,11 +1696,12 @@ def delete_address(user, key_urlsafe = None, address_uid = None, force = False):
     key.delete()
 
     # Remove address from search index
-    index = search.Index(name = "Address")
-    index.delete([key_urlsafe])
+    address_index.delete_documents([key_urlsafe])
 
-    # Decrement Quantity
-    decrement_address_quantity_in_cache()
+    # Decrement Quantity and update Business-, Category- and Tag-Items
+    if address:
+        decrement_address_quantity_in_cache()
+        facet_items.update_address_facets(facet_items.get_address_facets(address), {})
 
 
 def delete_all_addresses(yes_do_it = False):
@@ -1227,6 +1741,66 @@ def start_delete_all_addresses(yes_do_it = False):
     deferred.defer(delete_all_addresses, yes_do_it = yes_do_it)
 
 
+def start_update_computed_properties():
+    """
+    Saves all addresses again, so that the computed properties
+    (e.g. *emails*, *birthday*) of older addresses are written (deferred)
+    """
+
+    deferred.defer(_update_computed_properties)
+
+
+@ndb.transactional_tasklet
+def _rewrite_address_async(address_key):
+    """
+    Loads and writes one address in a transaction, so that a concurrent
+    edit is not overwritten with an old version
+    """
+
+    address = yield address_key.get_async()
+    if address:
+        yield address.put_async()
+
+
+def _update_computed_properties(cursor = None, quantity = 0):
+    """
+    Writes the addresses in batches without changing them.
+
+    Every address is written in its own transaction (in parallel).
+    The search index is not touched (*put_async* does not call
+    *Address.put*). This function will started by deferred and chains itself.
+    """
+
+    task_start = time.time()
+    cursor = ndb.Cursor(urlsafe = cursor) if cursor else ndb.Cursor()
+
+    while time.time() - task_start < REBUILD_TASK_SECONDS:
+        address_keys, next_cursor, more = Address.query().fetch_page(
+            page_size = BULK_BATCH_SIZE,
+            start_cursor = cursor,
+            keys_only = True
+        )
+        futures = [_rewrite_address_async(address_key) for address_key in address_keys]
+        for future in futures:
+            future.get_result()
+        quantity += len(address_keys)
+
+        if not (more and next_cursor):
+            logging.info(u"update_computed_properties: {quantity} addresses".format(
+                quantity = quantity
+            ))
+            return
+
+        cursor = next_cursor
+
+    # Next step
+    deferred.defer(
+        _update_computed_properties,
+        cursor = cursor.urlsafe(),
+        quantity = quantity
+    )
+
+
 def get_address_quantity_direct():
     """
     Returns the quantity of undeleted addresses in the database.
@@ -1238,19 +1812,19 @@ def get_address_quantity_direct():
 
 def get_address_quantity_cached():
     """
-    Returns all used category items as set.
+    Returns the quantity of undeleted addresses from the sharded counter.
     """
 
-    # Cache get
-    address_quantity = named_values.get_value(name = ADDRESS_QUANTITY)
+    # Counter get (memcache or shards)
+    address_quantity = counters.get_count(ADDRESS_QUANTITY)
     if address_quantity is not None:
         return address_quantity
 
-    # Fetch quantity direct from the Address model
-    address_quantity = get_address_quantity_direct()
-
-    # Cache set
-    named_values.set_value(name = ADDRESS_QUANTITY, value = address_quantity)
+    # Initialize the counter with the old NamedValue or directly from the Address model
+    address_quantity = named_values.get_value(name = ADDRESS_QUANTITY)
+    if address_quantity is None:
+        address_quantity = get_address_quantity_direct()
+    counters.correct(ADDRESS_QUANTITY, address_quantity)
 
     # Finished
     return address_quantity
@@ -1258,97 +1832,297 @@ def get_address_quantity_cached():
 
 def update_address_quantity_cache():
     """
-    Updates the "address_quantity" NamedValue entity
+    Starts the reconciliation of the sharded address counter (deferred)
+    """
+
+    deferred.defer(_reconcile_address_quantity)
+
+
+def _reconcile_address_quantity(cursor = None, quantity = 0):
     """
+    Counts the addresses (keys only, in chunks) and corrects the sharded
+    address counter.
+
+    This function will started by deferred. Addresses which are created or
+    deleted while counting can cause a small difference, which will
+    corrected with the next run.
+    """
+
+    task_start = time.time()
+    cursor = ndb.Cursor(urlsafe = cursor) if cursor else ndb.Cursor()
+
+    while time.time() - task_start < REBUILD_TASK_SECONDS:
+        address_keys, next_cursor, more = Address.query().fetch_page(
+            page_size = RECONCILE_BATCH_SIZE,
+            start_cursor = cursor,
+            keys_only = True
+        )
+        quantity += len(address_keys)
+
+        if not (more and next_cursor):
+            delta = counters.correct(ADDRESS_QUANTITY, quantity)
+            logging.info(
+                u"reconcile_address_quantity: {quantity} addresses, "
+                u"corrected by {delta}".format(quantity = quantity, delta = delta)
+            )
+            return
 
-    # Cache set
-    named_values.set_value(name = ADDRESS_QUANTITY, value = get_address_quantity_direct())
+        cursor = next_cursor
+
+    # Next step
+    deferred.defer(
+        _reconcile_address_quantity,
+        cursor = cursor.urlsafe(),
+        quantity = quantity
+    )
 
 
 def increment_address_quantity_in_cache():
     """
-    Increments address quantity in the cache
+    Increments address quantity in the sharded counter
     """
 
-    named_values.increment(name = ADDRESS_QUANTITY)
+    counters.increment(ADDRESS_QUANTITY)
 
 
 def decrement_address_quantity_in_cache():
     """
-    Decrements address quantity in the cache
+    Decrements address quantity in the sharded counter
     """
 
-    named_values.decrement(name = ADDRESS_QUANTITY)
+    counters.decrement(ADDRESS_QUANTITY)
 
 
 def update_address_search_index():
     """
     Updates all documents in the "Address" search index
+
+    Starts the deferred rebuild (see *start_rebuild_index()*).
     """
 
-    index = search.Index("Address")
-    address_keys = set()
+    return start_rebuild_index()
 
-    # # Iterate over all addresses
-    # #for address in Address.query().iter(batch_size = 50):
-    # for address in Address.query():
-    #
-    #     # Append key
-    #     address_keys.add(address.key.urlsafe())
-    #
-    #     # Update search index for the address
-    #     address.update_search_index()
 
+def get_number_found_accuracy(count_mode):
+    """
+    Returns the *number_found_accuracy* of the search query
 
-    def _update_index(cursor = None):
+    :param count_mode: "exact" (default), "approximate:<n>" (accurate up to
+        <n> addresses) or "none" (no total quantity)
 
-        if not cursor:
-            cursor = ndb.Cursor()
-        addresses, next_cursor, more = Address.query().fetch_page(
-            page_size = 100, start_cursor = cursor
+    :return: Accuracy or `None`, if no total quantity is needed
+    """
+
+    count_mode = (count_mode or COUNT_MODE_EXACT).strip().lower()
+    if count_mode == COUNT_MODE_EXACT:
+        return search.MAXIMUM_NUMBER_FOUND_ACCURACY
+    if count_mode == COUNT_MODE_NONE:
+        return None
+
+    mode, _, accuracy = count_mode.partition(":")
+    if mode == COUNT_MODE_APPROXIMATE and accuracy.strip().isdigit() and int(accuracy) > 0:
+        return min(int(accuracy), search.MAXIMUM_NUMBER_FOUND_ACCURACY)
+
+    raise search.QueryError(u"Invalid count mode: {count_mode}".format(count_mode = count_mode))
+
+
+def _get_total(search_result, number_found_accuracy):
+    """
+    Returns the total quantity and if it is exact
+
+    :return: (<total quantity> | None, <exact>)
+    """
+
+    if number_found_accuracy is None:
+        return None, False
+
+    # Finished
+    return search_result.number_found, search_result.number_found <= number_found_accuracy
+
+
+def start_schema_rebuild():
+    """
+    Starts the rebuild of the search index once, if the active index has an
+    older document schema (see *address_index.DOCUMENT_SCHEMA*)
+
+    Called by the warmup request of new instances, so that searches
+    have no side effects.
+    """
+
+    if address_index.get_index_schema() >= address_index.DOCUMENT_SCHEMA:
+        return
+    if not memcache.add(SCHEMA_REBUILD_LOCK, True, time = SCHEMA_REBUILD_LOCK_SECONDS):
+        return
+
+    # Already running?
+    index_names = address_index.get_index_names(local_cache = False)
+    if index_names["schema"] >= address_index.DOCUMENT_SCHEMA:
+        return
+    if index_names["shadow"] and index_names.get("shadow_schema", 1) >= address_index.DOCUMENT_SCHEMA:
+        return
+
+    logging.info(u"Search index schema {schema} is outdated; rebuild started".format(
+        schema = index_names["schema"]
+    ))
+    start_rebuild_index()
+
+
+def _add_read_clause(user, query_string):
+    """
+    Restricts the search query to the addresses, the user may read
+
+    The search index must contain the fields "owner" and "visibility"
+    (document schema 2). An outdated index is rebuilt after the deployment
+    (see *start_schema_rebuild()*); until then, users, who may not read all
+    addresses, get a `search.QueryError`.
+    """
+
+    if not user:
+        return query_string
+
+    read_clause = authorization.get_read_query_clause(user)
+    if not read_clause:
+        return query_string
+    if address_index.get_index_schema() < 2:
+        raise search.QueryError(
+            u"The search index is being rebuilt. Please try again later."
         )
-        if not addresses:
-            return
+    if not query_string:
+        return read_clause
 
-        for address in addresses:
-            try:
-                # Update search index for the address
-                address.update_search_index()
-            except Exception as err:
-                logging.error(unicode(err))
-                logging.error(u"Address-Key:", address.key.urlsafe())
-            # Append key
-            address_keys.add(address.key.urlsafe())
+    # Finished
+    return u"({query_string}) AND {read_clause}".format(
+        query_string = query_string,
+        read_clause = read_clause
+    )
 
-        return _update_index(next_cursor)
 
+def _get_sort_options(order_by):
+    """
+    Returns the SortOptions for a list with field names ("-" = descending)
+    """
+
+    if order_by and isinstance(order_by, basestring):
+        order_by = [order_by]
+    if not order_by:
+        return None
+
+    sort_expressions = []
+    for order_item in order_by:
+        # Parse
+        field_name = order_item.lstrip("-").lower()
+        if order_item.startswith("-"):
+            direction = search.SortExpression.DESCENDING
+        else:
+            direction = search.SortExpression.ASCENDING
 
-    _update_index()
+        sort_expressions.append(
+            search.SortExpression(
+                expression = field_name,
+                direction = direction
+            )
+        )
 
+    # Finished
+    return search.SortOptions(
+        expressions = sort_expressions,
+        limit = search.MAXIMUM_SORTED_DOCUMENTS
+    )
 
-    # Fetch all document ids
-    document_ids = set()
-    start_id = None
-    while True:
 
-        fetched_document_ids = index.get_range(
-            start_id = start_id,
-            include_start_object = False,
-            limit = 200,
+def _get_page_cursors(index, query_string, order_by, page_size, page):
+    """
+    Returns the cursor map of a query, which contains the page
+
+    The cursor map ``{<page>: <web safe cursor string>, ...}`` holds the
+    cursor to the beginning of each known page. It is cached in memcache per
+    query and index generation (see *search_cache*). Missing pages are mapped
+    from the nearest known page with *per_result* cursors (ids only,
+    up to *CURSOR_MAP_WALK_SIZE* documents per request).
+
+    A page, which is behind the end of the result, is not in the map.
+
+    :return: (<cursor map>, <signature of the cursor map>)
+    """
+
+    signature = search_cache.get_signature(
+        "page_cursors", index.name, query_string, order_by, page_size
+    )
+    page_cursors, generation = search_cache.get_result(signature)
+    page_cursors = page_cursors or {}
+    if page == 1 or page in page_cursors:
+        return page_cursors, signature
+
+    # Nearest known page
+    known_pages = [known_page for known_page in page_cursors if known_page < page]
+    current_page = max(known_pages) if known_pages else 1
+    sort_options = _get_sort_options(order_by)
+    pages_per_request = max(CURSOR_MAP_WALK_SIZE // page_size, 1)
+
+    while current_page < page:
+        steps = min(page - current_page, pages_per_request)
+        query_options = search.QueryOptions(
+            limit = steps * page_size,
+            cursor = search.Cursor(
+                web_safe_string = page_cursors.get(current_page),
+                per_result = True
+            ),
+            sort_options = sort_options,
             ids_only = True
         )
-        if not fetched_document_ids:
+        results = index.search(
+            search.Query(query_string = query_string, options = query_options)
+        ).results
+
+        for step in xrange(1, steps + 1):
+            position = step * page_size - 1
+            if position >= len(results):
+                break
+            page_cursors[current_page + step] = results[position].cursor.web_safe_string
+        if len(results) < steps * page_size:
             break
+        current_page += steps
 
-        for document in fetched_document_ids:
-            document_ids.add(document.doc_id)
+    search_cache.set_result(signature, generation, page_cursors)
 
-        start_id = fetched_document_ids[-1].doc_id
+    # Finished
+    return page_cursors, signature
 
-    # Delete search indexes for not existing addresses
-    for document_id in document_ids:
-        if document_id not in address_keys:
-            index.delete(document_id)
+
+def _prefetch_page_cursors(index_name, query_string, order_by, page_size, page):
+    """
+    Maps the page cursors up to *page* (started by deferred)
+    """
+
+    _get_page_cursors(search.Index(name = index_name), query_string, order_by, page_size, page)
+
+
+def _start_prefetch_page_cursors(index, query_string, order_by, page_size, page, page_cursors, signature):
+    """
+    Starts the mapping of the next pages in the background, if they are
+    not mapped yet
+    """
+
+    prefetch_page = page + CURSOR_MAP_PREFETCH_PAGES
+    if max(page_cursors) >= prefetch_page:
+        return
+
+    # Only one task per query and page
+    lock_key = u"page_cursors_prefetch:{signature}:{page}".format(
+        signature = signature,
+        page = prefetch_page
+    )
+    if not memcache.add(lock_key, 1, time = 60):
+        return
+
+    deferred.defer(
+        _prefetch_page_cursors,
+        index_name = index.name,
+        query_string = query_string,
+        order_by = order_by,
+        page_size = page_size,
+        page = prefetch_page
+    )
 
 
 def get_addresses_by_search(
@@ -1372,14 +2146,18 @@ def get_addresses_by_search(
     filter_by_city_char1 = None,
     filter_by_business_items = None,
     filter_by_category_items = None,
-    filter_by_tag_items = None
+    filter_by_tag_items = None,
+    returned_fields = None,
+    user = None,
+    count_mode = None
 ):
     """
     :return: Dictionary with total quantity and one page with 
         real addresses::
 
             {
-                "total_quantity": <Quantity>,
+                "total_quantity": <Quantity> | None,
+                "total_exact": True | False,
                 "addresses": [<Address>, ...]
             }
             
@@ -1404,46 +2182,38 @@ def get_addresses_by_search(
         - email
         - url
         - immoads_makler_id
+
+    :param returned_fields: Optional list with address field names, which
+        are stored in the search index (see *INDEX_STORED_FIELDS*).
+        If given, the addresses are not loaded from the datastore. The
+        result contains dictionaries, built directly from the search
+        documents, under the key "address_dicts".
+
+    :param user: If given, only addresses, which the user may read, are
+        returned (query clause with the index fields "owner" and "visibility").
+
+    :param count_mode: "exact" (default), "approximate:<n>" or "none".
+        See *get_number_found_accuracy()*.
         
     """
 
-    index = search.Index("Address")
+    index = address_index.get_index()
     offset = (page - 1) * page_size
+    number_found_accuracy = get_number_found_accuracy(count_mode)
 
     # Sorting
     if order_by and isinstance(order_by, basestring):
         order_by = [order_by]
-    if order_by:
-        sort_expressions = []
-        for order_item in order_by:
-            # Parse
-            field_name = order_item.lstrip("-").lower()
-            if order_item.startswith("-"):
-                direction = search.SortExpression.DESCENDING
-            else:
-                direction = search.SortExpression.ASCENDING
-
-            sort_expressions.append(
-                search.SortExpression(
-                    expression = field_name,
-                    direction = direction
-                )
-            )
-        sort_options = search.SortOptions(
-            expressions = sort_expressions,
-            limit = search.MAXIMUM_SORTED_DOCUMENTS
-        )
-    else:
-        sort_options = None
+    sort_options = _get_sort_options(order_by)
 
     # Query Options
     query_options = search.QueryOptions(
         limit = page_size,
-        number_found_accuracy = search.MAXIMUM_NUMBER_FOUND_ACCURACY,
-        # number_found_accuracy = 10,
+        number_found_accuracy = number_found_accuracy,
         offset = offset,
         sort_options = sort_options,
-        ids_only = True
+        ids_only = not returned_fields,
+        returned_fields = _get_index_field_names(returned_fields)
     )
 
     # Query String
@@ -1481,41 +2251,168 @@ def get_addresses_by_search(
     if filter_by_business_items:
         if isinstance(filter_by_business_items, basestring):
             filter_by_business_items = [filter_by_business_items]
-        for business_item in filter_by_business_items:
+        for business_item in sorted(filter_by_business_items):
             query_string += u' business:"%s"' % business_item
     if filter_by_category_items:
         if isinstance(filter_by_category_items, basestring):
             filter_by_category_items = [filter_by_category_items]
-        for category_item in filter_by_category_items:
+        for category_item in sorted(filter_by_category_items):
             query_string += u' category:"%s"' % category_item
     if filter_by_tag_items:
         if isinstance(filter_by_tag_items, basestring):
             filter_by_tag_items = [filter_by_tag_items]
-        for tag_item in filter_by_tag_items:
+        for tag_item in sorted(filter_by_tag_items):
             query_string += u' tag:"%s"' % tag_item
 
-    query_string = query_string.lstrip()
+    query_string = _add_read_clause(user, u" ".join(query_string.split()))
 
-    # Search
-    query = search.Query(query_string = query_string, options = query_options)
-    search_result = index.search(query)
+    # Cached result
+    signature = search_cache.get_signature(
+        "page", index.name, query_string, order_by, offset, page_size, returned_fields,
+        number_found_accuracy
+    )
+    cached_result, generation = search_cache.get_result(signature)
+
+    if cached_result is None:
+        # Deep pages: start at the stored cursor of the page instead of a
+        # large offset (slow and limited to 1000)
+        behind_end = False
+        if offset >= CURSOR_MAP_OFFSET:
+            page_cursors, page_cursors_signature = _get_page_cursors(
+                index, query_string, order_by, page_size, page
+            )
+            behind_end = page not in page_cursors
+            query_options = search.QueryOptions(
+                limit = 1 if behind_end else page_size,
+                number_found_accuracy = number_found_accuracy,
+                cursor = None if behind_end else search.Cursor(
+                    web_safe_string = page_cursors[page]
+                ),
+                sort_options = sort_options,
+                ids_only = not returned_fields,
+                returned_fields = _get_index_field_names(returned_fields)
+            )
+            if not behind_end:
+                _start_prefetch_page_cursors(
+                    index, query_string, order_by, page_size, page,
+                    page_cursors, page_cursors_signature
+                )
+
+        # Search
+        query = search.Query(query_string = query_string, options = query_options)
+        search_result = index.search(query)
+        total_quantity, total_exact = _get_total(search_result, number_found_accuracy)
+        documents = [] if behind_end else search_result.results
+        cached_result = {
+            "total_quantity": total_quantity,
+            "total_exact": total_exact,
+            "doc_ids": [document.doc_id for document in documents]
+        }
+        if returned_fields:
+            cached_result["address_dicts"] = [
+                document_to_address_dict(document, returned_fields)
+                for document in documents
+            ]
+        search_cache.set_result(signature, generation, cached_result)
+
+    # Address dictionaries built directly from the search documents
+    if returned_fields:
+        return {
+            "total_quantity": cached_result["total_quantity"],
+            "total_exact": cached_result["total_exact"],
+            "address_dicts": cached_result["address_dicts"]
+        }
 
     # Fetch addresses
-    addresses = []
-    for document in search_result.results:
-        key_urlsafe = document.doc_id
-        key = ndb.Key(urlsafe = key_urlsafe)
-        address = key.get()
-        if address:
-            addresses.append(address)
+    addresses = get_addresses_by_keys(cached_result["doc_ids"])
 
     # Finished
     return {
-        "total_quantity": search_result.number_found,
+        "total_quantity": cached_result["total_quantity"],
+        "total_exact": cached_result["total_exact"],
         "addresses": addresses
     }
 
 
+def get_index_returned_fields(
+    include = None,
+    exclude = None,
+    exclude_creation_metadata = None,
+    exclude_edit_metadata = None
+):
+    """
+    Returns the address field names, which can be served directly from
+    the "Address" search index.
+
+    Returns `None` if no fields are requested (*include*; all fields) or
+    if at least one of the requested fields is not stored in the search
+    index. Then the addresses must be loaded from the datastore.
+
+    :param include: List of address field names
+    """
+
+    if not include:
+        # All fields --> not only the fields of the search index
+        return None
+
+    if isinstance(include, basestring):
+        include = [include]
+    fieldnames = [fieldname for fieldname in include if fieldname != "key_urlsafe"]
+    for fieldname in fieldnames:
+        if fieldname not in INDEX_STORED_FIELDS:
+            return None
+
+    exclude = set(exclude or [])
+    if exclude_creation_metadata:
+        exclude.update(["ct", "cu"])
+    if exclude_edit_metadata:
+        exclude.update(["et", "eu"])
+
+    fieldnames = [fieldname for fieldname in fieldnames if fieldname not in exclude]
+
+    # Finished
+    return fieldnames or None
+
+
+def _get_index_field_names(returned_fields):
+    """
+    Maps address field names to search index field names
+    """
+
+    if not returned_fields:
+        return None
+
+    return [INDEX_STORED_FIELDS[fieldname] for fieldname in returned_fields]
+
+
+def document_to_address_dict(document, returned_fields):
+    """
+    Returns an address dictionary, built from a search document
+
+    :param document: Search document, queried with the *returned_fields*
+    :param returned_fields: List with address field names
+    """
+
+    # Collect field values. The first value is the original value,
+    # further values of text fields are the variants without umlauts.
+    index_values = {}
+    for field in document.fields:
+        index_values.setdefault(field.name, []).append(field.value)
+
+    address_dict = {}
+    for fieldname in returned_fields:
+        values = index_values.get(INDEX_STORED_FIELDS[fieldname], [])
+        if fieldname in INDEX_STORED_REPEATED_FIELDS:
+            value = values
+        else:
+            value = values[0] if values else None
+        address_dict[fieldname] = value
+    address_dict["key_urlsafe"] = document.doc_id
+
+    # Finished
+    return address_dict
+
+
 def get_search_index_fieldnames():
     """
     Returns the schema of the "Address" search index.
@@ -1527,7 +2424,7 @@ def get_search_index_fieldnames():
 
     response = search.get_indexes(
         limit = 1,
-        start_index_name = "Address",
+        start_index_name = address_index.get_index_name(),
         include_start_index = True,
         fetch_schema = True
     )
@@ -1561,22 +2458,39 @@ def get_addresses_for_iteration(
     filter_by_city_char1 = None,
     filter_by_business_items = None,
     filter_by_category_items = None,
-    filter_by_tag_items = None
+    filter_by_tag_items = None,
+    returned_fields = None,
+    user = None,
+    count_mode = None
 ):
     """
     :param cursor: Search-Cursor for iteration over the full result
 
+    :param returned_fields: Optional list with address field names, which
+        are stored in the search index (see *INDEX_STORED_FIELDS*).
+        If given, the addresses are not loaded from the datastore. The
+        result contains dictionaries, built directly from the search
+        documents, under the key "address_dicts".
+
+    :param user: If given, only addresses, which the user may read, are
+        returned (query clause with the index fields "owner" and "visibility").
+
+    :param count_mode: "exact" (default), "approximate:<n>" or "none".
+        See *get_number_found_accuracy()*.
+
     :return: Dictionary with total quantity, cursor and one page with
         real addresses::
 
             {
-                "total_quantity": <Quantity>,
+                "total_quantity": <Quantity> | None,
+                "total_exact": True | False,
                 "next_cursor": <Cursor>,
                 "addresses": [<Address>, ...]
             }
     """
 
-    index = search.Index("Address")
+    index = address_index.get_index()
+    number_found_accuracy = get_number_found_accuracy(count_mode)
     if cursor:
         if isinstance(cursor, basestring):
             cursor = search.Cursor(web_safe_string = cursor or None)
@@ -1586,36 +2500,16 @@ def get_addresses_for_iteration(
     # Sorting
     if order_by and isinstance(order_by, basestring):
         order_by = [order_by]
-    if order_by:
-        sort_expressions = []
-        for order_item in order_by:
-            # Parse
-            field_name = order_item.lstrip("-").lower()
-            if order_item.startswith("-"):
-                direction = search.SortExpression.DESCENDING
-            else:
-                direction = search.SortExpression.ASCENDING
-
-            sort_expressions.append(
-                search.SortExpression(
-                    expression = field_name,
-                    direction = direction
-                )
-            )
-        sort_options = search.SortOptions(
-            expressions = sort_expressions,
-            limit = search.MAXIMUM_SORTED_DOCUMENTS
-        )
-    else:
-        sort_options = None
+    sort_options = _get_sort_options(order_by)
 
     # Query Options
     query_options = search.QueryOptions(
         limit = limit,
-        number_found_accuracy = search.MAXIMUM_NUMBER_FOUND_ACCURACY,
+        number_found_accuracy = number_found_accuracy,
         cursor = cursor,
         sort_options = sort_options,
-        ids_only = True
+        ids_only = not returned_fields,
+        returned_fields = _get_index_field_names(returned_fields)
     )
 
     # Query String
@@ -1653,44 +2547,249 @@ def get_addresses_for_iteration(
     if filter_by_business_items:
         if isinstance(filter_by_business_items, basestring):
             filter_by_business_items = [filter_by_business_items]
-        for business_item in filter_by_business_items:
+        for business_item in sorted(filter_by_business_items):
             query_string += u' business:"%s"' % business_item
     if filter_by_category_items:
         if isinstance(filter_by_category_items, basestring):
             filter_by_category_items = [filter_by_category_items]
-        for category_item in filter_by_category_items:
+        for category_item in sorted(filter_by_category_items):
             query_string += u' category:"%s"' % category_item
     if filter_by_tag_items:
         if isinstance(filter_by_tag_items, basestring):
             filter_by_tag_items = [filter_by_tag_items]
-        for tag_item in filter_by_tag_items:
+        for tag_item in sorted(filter_by_tag_items):
             query_string += u' tag:"%s"' % tag_item
 
-    query_string = query_string.lstrip()
+    query_string = _add_read_clause(user, u" ".join(query_string.split()))
 
-    # Search
-    query = search.Query(query_string = query_string, options = query_options)
-    search_result = index.search(query)
-    next_cursor = search_result.cursor
+    # Cached result
+    signature = search_cache.get_signature(
+        "iteration", index.name, query_string, order_by, cursor.web_safe_string,
+        limit, returned_fields, number_found_accuracy
+    )
+    cached_result, generation = search_cache.get_result(signature)
+
+    if cached_result is None:
+        # Search
+        query = search.Query(query_string = query_string, options = query_options)
+        search_result = index.search(query)
+        total_quantity, total_exact = _get_total(search_result, number_found_accuracy)
+        cached_result = {
+            "total_quantity": total_quantity,
+            "total_exact": total_exact,
+            "next_cursor": (
+                search_result.cursor.web_safe_string if search_result.cursor else None
+            ),
+            "doc_ids": [document.doc_id for document in search_result.results]
+        }
+        if returned_fields:
+            cached_result["address_dicts"] = [
+                document_to_address_dict(document, returned_fields)
+                for document in search_result.results
+            ]
+        search_cache.set_result(signature, generation, cached_result)
 
+    next_cursor = cached_result["next_cursor"]
+    if next_cursor:
+        next_cursor = search.Cursor(web_safe_string = next_cursor)
+
+    # Address dictionaries built directly from the search documents
+    if returned_fields:
+        return {
+            "total_quantity": cached_result["total_quantity"],
+            "total_exact": cached_result["total_exact"],
+            "next_cursor": next_cursor,
+            "address_dicts": cached_result["address_dicts"]
+        }
 
     # Fetch addresses
-    addresses = []
-    for document in search_result.results:
-        key_urlsafe = document.doc_id
-        key = ndb.Key(urlsafe = key_urlsafe)
-        address = key.get()
-        if address:
-            addresses.append(address)
+    addresses = get_addresses_by_keys(cached_result["doc_ids"])
 
     # Finished
     return {
-        "total_quantity": search_result.number_found,
+        "total_quantity": cached_result["total_quantity"],
+        "total_exact": cached_result["total_exact"],
         "next_cursor": next_cursor,
         "addresses": addresses
     }
 
 
+def iter_address_batches(
+    cursor = None,
+    batch_size = EXPORT_BATCH_SIZE,
+    max_seconds = None,
+    user = None
+):
+    """
+    Iterates over all addresses (datastore order) and yields batches::
+
+        (<addresses>, <next cursor string>, <more>)
+
+    The next batch is fetched while the caller processes the current one.
+
+    :param cursor: Urlsafe datastore cursor string to resume an export
+
+    :param batch_size: Addresses per batch
+
+    :param max_seconds: Stops after this runtime; the last yielded cursor
+        can be used to resume.
+
+    :param user: If given, only the addresses, which the user may read,
+        are yielded (a batch can be smaller than *batch_size* or empty).
+    """
+
+    start = time.time()
+    cursor = ndb.Cursor(urlsafe = cursor) if cursor else ndb.Cursor()
+    query = Address.query()
+
+    future = query.fetch_page_async(batch_size, start_cursor = cursor)
+    while True:
+        addresses, next_cursor, more = future.get_result()
+        more = bool(more and next_cursor)
+        timed_out = max_seconds and (time.time() - start) >= max_seconds
+
+        # Prefetch next batch
+        if more and not timed_out:
+            future = query.fetch_page_async(batch_size, start_cursor = next_cursor)
+
+        if user:
+            addresses = authorization.filter_readable_addresses(user, addresses)
+
+        yield addresses, (next_cursor.urlsafe() if next_cursor else None), more
+
+        if not more or timed_out:
+            break
+
+
+def _chunks(items, size):
+    """
+    Splits a list into lists with maximal *size* items
+    """
+
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _bulk_set_items(user, address_keys, fieldname, get_new_items):
+    """
+    Sets new item lists (e.g. "category_items") for many addresses
+
+    All addresses are loaded with *get_multi*, every changed address is
+    written with its history entry in an own transaction (in parallel) and
+    the search documents
+    are updated in batches (see *address_index.update_documents()*).
+
+    :param user: Username
+
+    :param address_keys: List with keys
+
+    :param fieldname: "category_items" | "tag_items" | "business_items"
+
+    :param get_new_items: Function which gets the current item list of an
+        address and returns the new item list.
+
+    :return: Dictionary with the result for each key::
+
+        {<KeyUrlsafe>: "changed" | "unchanged" | "not_found" | "not_authorized", ...}
+    """
+
+    results = {}
+    utcnow = datetime.datetime.utcnow()
+    facet_deltas = collections.Counter()
+
+    # Unique keys
+    unique_address_keys = []
+    for address_key in address_keys:
+        if address_key not in results:
+            results[address_key] = None
+            unique_address_keys.append(address_key)
+
+    for address_keys_chunk in _chunks(unique_address_keys, BULK_BATCH_SIZE):
+
+        # Load addresses
+        addresses = ndb.get_multi(
+            [ndb.Key(urlsafe = address_key) for address_key in address_keys_chunk]
+        )
+
+        # Change addresses
+        changed_addresses = []
+        changed_search_fields = []
+        for address_key, address in zip(address_keys_chunk, addresses):
+            if address is None:
+                results[address_key] = BULK_NOT_FOUND
+                continue
+
+            # Check authorization
+            try:
+                authorization.check_address_authorization(user, address, "edit")
+            except errors.NotAuthorizedError:
+                results[address_key] = BULK_NOT_AUTHORIZED
+                continue
+
+            # New items
+            old_items = sorted(getattr(address, fieldname) or [])
+            new_items = sorted(list(set(get_new_items(old_items))))
+            if new_items == old_items:
+                results[address_key] = BULK_UNCHANGED
+                continue
+
+            old_facets = facet_items.get_address_facets(address)
+            setattr(address, fieldname, new_items)
+            facet_items.add_changes(
+                facet_deltas, old_facets, facet_items.get_address_facets(address)
+            )
+            address.et = utcnow
+            address.eu = user
+
+            search_fields = address.get_search_fields()
+            address.set_index_hash(search_fields)
+            changed_addresses.append(address)
+            changed_search_fields.append(search_fields)
+            results[address_key] = BULK_CHANGED
+
+        if not changed_addresses:
+            continue
+
+        # Save addresses and the original addresses to *address_history*
+        # (one transaction per address, all in parallel)
+        futures = [
+            address_history.put_address_async(address, user)
+            for address in changed_addresses
+        ]
+        for future in futures:
+            future.get_result()
+
+        # Update search index
+        address_index.update_documents(changed_addresses, documents = [
+            address.get_search_document(search_fields)
+            for address, search_fields in zip(changed_addresses, changed_search_fields)
+        ])
+
+    # Update Category- and Tag-Items
+    facet_items.apply_deltas(facet_deltas)
+
+    # Finished
+    return results
+
+
+def _clean_names(names):
+    """
+    Returns a list with stripped, not empty names
+    """
+
+    if isinstance(names, basestring):
+        names = [names]
+
+    cleaned_names = []
+    for name in names:
+        name = name.strip()
+        if name:
+            cleaned_names.append(name)
+
+    # Finished
+    return cleaned_names
+
+
 def add_categories(user, address_keys, categories):
     """
     Adds one or more categories to one or more addresses
@@ -1700,22 +2799,15 @@ def add_categories(user, address_keys, categories):
     :param address_keys: List with keys or string with one key
 
     :param categories: List with category names or string with one category
+
+    :return: Dictionary with the result for each key
+        ("changed", "unchanged", "not_found", "not_authorized")
     """
 
     # Params
     if isinstance(address_keys, basestring):
         address_keys = [address_keys]
-    if isinstance(categories, basestring):
-        categories = [categories]
-
-    # Clean categories
-    _categories = []
-    for category in categories:
-        category = category.strip()
-        if category:
-            _categories.append(category)
-    categories = _categories
-    del _categories
+    categories = _clean_names(categories)
 
     # Collect cached category names
     cached_categories = {}
@@ -1723,33 +2815,17 @@ def add_categories(user, address_keys, categories):
         cached_categories[category.lower()] = category
 
     # Replace categories with correct spelled category names
-    _categories = []
-    for category in categories:
-        if category.lower() in cached_categories:
-            _categories.append(cached_categories[category.lower()])
-        else:
-            _categories.append(category)
-    categories = _categories
-    del _categories
+    categories = [
+        cached_categories.get(category.lower(), category) for category in categories
+    ]
 
     # Update addresses
-    for address_key in address_keys:
-        # Current address
-        address = get_address(key_urlsafe = address_key)
-        old_category_items = sorted(address.category_items or [])
-
-        # New category items
-        new_category_items = set(address.category_items or [])
-        new_category_items.update(categories)
-        new_category_items = sorted(list(new_category_items))
-
-        # Save (if needed)
-        if new_category_items != old_category_items:
-            save_address(
-                user = user,
-                key_urlsafe = address_key,
-                category_items = new_category_items
-            )
+    return _bulk_set_items(
+        user = user,
+        address_keys = address_keys,
+        fieldname = "category_items",
+        get_new_items = lambda category_items: category_items + categories
+    )
 
 
 def delete_categories(user, address_keys, categories):
@@ -1761,49 +2837,26 @@ def delete_categories(user, address_keys, categories):
     :param address_keys: List with keys or string with one key
 
     :param categories: List with category names or string with one category
+
+    :return: Dictionary with the result for each key
+        ("changed", "unchanged", "not_found", "not_authorized")
     """
 
     # Params
     if isinstance(address_keys, basestring):
         address_keys = [address_keys]
-    if isinstance(categories, basestring):
-        categories = [categories]
-
-    # Clean categories
-    _categories = []
-    for category in categories:
-        category = category.strip()
-        if category:
-            _categories.append(category)
-    categories = _categories
-    del _categories
+    categories_lower = set(category.lower() for category in _clean_names(categories))
 
     # Update addresses
-    for address_key in address_keys:
-        # Current address
-        address = get_address(key_urlsafe = address_key)
-        old_category_items = sorted(address.category_items or [])
-
-        # Current categories
-        current_categories = {}
-        for category in (address.category_items or []):
-            current_categories[category.lower()] = category
-
-        # Delete from current categories
-        for category in categories:
-            if category.lower() in current_categories:
-                del current_categories[category.lower()]
-
-        # New category items
-        new_category_items = sorted(list(set(current_categories.values() or [])))
-
-        # Save (if needed)
-        if new_category_items != old_category_items:
-            save_address(
-                user = user,
-                key_urlsafe = address_key,
-                category_items = new_category_items
-            )
+    return _bulk_set_items(
+        user = user,
+        address_keys = address_keys,
+        fieldname = "category_items",
+        get_new_items = lambda category_items: [
+            category for category in category_items
+            if category.lower() not in categories_lower
+        ]
+    )
 
 
 def add_tags(user, address_keys, tags):
@@ -1815,22 +2868,15 @@ def add_tags(user, address_keys, tags):
     :param address_keys: List with keys or string with one key
 
     :param tags: List with tag names or string with one tag
+
+    :return: Dictionary with the result for each key
+        ("changed", "unchanged", "not_found", "not_authorized")
     """
 
     # Params
     if isinstance(address_keys, basestring):
         address_keys = [address_keys]
-    if isinstance(tags, basestring):
-        tags = [tags]
-
-    # Clean tags
-    _tags = []
-    for tag in tags:
-        tag = tag.strip()
-        if tag:
-            _tags.append(tag)
-    tags = _tags
-    del _tags
+    tags = _clean_names(tags)
 
     # Collect cached tag names
     cached_tags = {}
@@ -1838,33 +2884,15 @@ def add_tags(user, address_keys, tags):
         cached_tags[tag.lower()] = tag
 
     # Replace tags with correct spelled tag names
-    _tags = []
-    for tag in tags:
-        if tag.lower() in cached_tags:
-            _tags.append(cached_tags[tag.lower()])
-        else:
-            _tags.append(tag)
-    tags = _tags
-    del _tags
+    tags = [cached_tags.get(tag.lower(), tag) for tag in tags]
 
     # Update addresses
-    for address_key in address_keys:
-        # Current address
-        address = get_address(key_urlsafe = address_key)
-        old_tag_items = sorted(address.tag_items or [])
-
-        # New tag items
-        new_tag_items = set(address.tag_items or [])
-        new_tag_items.update(tags)
-        new_tag_items = sorted(list(new_tag_items))
-
-        # Save (if needed)
-        if new_tag_items != old_tag_items:
-            save_address(
-                user = user,
-                key_urlsafe = address_key,
-                tag_items = new_tag_items
-            )
+    return _bulk_set_items(
+        user = user,
+        address_keys = address_keys,
+        fieldname = "tag_items",
+        get_new_items = lambda tag_items: tag_items + tags
+    )
 
 
 def delete_tags(user, address_keys, tags):
@@ -1876,47 +2904,23 @@ def delete_tags(user, address_keys, tags):
     :param address_keys: List with keys or string with one key
 
     :param tags: List with tag names or string with one tag
+
+    :return: Dictionary with the result for each key
+        ("changed", "unchanged", "not_found", "not_authorized")
     """
 
     # Params
     if isinstance(address_keys, basestring):
         address_keys = [address_keys]
-    if isinstance(tags, basestring):
-        tags = [tags]
-
-    # Clean tags
-    _tags = []
-    for tag in tags:
-        tag = tag.strip()
-        if tag:
-            _tags.append(tag)
-    tags = _tags
-    del _tags
+    tags_lower = set(tag.lower() for tag in _clean_names(tags))
 
     # Update addresses
-    for address_key in address_keys:
-        # Current address
-        address = get_address(key_urlsafe = address_key)
-        old_tag_items = sorted(address.tag_items or [])
-
-        # Current tags
-        current_tags = {}
-        for tag in (address.tag_items or []):
-            current_tags[tag.lower()] = tag
-
-        # Delete from current tags
-        for tag in tags:
-            if tag.lower() in current_tags:
-                del current_tags[tag.lower()]
-
-        # New tag items
-        new_tag_items = sorted(list(set(current_tags.values() or [])))
-
-        # Save (if needed)
-        if new_tag_items != old_tag_items:
-            save_address(
-                user = user,
-                key_urlsafe = address_key,
-                tag_items = new_tag_items
-            )
+    return _bulk_set_items(
+        user = user,
+        address_keys = address_keys,
+        fieldname = "tag_items",
+        get_new_items = lambda tag_items: [
+            tag for tag in tag_items if tag.lower() not in tags_lower
+        ]
+    )
 
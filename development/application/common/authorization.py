@@ -66,6 +66,9 @@ DEFAULT_AUTHORIZATIONS = {
 # Global authorizations
 _authorizations = None
 
+# Compiled permission matrix: {<user>: frozenset([<authorization>, ...])}
+_user_authorizations = None
+
 
 def get_authorizations():
     """
@@ -84,6 +87,57 @@ def get_authorizations():
     return _authorizations
 
 
+def compile_authorizations():
+    """
+    Builds the set of authorizations for every user (INI-settings
+    "users", "roles" and "authorizations").
+
+    Called once, after the configuration is loaded.
+    """
+
+    global _user_authorizations
+
+    roles = cherrypy.config["roles"]
+    user_authorizations = dict((user, set()) for user in cherrypy.config["users"])
+    for authorization, role_names in get_authorizations().items():
+        for role_name in role_names or []:
+            for user in roles.get(role_name, []):
+                if user in user_authorizations:
+                    user_authorizations[user].add(authorization)
+
+    _user_authorizations = dict(
+        (user, frozenset(authorizations))
+        for user, authorizations in user_authorizations.items()
+    )
+
+    # Finished
+    return _user_authorizations
+
+
+def get_user_authorizations(user):
+    """
+    Returns all authorizations of the user (frozenset)
+
+    Raises an error, if the user does not exist.
+    """
+
+    user_authorizations = _user_authorizations or compile_authorizations()
+    try:
+        return user_authorizations[user]
+    except KeyError:
+        raise errors.UserNotExistsError(user = user)
+
+
+def has_authorization(user, authorization):
+    """
+    Returns `True`, if the user has the authorization
+    """
+
+    assert authorization in ALL_AUTHORIZATIONS
+
+    return authorization in get_user_authorizations(user)
+
+
 def check_authorization(user, authorization):
     """
     Checks if the user has the authorization.
@@ -91,25 +145,87 @@ def check_authorization(user, authorization):
     Raises an error if not.
     """
 
-    assert authorization in ALL_AUTHORIZATIONS
+    if not has_authorization(user, authorization):
+        raise errors.NotAuthorizedError(user = user, authorization = authorization)
 
-    # Check if user exists
-    if user not in cherrypy.config["users"]:
-        raise errors.UserNotExistsError(user = user)
 
-    # Get authorizations
-    authorizations = get_authorizations()
+def get_address_authorization(user, address, action):
+    """
+    Returns the authorization, which is needed for the action on the address
 
-    # Get roles for authorization
-    role_names = authorizations.get(authorization)
-    if not role_names:
-        raise errors.NotAuthorizedError(user = user, authorization = authorization)
+    :param action: "read", "edit" or "delete"
+    """
 
-    # Check usernames in roles
-    for role_name in role_names:
-        if user in cherrypy.config["roles"][role_name]:
-            break
+    if address.owner == user:
+        return u"own_address." + action
+    elif address.private:
+        return u"private_address." + action
     else:
-        raise errors.NotAuthorizedError(user = user, authorization = authorization)
+        return u"public_address." + action
+
+
+def check_address_authorization(user, address, action):
+    """
+    Checks if the user may read, edit or delete the address.
+
+    Raises an error if not.
+
+    :param action: "read", "edit" or "delete"
+    """
+
+    check_authorization(user, get_address_authorization(user, address, action))
+
+
+def may_read_all_addresses(user):
+    """
+    Returns `True`, if the user may read public and private addresses
+    """
+
+    user_authorizations = get_user_authorizations(user)
+    return PUBLIC_ADDRESS_READ in user_authorizations and PRIVATE_ADDRESS_READ in user_authorizations
 
 
+def filter_readable_addresses(user, addresses):
+    """
+    Returns the addresses, which the user may read (missing addresses
+    are removed, the order is kept)
+    """
+
+    if may_read_all_addresses(user):
+        return [address for address in addresses if address]
+
+    user_authorizations = get_user_authorizations(user)
+    return [
+        address for address in addresses
+        if address and get_address_authorization(user, address, "read") in user_authorizations
+    ]
+
+
+def get_read_query_clause(user):
+    """
+    Returns the search query clause with the addresses, the user may read
+    (search index fields "owner" and "visibility").
+
+    Returns `None`, if the user may read all addresses.
+    Raises an error, if the user may not read any address.
+    """
+
+    user_authorizations = get_user_authorizations(user)
+
+    public = PUBLIC_ADDRESS_READ in user_authorizations
+    private = PRIVATE_ADDRESS_READ in user_authorizations
+    if public and private:
+        return None
+
+    clauses = []
+    if OWN_ADDRESS_READ in user_authorizations:
+        clauses.append(u'owner:"{user}"'.format(user = user.replace(u'"', u"")))
+    if public:
+        clauses.append(u"visibility:public")
+    if private:
+        clauses.append(u"visibility:private")
+    if not clauses:
+        raise errors.NotAuthorizedError(user = user, authorization = PUBLIC_ADDRESS_READ)
+
+    # Finished
+    return u"(" + u" OR ".join(clauses) + u")"
@@ -2,10 +2,7 @@
 # coding: utf-8
 
 from model.address import Address
-import named_values
-
-
-BUSINESS_ITEMS = "business_items"
+import facet_items
 
 
 def get_business_items_direct():
@@ -24,53 +21,37 @@ def get_business_items_direct():
     return business_items
 
 
-def get_business_items_cached():
-    """
-    Returns all used business items as set.
+def get_business_item_counts():
     """
+    Returns all used business items with the number of addresses::
 
-    # Cache get
-    business_items = named_values.get_value(name = BUSINESS_ITEMS)
-    if business_items is not None:
-        return business_items
+        {<business item>: <count>, ...}
 
-    # Fetch business items direct from the Address model
-    business_items = get_business_items_direct()
+    Until the facet items are built (in the background), the counts
+    are `None`.
+    """
 
-    # Cache set
-    named_values.set_value(name = BUSINESS_ITEMS, value = business_items)
+    # Build the facet items once (deferred)
+    if not facet_items.is_ready(facet_items.BUSINESS):
+        facet_items.start_rebuild_facet(facet_items.BUSINESS)
+        return dict.fromkeys(get_business_items_direct())
 
     # Finished
-    return business_items
+    return facet_items.get_counts(facet_items.BUSINESS)
 
 
-def update_business_items_cache():
+def get_business_items_cached():
     """
-    Updates the "business_items" NamedValue entity
+    Returns all used business items as set.
     """
 
-    # Cache set
-    named_values.set_value(name = BUSINESS_ITEMS, value = get_business_items_direct())
+    return set(get_business_item_counts())
 
 
-def add_business_items_to_cache(business_items):
+def update_business_items_cache():
     """
-    Add business items to the cache
+    Recounts the business facet items directly from the Address model
     """
 
-    if isinstance(business_items, basestring):
-        business_items = [business_items]
-
-    # Cache get
-    cached_business_items = named_values.get_value(name = BUSINESS_ITEMS)
-    if cached_business_items is None:
-        cached_business_items = set()
-
-    # Add new business items
-    for business_item in business_items:
-        cached_business_items.add(business_item)
-
-    # Cache set
-    named_values.set_value(name = BUSINESS_ITEMS, value = cached_business_items)
-
+    facet_items.rebuild_facet(facet_items.BUSINESS)
 
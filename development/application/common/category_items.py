@@ -2,10 +2,7 @@
 # coding: utf-8
 
 from model.address import Address
-import named_values
-
-
-CATEGORY_ITEMS = "category_items"
+import facet_items
 
 
 def get_category_items_direct():
@@ -25,53 +22,37 @@ def get_category_items_direct():
     return category_items
 
 
-def get_category_items_cached():
-    """
-    Returns all used category items as set.
+def get_category_item_counts():
     """
+    Returns all used category items with the number of addresses::
 
-    # Cache get
-    category_items = named_values.get_value(name = CATEGORY_ITEMS)
-    if category_items is not None:
-        return category_items
+        {<category item>: <count>, ...}
 
-    # Fetch category items direct from the Address model
-    category_items = get_category_items_direct()
+    Until the facet items are built (in the background), the counts
+    are `None`.
+    """
 
-    # Cache set
-    named_values.set_value(name = CATEGORY_ITEMS, value = category_items)
+    # Build the facet items once (deferred)
+    if not facet_items.is_ready(facet_items.CATEGORY):
+        facet_items.start_rebuild_facet(facet_items.CATEGORY)
+        return dict.fromkeys(get_category_items_direct())
 
     # Finished
-    return category_items
+    return facet_items.get_counts(facet_items.CATEGORY)
 
 
-def update_category_items_cache():
+def get_category_items_cached():
     """
-    Updates the "category_items" NamedValue entity
+    Returns all used category items as set.
     """
 
-    # Cache set
-    named_values.set_value(name = CATEGORY_ITEMS, value = get_category_items_direct())
+    return set(get_category_item_counts())
 
 
-def add_category_items_to_cache(category_items):
+def update_category_items_cache():
     """
-    Add category items to the cache
+    Recounts the category facet items directly from the Address model
     """
 
-    if isinstance(category_items, basestring):
-        category_items = [category_items]
-
-    # Cache get
-    cached_category_items = named_values.get_value(name = CATEGORY_ITEMS)
-    if cached_category_items is None:
-        cached_category_items = set()
-
-    # Add new category items
-    for category_item in category_items:
-        cached_category_items.add(category_item)
-
-    # Cache set
-    named_values.set_value(name = CATEGORY_ITEMS, value = cached_category_items)
-
+    facet_items.rebuild_facet(facet_items.CATEGORY)
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Sharded counters
+
+Every change is written transactionally into one random shard, so
+concurrent changes neither get lost nor hit the write limit of a single
+entity group. The total is cached in memcache.
+
+The number of shards is configured with the INI-setting *counter.shards*.
+It should only be increased, never decreased.
+"""
+
+import random
+import cherrypy
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from model.counter_shard import CounterShard
+
+DEFAULT_SHARDS = 20
+MEMCACHE_PREFIX = "counter:"
+
+
+def get_shard_count():
+    """
+    Returns the configured number of shards
+    """
+
+    return int(cherrypy.config.get("counter.shards") or DEFAULT_SHARDS)
+
+
+def _shard_key(name, shard):
+    return ndb.Key(CounterShard, u"{name}-{shard}".format(name = name, shard = shard))
+
+
+@ndb.transactional
+def _add_to_shard(name, shard, delta):
+    """
+    Adds *delta* to one shard (in a transaction)
+    """
+
+    key = _shard_key(name, shard)
+    counter_shard = key.get()
+    if counter_shard is None:
+        counter_shard = CounterShard(key = key, name = name)
+    counter_shard.count += delta
+    counter_shard.put()
+
+
+def add(name, delta):
+    """
+    Adds *delta* (positive or negative) to the counter
+    """
+
+    if not delta:
+        return
+
+    _add_to_shard(name, random.randint(0, get_shard_count() - 1), delta)
+
+    # Update cached total (only if cached)
+    if delta > 0:
+        memcache.incr(MEMCACHE_PREFIX + name, delta = delta)
+    else:
+        memcache.decr(MEMCACHE_PREFIX + name, delta = -delta)
+
+
+def increment(name):
+    """
+    Increments the counter
+    """
+
+    add(name, 1)
+
+
+def decrement(name):
+    """
+    Decrements the counter
+    """
+
+    add(name, -1)
+
+
+def get_count(name):
+    """
+    Returns the total of the counter or `None`, if the counter does not exist
+    """
+
+    # Cache get
+    count = memcache.get(MEMCACHE_PREFIX + name)
+    if count is not None:
+        return count
+
+    # Sum of all shards
+    counter_shards = ndb.get_multi([
+        _shard_key(name, shard) for shard in range(get_shard_count())
+    ])
+    counter_shards = [counter_shard for counter_shard in counter_shards if counter_shard]
+    if not counter_shards:
+        return None
+    count = sum(counter_shard.count for counter_shard in counter_shards)
+
+    # Cache set
+    memcache.add(MEMCACHE_PREFIX + name, count)
+
+    # Finished
+    return count
+
+
+def correct(name, count):
+    """
+    Corrects the counter to the given total
+
+    :return: Difference between the corrected and the previous total
+    """
+
+    # Sum of all shards (not cached)
+    counter_shards = ndb.get_multi([
+        _shard_key(name, shard) for shard in range(get_shard_count())
+    ])
+    current_count = sum(
+        counter_shard.count for counter_shard in counter_shards if counter_shard
+    )
+
+    # Write difference into the first shard
+    delta = count - current_count
+    if delta or not any(counter_shards):
+        _add_to_shard(name, 0, delta)
+
+    # Reset cached total
+    memcache.delete(MEMCACHE_PREFIX + name)
+
+    # Finished
+    return delta
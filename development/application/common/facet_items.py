@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Incremental facet index
+
+For every used category, tag and business item exists one FacetItem with
+the number of addresses, which use the item. The counts are updated
+whenever addresses are created, saved or deleted.
+
+The cached counts are read with *get_multi* (strongly consistent) and are
+updated by the transactions, which change the counts.
+"""
+
+import datetime
+import collections
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from model.address import Address
+from model.facet_item import FacetItem
+import named_values
+
+CATEGORY = "category"
+TAG = "tag"
+BUSINESS = "business"
+
+# Facet --> Address field
+FACET_FIELDS = {
+    CATEGORY: "category_items",
+    TAG: "tag_items",
+    BUSINESS: "business_items",
+}
+
+MEMCACHE_PREFIX = "facet_items:"
+MEMCACHE_SECONDS = 600  # Lifetime of the cached counts
+MEMCACHE_CAS_RETRIES = 5
+FACET_ITEMS_READY = "facet_items_ready"  # NamedValue with the initialized facets
+REBUILD_LOCK_PREFIX = "facet_items:rebuild:"
+REBUILD_LOCK_SECONDS = 600  # The first build of a facet is started at most every 10 minutes
+
+
+def _facet_item_key(facet, value):
+    return ndb.Key(FacetItem, u"{facet}:{value}".format(facet = facet, value = value))
+
+
+def get_address_facets(address):
+    """
+    Returns the facet values of the address::
+
+        {"category": [...], "tag": [...], "business": [...]}
+    """
+
+    if address is None:
+        return {}
+
+    return dict(
+        (facet, list(getattr(address, fieldname) or []))
+        for facet, fieldname in FACET_FIELDS.items()
+    )
+
+
+def add_changes(deltas, old_facets, new_facets):
+    """
+    Adds the differences between the old and the new facet values of
+    one address to *deltas*.
+
+    :param deltas: collections.Counter with (facet, value)-tuples as keys
+    :param old_facets: Result of *get_address_facets()* before the change
+    :param new_facets: Result of *get_address_facets()* after the change
+    """
+
+    for facet in FACET_FIELDS:
+        old_values = set(old_facets.get(facet, []))
+        new_values = set(new_facets.get(facet, []))
+        for value in new_values - old_values:
+            deltas[(facet, value)] += 1
+        for value in old_values - new_values:
+            deltas[(facet, value)] -= 1
+
+    # Finished
+    return deltas
+
+
+@ndb.transactional_tasklet
+def _apply_delta_async(facet, value, delta):
+    """
+    Changes the count of one facet item (in a transaction)
+    """
+
+    key = _facet_item_key(facet, value)
+    facet_item = yield key.get_async()
+    if facet_item is None:
+        facet_item = FacetItem(key = key, facet = facet, value = value)
+    facet_item.count += delta
+    if facet_item.count > 0:
+        yield facet_item.put_async()
+    else:
+        yield key.delete_async()
+    raise ndb.Return(facet_item.count)
+
+
+def _update_cached_counts(facet, new_counts):
+    """
+    Writes the new counts of changed facet items into the cached counts
+    of the facet (compare and set)
+
+    :param new_counts: {<value>: <count>, ...}; counts below 1 are removed
+    """
+
+    key = MEMCACHE_PREFIX + facet
+    client = memcache.Client()
+    for retry in xrange(MEMCACHE_CAS_RETRIES):
+        counts = client.gets(key)
+        if counts is None:
+            # Nothing cached; the next *get_counts* reads the facet items
+            return
+        counts = dict(counts)
+        for value, count in new_counts.items():
+            if count > 0:
+                counts[value] = count
+            else:
+                counts.pop(value, None)
+        if client.cas(key, counts, time = MEMCACHE_SECONDS):
+            return
+
+    # Too many concurrent changes
+    memcache.delete(key)
+
+
+def apply_deltas(deltas):
+    """
+    Writes the collected differences into the facet items.
+
+    Every facet item is changed in its own transaction. All transactions
+    run in parallel.
+    """
+
+    deltas = dict((facet_value, delta) for facet_value, delta in deltas.items() if delta)
+    if not deltas:
+        return
+
+    facet_values = deltas.keys()
+    futures = [
+        _apply_delta_async(facet, value, deltas[(facet, value)])
+        for facet, value in facet_values
+    ]
+    ndb.Future.wait_all(futures)
+
+    # Update cached counts
+    new_counts = collections.defaultdict(dict)
+    try:
+        for (facet, value), future in zip(facet_values, futures):
+            new_counts[facet][value] = future.get_result()
+    except Exception:
+        memcache.delete_multi([
+            MEMCACHE_PREFIX + facet for facet in set(facet for facet, value in facet_values)
+        ])
+        raise
+    for facet, facet_counts in new_counts.items():
+        _update_cached_counts(facet, facet_counts)
+
+
+def update_address_facets(old_facets, new_facets):
+    """
+    Updates the facet items after one address was changed
+    """
+
+    apply_deltas(add_changes(collections.Counter(), old_facets, new_facets))
+
+
+def is_ready(facet):
+    """
+    Returns `True`, if the facet items were built at least once
+    """
+
+    return facet in (named_values.get_value(name = FACET_ITEMS_READY) or [])
+
+
+def start_rebuild_facet(facet):
+    """
+    Starts the rebuild of the facet items in the background (deferred),
+    if it was not started in the last *REBUILD_LOCK_SECONDS*
+    """
+
+    if memcache.add(REBUILD_LOCK_PREFIX + facet, True, time = REBUILD_LOCK_SECONDS):
+        deferred.defer(rebuild_facet, facet)
+
+
+def get_counts(facet):
+    """
+    Returns the used values of the facet with its number of addresses::
+
+        {<value>: <count>, ...}
+    """
+
+    # Cache get
+    counts = memcache.get(MEMCACHE_PREFIX + facet)
+    if counts is not None:
+        return counts
+
+    # The keys from the query, the counts with *get_multi* (strongly consistent)
+    keys = list(FacetItem.query(FacetItem.facet == facet).iter(keys_only = True, batch_size = 500))
+    counts = {}
+    for start in xrange(0, len(keys), 500):
+        for facet_item in ndb.get_multi(keys[start:start + 500]):
+            if facet_item and facet_item.count > 0:
+                counts[facet_item.value] = facet_item.count
+
+    # Cache set
+    memcache.add(MEMCACHE_PREFIX + facet, counts, time = MEMCACHE_SECONDS)
+
+    # Finished
+    return counts
+
+
+@ndb.transactional_tasklet
+def _set_count_async(facet, value, count, rebuild_start):
+    """
+    Sets the recounted count of one facet item (in a transaction)
+
+    Facet items, which were changed after *rebuild_start*, are not changed
+    (the recounted count may not contain this change).
+    """
+
+    key = _facet_item_key(facet, value)
+    facet_item = yield key.get_async()
+    if facet_item is not None and facet_item.et and facet_item.et >= rebuild_start:
+        return
+    if count > 0:
+        if facet_item is None:
+            facet_item = FacetItem(key = key, facet = facet, value = value)
+        if facet_item.count != count:
+            facet_item.count = count
+            yield facet_item.put_async()
+    elif facet_item is not None:
+        yield key.delete_async()
+
+
+def rebuild_facet(facet):
+    """
+    Counts the values of the facet directly from the Address model and
+    corrects the facet items of the facet.
+
+    Every facet item is corrected in its own transaction; facet items,
+    which were changed during the rebuild, are kept.
+    """
+
+    address_field = Address._properties[FACET_FIELDS[facet]]
+    rebuild_start = datetime.datetime.utcnow()
+
+    # Count (one result per address and value)
+    counts = collections.Counter()
+    query = Address.query(projection = [address_field])
+    for address in query.iter(batch_size = 500):
+        for value in getattr(address, FACET_FIELDS[facet]):
+            counts[value] += 1
+
+    # Correct facet items (also the unused ones)
+    values = set(counts)
+    for key in FacetItem.query(FacetItem.facet == facet).iter(keys_only = True):
+        values.add(key.id().split(u":", 1)[1])
+    values = list(values)
+    for start in xrange(0, len(values), 100):
+        futures = [
+            _set_count_async(facet, value, counts.get(value, 0), rebuild_start)
+            for value in values[start:start + 100]
+        ]
+        for future in futures:
+            future.get_result()
+
+    # Mark facet as ready
+    ready_facets = set(named_values.get_value(name = FACET_ITEMS_READY) or [])
+    if facet not in ready_facets:
+        ready_facets.add(facet)
+        named_values.set_value(name = FACET_ITEMS_READY, value = ready_facets)
+
+    # Invalidate cached counts
+    memcache.delete(MEMCACHE_PREFIX + facet)
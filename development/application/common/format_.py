@@ -4,13 +4,26 @@
 Formathelper
 """
 
+import re
 import string
 import datetime
-import pytz
 import decimal
 
 
 ALLLOWED_ASCII_CHARS = string.digits + string.ascii_letters + "-_ "
+NOT_ALLOWED_ASCII_CHARS_RE = re.compile(u"[^0-9A-Za-z\\-_ ]+")
+WORD_RE = re.compile(u"\\w+", re.UNICODE)
+
+# Umlaute umschreiben (für *unicode.translate*)
+UMLAUT_TRANSLATION = {
+    ord(u"ö"): u"oe",
+    ord(u"ä"): u"ae",
+    ord(u"ü"): u"ue",
+    ord(u"Ö"): u"Oe",
+    ord(u"Ä"): u"Ae",
+    ord(u"Ü"): u"Ue",
+    ord(u"ß"): u"ss",
+}
 
 
 def string_to_date(date_string):
@@ -147,23 +160,10 @@ def safe_ascii(text):
     text = safe_unicode(text)
 
     # Umlaute umschreiben
-    for searchchar, replacechar in (
-        (u"ö", u"oe"),
-        (u"Ö", u"Oe"),
-        (u"ä", u"ae"),
-        (u"Ä", u"Ae"),
-        (u"ü", u"ue"),
-        (u"Ü", u"Ue"),
-        (u"ß", u"ss"),
-    ):
-        text = text.replace(searchchar, replacechar)
+    text = text.translate(UMLAUT_TRANSLATION)
 
     # Sonderzeichen entfernen
-    text_tmp = ""
-    for char in text:
-        if char in ALLLOWED_ASCII_CHARS:
-            text_tmp += char
-    text = text_tmp
+    text = NOT_ALLOWED_ASCII_CHARS_RE.sub(u"", text)
 
     # Fertig
     return text
@@ -333,6 +333,7 @@ def datetime_utc_with_timezone(dt):
     if dt is None:
         return
 
+    import pytz  # Erst bei Bedarf laden (Kaltstart)
     return pytz.UTC.fromutc(dt)
 
 
@@ -499,12 +500,7 @@ def has_umlauts(text):
     if not text:
         return False
 
-    for umlaut in u"öäüÖÄÜß":
-        if text.find(umlaut) > -1:
-            return True
-
-    # Fertig
-    return False
+    return fold_umlauts(text) is not None
 
 
 def replace_umlauts(text):
@@ -515,16 +511,63 @@ def replace_umlauts(text):
     if not text:
         return text
 
-    for umlaut, replacement in (
-        (u"ö", u"oe"),
-        (u"ä", u"ae"),
-        (u"ü", u"ue"),
-        (u"Ö", u"Oe"),
-        (u"Ä", u"Ae"),
-        (u"Ü", u"Ue"),
-        (u"ß", u"ss"),
-    ):
-        text = text.replace(umlaut, replacement)
+    # Fertig
+    return fold_umlauts(text) or text
+
+
+def fold_umlauts(text):
+    """
+    Ersetzt Umlaute in einem Durchlauf
+
+    Gibt `None` zurück, wenn der Text keine Umlaute enthält.
+    """
+
+    if not isinstance(text, unicode):
+        # Byte-Strings ohne Umlaute (ASCII) bleiben unverändert
+        try:
+            text = text.decode("ascii")
+        except UnicodeDecodeError:
+            text = text.decode("utf-8")
+        else:
+            return None
+
+    folded = text.translate(UMLAUT_TRANSLATION)
+    if folded == text:
+        return None
 
     # Fertig
-    return text
+    return folded
+
+
+def split_words(text):
+    """
+    Gibt die Wörter des Textes klein geschrieben zurück (ohne Satzzeichen)
+    """
+
+    if not text:
+        return []
+
+    return WORD_RE.findall(safe_unicode(text).lower())
+
+
+def edge_ngrams(text, min_length = 1, max_length = 10):
+    """
+    Gibt die Anfänge aller Wörter des Textes zurück
+    (klein geschrieben, zusätzlich ohne Umlaute)
+
+    u"Jörg" --> [u"j", u"jö", u"jör", u"jörg", u"jo", u"joe", u"joer", u"joerg"]
+    """
+
+    ngrams = []
+    seen = set()
+    for word in split_words(text):
+        folded = fold_umlauts(word)
+        for variant in (word, folded) if folded else (word,):
+            for length in xrange(min_length, min(len(variant), max_length) + 1):
+                ngram = variant[:length]
+                if ngram not in seen:
+                    seen.add(ngram)
+                    ngrams.append(ngram)
+
+    # Fertig
+    return ngrams
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Kaltstart-Messung
+
+- Import-Zeiten pro Modul (wie ``python -X importtime``), nur wenn die
+  Umgebungsvariable IMPORT_PROFILE gesetzt ist (app.yaml: env_variables).
+- Zeitpunkte (ab dem Laden von *appengine_config.py*) für den Kaltstart,
+  z.B. "api.app" und "first_response".
+
+Darf nur Module der Standardbibliothek importieren, da es vor allen
+anderen Modulen geladen wird.
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+import __builtin__
+
+STARTED = time.time()
+
+_original_import = None
+_records = []  # [(name, depth, self_seconds, cumulative_seconds), ...]
+_local = threading.local()  # Pro Thread: stack = Importzeit der Unter-Importe pro Ebene
+_milestones = []  # [(name, seconds since start), ...]
+
+
+def is_enabled():
+    return bool(os.environ.get("IMPORT_PROFILE"))
+
+
+def install():
+    """
+    Ersetzt *__import__* durch die Zeitmessung (falls eingeschaltet)
+    """
+
+    global _original_import
+
+    if _original_import or not is_enabled():
+        return
+
+    _original_import = __builtin__.__import__
+    __builtin__.__import__ = _timed_import
+
+
+def _timed_import(name, globals = None, locals = None, fromlist = None, level = -1):
+    """
+    Misst die Dauer jedes Imports, der neue Module lädt
+    """
+
+    # Eigener Stapel pro Thread (gleichzeitige Requests)
+    _stack = getattr(_local, "stack", None)
+    if _stack is None:
+        _stack = _local.stack = []
+
+    modules_count = len(sys.modules)
+    _stack.append(0.0)
+    start = time.time()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        cumulative = time.time() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += cumulative
+        if len(sys.modules) > modules_count:
+            _records.append((name, len(_stack), cumulative - children, cumulative))
+
+
+def mark(name):
+    """
+    Merkt sich einen Kaltstart-Zeitpunkt (nur beim ersten Aufruf je Name)
+    """
+
+    if name in dict(_milestones):
+        return
+    seconds = time.time() - STARTED
+    _milestones.append((name, seconds))
+    logging.info(u"Cold start: {name} after {ms:.0f} ms".format(name = name, ms = seconds * 1000))
+
+
+def get_cold_start_info():
+    """
+    Gibt die Kaltstart-Zeitpunkte in Millisekunden zurück
+    """
+
+    return [
+        {"name": name, "ms": round(seconds * 1000, 1)}
+        for name, seconds in _milestones
+    ]
+
+
+def get_report(limit = 50, sort_by = "cumulative"):
+    """
+    Gibt die langsamsten Imports zurück
+
+    :param sort_by: "cumulative" oder "self"
+    """
+
+    index = 3 if sort_by == "cumulative" else 2
+    records = sorted(_records, key = lambda record: record[index], reverse = True)
+    return [
+        {
+            "module": name,
+            "depth": depth,
+            "self_ms": round(self_seconds * 1000, 2),
+            "cumulative_ms": round(cumulative_seconds * 1000, 2),
+        }
+        for name, depth, self_seconds, cumulative_seconds in records[:limit]
+    ]
+
+
+def format_report():
+    """
+    Gibt alle Imports in Ladereihenfolge als Text zurück (wie -X importtime)
+    """
+
+    lines = [u"import time: self [us] | cumulative | imported package"]
+    for name, depth, self_seconds, cumulative_seconds in _records:
+        lines.append(u"import time: {self_us:>9} | {cumulative_us:>10} | {indent}{name}".format(
+            self_us = int(self_seconds * 1000000),
+            cumulative_us = int(cumulative_seconds * 1000000),
+            indent = u"  " * depth,
+            name = name
+        ))
+    return u"\n".join(lines)
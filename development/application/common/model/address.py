@@ -1,19 +1,179 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import copy
 import datetime
+import operator
 import cherrypy
 import common.format_
+import common.address_index
 from google.appengine.ext import ndb
 from google.appengine.api import search
-from bunch import Bunch
 # from google.appengine.ext import deferred
 
 
 # ACHTUNG! Neue Models müssen auch in den Backup-Cron-Job eingetragen werden!
 
 
+# Kinds of properties for *Address.to_dict*
+SCALAR_FIELD = "scalar"
+REPEATED_FIELD = "repeated"
+STRUCTURED_FIELD = "structured"
+
+# Repeated string fields, which are removed by *exclude_empty_fields*
+EMPTY_REPEATED_FIELDS = {"category_items", "business_items", "tag_items"}
+
+# Internal fields, which are only returned by *Address.to_dict*, if they
+# are named in *include*
+INTERNAL_FIELDS = frozenset(["index_hash", "history_version", "emails"])
+
+# Compiled plans for *Address.to_dict*
+_to_dict_plans = {}
+_TO_DICT_PLANS_MAX = 200
+
+
+def _search_field_spec(attribute, name, field_type, repluml = False, char1 = False):
+    return (
+        operator.attrgetter(attribute),
+        name,
+        field_type,
+        repluml,
+        name + u"_char1" if char1 else None
+    )
+
+
+# Default fields of the search document:
+# (<value getter>, <field name>, <field type>, <also without umlauts>, <char1 field name>)
+SEARCH_FIELD_SPECS = (
+    _search_field_spec("ct", u"creation_timestamp", search.DateField),
+    _search_field_spec("cu", u"creation_user", search.TextField),
+    _search_field_spec("et", u"edit_timestamp", search.DateField),
+    _search_field_spec("eu", u"edit_user", search.TextField),
+    _search_field_spec("owner", u"owner", search.AtomField),
+    (lambda address: address.get_visibility(), u"visibility", search.AtomField, False, None),
+    _search_field_spec("kind", u"kind", search.AtomField),
+    _search_field_spec("organization", u"organization", search.TextField, repluml = True),
+    _search_field_spec("position", u"position", search.TextField, repluml = True, char1 = True),
+    _search_field_spec("salutation", u"salutation", search.TextField, repluml = True, char1 = True),
+    _search_field_spec("first_name", u"first_name", search.TextField, repluml = True, char1 = True),
+    _search_field_spec("last_name", u"last_name", search.TextField, repluml = True, char1 = True),
+    _search_field_spec("nickname", u"nickname", search.TextField, repluml = True, char1 = True),
+    _search_field_spec("street", u"street", search.TextField, repluml = True, char1 = True),
+    _search_field_spec("postcode", u"postcode", search.TextField, char1 = True),
+    _search_field_spec("city", u"city", search.TextField, repluml = True, char1 = True),
+    _search_field_spec("district", u"district", search.TextField, repluml = True),
+    _search_field_spec("land", u"land", search.TextField, repluml = True),
+    _search_field_spec("country", u"country", search.TextField, repluml = True),
+    _search_field_spec("gender", u"gender", search.AtomField),
+    _search_field_spec("category_items", u"category", search.AtomField),
+    _search_field_spec("tag_items", u"tag", search.AtomField),
+    _search_field_spec("business_items", u"business", search.AtomField),
+)
+
+# Prefix tokens (edge n-grams) for the type-as-you-go search
+PREFIX_FIELD = u"prefix"
+PREFIX_SOURCE_FIELDS = ("first_name", "last_name", "nickname", "organization", "city")
+PREFIX_MAX_LENGTH = 10  # Longer words are only found with the first 10 characters
+PREFIX_MAX_TOKENS = 200
+
+# Label --> search field name (free defined items and anniversaries)
+_label_field_names = {}
+_LABEL_FIELD_NAMES_MAX = 1000
+
+
+def get_label_field_name(label):
+    """
+    Returns the search field name for the label of a free defined item
+    or an anniversary item (memoized)
+    """
+
+    name = _label_field_names.get(label)
+    if name is None:
+        name = common.format_.safe_ascii(label.lower().replace(" ", "_").replace("-", "_"))
+        if len(_label_field_names) >= _LABEL_FIELD_NAMES_MAX:
+            _label_field_names.clear()
+        _label_field_names[label] = name
+
+    # Finished
+    return name
+
+
+def _get_to_dict_plan(
+    properties,
+    include,
+    exclude,
+    exclude_creation_metadata,
+    exclude_edit_metadata,
+    exclude_empty_fields
+):
+    """
+    Returns the plan for *Address.to_dict* for one option combination::
+
+        (
+            [(<name>, <property>, <kind>), ...],
+            (<metadata fields of the items>, ...),
+            <exclude empty fields>
+        )
+
+    The order of the properties is the order of *ndb.Model._to_dict*.
+    The *INTERNAL_FIELDS* are only part of the plan, if they are included.
+    Plans are cached for the properties of the model class. Entities with
+    additional (unknown) properties get an uncached plan.
+    """
+
+    exclude = set(exclude or [])
+    if exclude_creation_metadata:
+        exclude.update(["ct", "cu"])
+    if exclude_edit_metadata:
+        exclude.update(["et", "eu"])
+    include = frozenset(include) if include is not None else None
+
+    cache_key = (
+        include,
+        frozenset(exclude),
+        bool(exclude_creation_metadata),
+        bool(exclude_edit_metadata),
+        bool(exclude_empty_fields)
+    )
+    cacheable = properties is Address._properties
+    if cacheable:
+        plan = _to_dict_plans.get(cache_key)
+        if plan:
+            return plan
+
+    plan_properties = []
+    for prop in properties.itervalues():
+        name = prop._code_name
+        if include is None and name in INTERNAL_FIELDS:
+            continue
+        if include is not None and name not in include:
+            continue
+        if name in exclude:
+            continue
+        if isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty)) and prop._repeated:
+            kind = STRUCTURED_FIELD
+        elif prop._repeated:
+            kind = REPEATED_FIELD
+        else:
+            kind = SCALAR_FIELD
+        plan_properties.append((name, prop, kind))
+
+    item_exclude = ()
+    if exclude_creation_metadata:
+        item_exclude += ("ct", "cu")
+    if exclude_edit_metadata:
+        item_exclude += ("et", "eu")
+
+    plan = (plan_properties, item_exclude, bool(exclude_empty_fields))
+
+    if cacheable:
+        if len(_to_dict_plans) >= _TO_DICT_PLANS_MAX:
+            _to_dict_plans.clear()
+        _to_dict_plans[cache_key] = plan
+
+    # Finished
+    return plan
+
+
 def age_years(birthday, basedate = None):
     """
     Gibt das Alter in Jahren zurück.
@@ -123,6 +283,27 @@ class Address(ndb.Model):
                     )
 
 
+    def get_emails_lower(self):
+        """
+        Returns the email addresses in lower case (indexed property *emails*)
+        """
+
+        emails = []
+        for email_item in self.email_items:
+            email = (email_item.email or u"").strip().lower()
+            if email and email not in emails:
+                emails.append(email)
+        return emails
+
+
+    def get_visibility(self):
+        """
+        Returns "private" or "public" (search index field *visibility*)
+        """
+
+        return u"private" if self.private else u"public"
+
+
     def get_age(self):
         """
         Returns the age if possible
@@ -149,6 +330,9 @@ class Address(ndb.Model):
 
     uid = ndb.StringProperty(required = True)
     owner = ndb.StringProperty(required = True)
+    private = ndb.BooleanProperty(default = False)  # Visibility
+    index_hash = ndb.StringProperty(indexed = False)  # Fingerprint of the indexed search fields
+    history_version = ndb.IntegerProperty(indexed = False, default = 0)  # Newest AddressHistory id
 
     ct = ndb.DateTimeProperty(required = True, verbose_name = u"creation_timestamp")
     cu = ndb.StringProperty(required = True, verbose_name = u"creation_user")
@@ -170,6 +354,7 @@ class Address(ndb.Model):
     country = ndb.StringProperty()  # Land
     gender = ndb.StringProperty()
     birthday = ndb.ComputedProperty(get_birthday_iso)
+    emails = ndb.ComputedProperty(get_emails_lower, repeated = True)  # Lookup by email address
     age = property(fget = get_age)
 
     business_items = ndb.StringProperty(repeated = True)
@@ -197,62 +382,56 @@ class Address(ndb.Model):
     ):
         """
         Return address-dict without unneeded fields
+
+        The dictionary is built in one pass with a plan, which is compiled
+        once per option combination (see *_get_to_dict_plan*).
         """
 
-        exclude = exclude or []
-        if exclude_creation_metadata:
-            exclude.extend(["ct", "cu"])
-        if exclude_edit_metadata:
-            exclude.extend(["et", "eu"])
+        if include is not None and not isinstance(include, (list, tuple, set, frozenset)):
+            raise TypeError("include should be a list, tuple or set")
 
-        # Convert address to dictionary
-        address_dict = self._to_dict(include = include, exclude = exclude)
-        address_dict = copy.deepcopy(address_dict)
-        address_dict["key_urlsafe"] = self.key.urlsafe()
+        plan_properties, item_exclude, exclude_empty = _get_to_dict_plan(
+            self._properties,
+            include,
+            exclude,
+            exclude_creation_metadata,
+            exclude_edit_metadata,
+            exclude_empty_fields
+        )
 
-        # Repeated fields
-        for fieldname in [
-            "phone_items",
-            "email_items",
-            "url_items",
-            "note_items",
-            "journal_items",
-            "agreement_items",
-            "free_defined_items",
-            "anniversary_items",
-        ]:
-            if fieldname not in address_dict:
+        address_dict = {}
+        empty_fields = []
+        for name, prop, kind in plan_properties:
+            try:
+                value = prop._get_for_dict(self)
+            except ndb.UnprojectedPropertyError:
                 continue
 
-            for field_item in address_dict.get(fieldname, []):
-                # Exclude creation metadata
-                if exclude_creation_metadata:
-                    if "ct" in field_item:
-                        del field_item["ct"]
-                    if "cu" in field_item:
-                        del field_item["cu"]
-
-                # Exclude edit metadata
-                if exclude_edit_metadata:
-                    if "et" in field_item:
-                        del field_item["et"]
-                    if "eu" in field_item:
-                        del field_item["eu"]
-
-            # Exclude empty fields
-            if exclude_empty_fields:
-                field = address_dict.get(fieldname, [])
-                if not field:
-                    del address_dict[fieldname]
-
-        # Exclude empty fields
-        if exclude_empty_fields:
-            for key, value in address_dict.items():
-                if value is None:
-                    del address_dict[key]
-                elif key in ["category_items", "business_items", "tag_items"]:
-                    if not value:
-                        del address_dict[key]
+            if kind == STRUCTURED_FIELD:
+                # New dictionaries per item; only remove metadata
+                if item_exclude:
+                    for field_item in value:
+                        for key in item_exclude:
+                            if key in field_item:
+                                del field_item[key]
+                if exclude_empty and not value:
+                    empty_fields.append(name)
+            elif kind == REPEATED_FIELD:
+                # Own list, the entity must not change
+                value = list(value)
+                if exclude_empty and not value and name in EMPTY_REPEATED_FIELDS:
+                    empty_fields.append(name)
+            elif value is None and exclude_empty:
+                empty_fields.append(name)
+
+            address_dict[name] = value
+
+        address_dict["key_urlsafe"] = self.key.urlsafe()
+
+        # Exclude empty fields (deleted at the end, so the order of the
+        # dictionary stays the same as before)
+        for name in empty_fields:
+            del address_dict[name]
 
         # Finished
         return address_dict
@@ -262,72 +441,133 @@ class Address(ndb.Model):
         """
         Writes the address to the datastore.
 
-        Adds a document to the Search-Index.
+        Adds a document to the Search-Index. In the "deferred" index mode,
+        the document will written later by a task.
         """
 
+        # Fingerprint of the search fields; unchanged documents are not written
+        search_fields = self.get_search_fields()
+        index_changed = self.set_index_hash(search_fields)
+
         # Save address
         key = ndb.Model.put(self, **ctx_options)
 
-        # Update search index
-        self.update_search_index()
+        # Update search index (directly or deferred)
+        self.write_search_document(search_fields, index_changed, **ctx_options)
 
         # Finished
         return key
 
 
-    def update_search_index(self):
+    def write_search_document(self, search_fields, index_changed, **ctx_options):
         """
-        Updates the address search index with the values of this address.
+        Writes the search document of the saved address (directly or deferred)
+
+        Must be called after the address was saved and outside of
+        transactions (the search index and the pending documents are not
+        part of the entity group of the address).
+
+        :param search_fields: Result of *get_search_fields()*
+        :param index_changed: Result of *set_index_hash()* before the save
+        """
+
+        if not index_changed:
+            common.address_index.count_skipped_documents(1)
+            return
+
+        try:
+            common.address_index.update_documents(
+                [self], documents = [self.get_search_document(search_fields)]
+            )
+        except Exception:
+            # The next save must write the document again
+            self.index_hash = None
+            ndb.Model.put(self, **ctx_options)
+            raise
+
+
+    def set_index_hash(self, search_fields = None):
+        """
+        Saves the fingerprint of the search fields in *index_hash*
+        (not in the datastore).
+
+        :return: `True`, if the indexed content has changed
+        """
+
+        if search_fields is None:
+            search_fields = self.get_search_fields()
+
+        index_hash = common.address_index.get_fields_hash(search_fields)
+        if index_hash == self.index_hash:
+            return False
+
+        self.index_hash = index_hash
+        return True
+
+
+    def get_search_document(self, search_fields = None):
+        """
+        Returns the search document with the values of this address.
+
+        :param search_fields: Result of *get_search_fields()*, if already built
+        """
+
+        if search_fields is None:
+            search_fields = self.get_search_fields()
+
+        # Finished
+        return search.Document(
+            doc_id = self.key.urlsafe(),
+            fields = search_fields,
+            language = cherrypy.config["LANGUAGE"]
+        )
+
+
+    def get_search_fields(self):
+        """
+        Returns the fields of the search document
         """
 
         # Gather information for the index
         fields = []
+        append = fields.append
+        fold_umlauts = common.format_.fold_umlauts
 
         # Append default fields
-        for field_def in [
-            Bunch(val = self.ct, name = u"creation_timestamp", ftype = search.DateField, repluml = False, char1 = False),
-            Bunch(val = self.cu, name = u"creation_user", ftype = search.TextField, repluml = False, char1 = False),
-            Bunch(val = self.et, name = u"edit_timestamp", ftype = search.DateField, repluml = False, char1 = False),
-            Bunch(val = self.eu, name = u"edit_user", ftype = search.TextField, repluml = False, char1 = False),
-            Bunch(val = self.kind, name = u"kind", ftype = search.AtomField, repluml = False, char1 = False),
-            Bunch(val = self.organization, name = u"organization", ftype = search.TextField, repluml = True, char1 = False),
-            Bunch(val = self.position, name = u"position", ftype = search.TextField, repluml = True, char1 = True),
-            Bunch(val = self.salutation, name = u"salutation", ftype = search.TextField, repluml = True, char1 = True),
-            Bunch(val = self.first_name, name = u"first_name", ftype = search.TextField, repluml = True, char1 = True),
-            Bunch(val = self.last_name, name = u"last_name", ftype = search.TextField, repluml = True, char1 = True),
-            Bunch(val = self.nickname, name = u"nickname", ftype = search.TextField, repluml = True, char1 = True),
-            Bunch(val = self.street, name = u"street", ftype = search.TextField, repluml = True, char1 = True),
-            Bunch(val = self.postcode, name = u"postcode", ftype = search.TextField, repluml = False, char1 = True),
-            Bunch(val = self.city, name = u"city", ftype = search.TextField, repluml = True, char1 = True),
-            Bunch(val = self.district, name = u"district", ftype = search.TextField, repluml = True, char1 = False),
-            Bunch(val = self.land, name = u"land", ftype = search.TextField, repluml = True, char1 = False),
-            Bunch(val = self.country, name = u"country", ftype = search.TextField, repluml = True, char1 = False),
-            Bunch(val = self.gender, name = u"gender", ftype = search.AtomField, repluml = False, char1 = False),
-            Bunch(val = self.category_items, name = u"category", ftype = search.AtomField, repluml = False, char1 = False),
-            Bunch(val = self.tag_items, name = u"tag", ftype = search.AtomField, repluml = False, char1 = False),
-            Bunch(val = self.business_items, name = u"business", ftype = search.AtomField, repluml = False, char1 = False),
-        ]:
-            values = field_def.val
+        for get_value, name, field_type, repluml, char1_name in SEARCH_FIELD_SPECS:
+            values = get_value(self)
 
             if not isinstance(values, (list, tuple)):
-                values = [values]
+                values = (values,)
 
             for value in values:
                 if value is not None:
                     # Append default value
-                    fields.append(field_def.ftype(name = field_def.name, value = value))
+                    append(field_type(name = name, value = value))
                     # Append value without umlauts
-                    if field_def.repluml and common.format_.has_umlauts(value):
-                        fields.append(field_def.ftype(
-                            name = field_def.name,
-                            value = common.format_.replace_umlauts(value)
-                        ))
+                    if repluml and value:
+                        folded = fold_umlauts(value)
+                        if folded is not None:
+                            append(field_type(name = name, value = folded))
                     # Append first character
-                    if field_def.char1 and len(value) > 0:
-                        fields.append(search.AtomField(
-                            name = field_def.name + u"_char1",
-                            value = value[0].lower()
-                        ))
+                    if char1_name and len(value) > 0:
+                        append(search.AtomField(name = char1_name, value = value[0].lower()))
+
+        # Prefix tokens of the names, the organization and the city
+        prefix_tokens = []
+        for fieldname in PREFIX_SOURCE_FIELDS:
+            value = getattr(self, fieldname)
+            if value:
+                prefix_tokens.extend(common.format_.edge_ngrams(value, max_length = PREFIX_MAX_LENGTH))
+        if prefix_tokens:
+            seen = set()
+            prefix_tokens = [
+                token for token in prefix_tokens if not (token in seen or seen.add(token))
+            ]
+            append(search.TextField(
+                name = PREFIX_FIELD,
+                value = u" ".join(prefix_tokens[:PREFIX_MAX_TOKENS])
+            ))
 
         # Fields with its own model
         for phone_item in self.phone_items:
@@ -342,13 +582,12 @@ class Address(ndb.Model):
             if url_item.url is not None:
                 fields.append(search.TextField(name = u"url", value = url_item.url))
 
+        exceptions = cherrypy.config["search_index.address.free_defined_fields.exceptions"]
         for free_defined_item in self.free_defined_items:
 
-            name = common.format_.safe_ascii(
-                free_defined_item.label.lower().replace(" ", "_").replace("-", "_")
-            )
+            name = get_label_field_name(free_defined_item.label)
             # This fields will not indexed
-            if name in cherrypy.config["search_index.address.free_defined_fields.exceptions"]:
+            if name in exceptions:
                 continue
 
             value = free_defined_item.text
@@ -357,11 +596,9 @@ class Address(ndb.Model):
 
                 if free_defined_item.value_type == u"unicode":
                     fields.append(search.TextField(name = name, value = value))
-                    if common.format_.has_umlauts(free_defined_item.text):
-                        fields.append(search.TextField(
-                            name = name,
-                            value = common.format_.replace_umlauts(value),
-                        ))
+                    folded = fold_umlauts(value)
+                    if folded is not None:
+                        fields.append(search.TextField(name = name, value = folded))
                 elif free_defined_item.value_type == u"int":
                     fields.append(search.NumberField(name = name, value = int(value)))
                 elif free_defined_item.value_type == u"float":
@@ -371,9 +608,7 @@ class Address(ndb.Model):
 
         for anniversary_item in self.anniversary_items:
 
-            name = common.format_.safe_ascii(
-                anniversary_item.label.lower().replace(" ", "_").replace("-", "_")
-            )
+            name = get_label_field_name(anniversary_item.label)
             value = u""
 
             if anniversary_item.year and anniversary_item.month and anniversary_item.day:
@@ -419,15 +654,17 @@ class Address(ndb.Model):
         #     fields.append(search.TextField(name = u"agreement", value = agreement_item.text))
 
         # Document
-        document = search.Document(
-            doc_id = self.key.urlsafe(),
-            fields = fields,
-            language = cherrypy.config["LANGUAGE"]
-        )
+        # Finished
+        return fields
+
+
+    def update_search_index(self):
+        """
+        Updates the address search index with the values of this address.
+        """
 
         # Add/update index
-        index = search.Index(name = "Address")
-        index.put(document)
+        common.address_index.put_documents([self])
 
 
         # ToDo: Add notes, journal and agreements into an own index
@@ -8,10 +8,20 @@ from google.appengine.ext import ndb
 
 
 class AddressHistory(ndb.Model):
+    """
+    State of an address before one edit
+
+    The key id is the version number (1, 2, 3, ...). Every n-th version
+    holds the whole address (*address_dict*), all other versions only hold
+    the fields which differ from the next newer version (*delta*).
+    Entries of older releases (automatic ids) always hold the whole address,
+    until they are compacted (see *common.address_history*).
+    """
 
     ct = ndb.DateTimeProperty(
         auto_now_add = True, required = True, verbose_name = u"creation_timestamp"
     )
     cu = ndb.StringProperty(required = True, verbose_name = u"creation_user")
 
-    address_dict = ndb.PickleProperty()
+    address_dict = ndb.PickleProperty(compressed = True)  # Snapshot
+    delta = ndb.PickleProperty(compressed = True)  # {"set": {...}, "unset": [...]}
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from google.appengine.ext import ndb
+
+
+# ACHTUNG! Neue Models müssen auch in den Backup-Cron-Job eingetragen werden!
+
+
+class CounterShard(ndb.Model):
+    """
+    One shard of a sharded counter.
+
+    The key name is "<counter name>-<shard number>".
+    """
+
+    name = ndb.StringProperty(required = True)
+    count = ndb.IntegerProperty(default = 0)
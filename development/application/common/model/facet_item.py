@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from google.appengine.ext import ndb
+
+
+# ACHTUNG! Neue Models müssen auch in den Backup-Cron-Job eingetragen werden!
+
+
+class FacetItem(ndb.Model):
+    """
+    Number of addresses which use one category, tag or business item.
+
+    The key name is "<facet>:<value>".
+    """
+
+    facet = ndb.StringProperty(required = True)  # "category", "tag", "business"
+    value = ndb.StringProperty(required = True)
+    count = ndb.IntegerProperty(default = 0)
+    et = ndb.DateTimeProperty(auto_now = True, indexed = False, verbose_name = u"edit_timestamp")
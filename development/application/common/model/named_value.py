@@ -10,4 +10,5 @@ from google.appengine.ext import ndb
 class NamedValue(ndb.Model):
     name = ndb.StringProperty()
     value = ndb.PickleProperty()
+    version = ndb.IntegerProperty(default = 0)
 
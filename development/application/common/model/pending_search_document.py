@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from google.appengine.ext import ndb
+
+
+# ACHTUNG! Neue Models müssen auch in den Backup-Cron-Job eingetragen werden!
+
+
+class PendingSearchDocument(ndb.Model):
+    """
+    Marks an address, whose search document must be updated.
+
+    The key name is the urlsafe key of the address (= document id).
+    """
+
+    ct = ndb.DateTimeProperty(required = True, verbose_name = u"creation_timestamp")
@@ -1,10 +1,99 @@
 #!/usr/bin/env python
 # coding: utf-8
-
+"""
+Simple key-value store (NamedValue model)
+
+The values are cached in two levels:
+
+- Per instance in a small LRU cache with a short TTL. The cache holds
+  own copies of the values and returns copies, so changes of a returned
+  value never change the cached value.
+- In memcache, together with the version of the NamedValue entity.
+  Writes update memcache with compare-and-set and never replace a newer
+  version with an older one.
+"""
+
+import copy
+import time
+import threading
+import collections
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
 from model.named_value import NamedValue
 
+LOCAL_CACHE_SIZE = 100
+LOCAL_CACHE_SECONDS = 10
+MEMCACHE_PREFIX = "named_value:v1:"
+CAS_RETRIES = 5
+
 _global_keys = {}
 
+# Per instance cache: name --> (expires, (version, value))
+_local_cache = collections.OrderedDict()
+_local_cache_lock = threading.Lock()
+
+
+def _local_get(name):
+    """
+    Returns the (version, value)-tuple from the per instance cache
+    (with a copy of the value)
+    """
+
+    with _local_cache_lock:
+        item = _local_cache.pop(name, None)
+        if item is None or item[0] < time.time():
+            return None
+        _local_cache[name] = item
+        version, value = item[1]
+    return version, copy.deepcopy(value)
+
+
+def _local_set(name, cached):
+    """
+    Writes the (version, value)-tuple into the per instance cache
+    """
+
+    version, value = cached
+    cached = (version, copy.deepcopy(value))
+    with _local_cache_lock:
+        _local_cache.pop(name, None)
+        _local_cache[name] = (time.time() + LOCAL_CACHE_SECONDS, cached)
+        while len(_local_cache) > LOCAL_CACHE_SIZE:
+            _local_cache.popitem(last = False)
+
+
+def _memcache_set(name, cached):
+    """
+    Writes the (version, value)-tuple into memcache, if it is newer
+    than the cached version.
+    """
+
+    client = memcache.Client()
+    memcache_key = MEMCACHE_PREFIX + name
+
+    for _ in range(CAS_RETRIES):
+        current = client.gets(memcache_key)
+        if current is None:
+            if client.add(memcache_key, cached):
+                return
+        elif current[0] >= cached[0]:
+            return
+        elif client.cas(memcache_key, cached):
+            return
+
+    # Not possible to update --> invalidate
+    client.delete(memcache_key)
+
+
+def _cache_set(named_value):
+    """
+    Writes the value of the NamedValue entity into both cache levels
+    """
+
+    cached = (named_value.version or 0, named_value.value)
+    _local_set(named_value.name, cached)
+    _memcache_set(named_value.name, cached)
+
 
 def get_named_value_raw(name):
     """
@@ -20,82 +109,113 @@ def get_named_value_raw(name):
             return named_value
 
 
-def get_value(name):
+def get_value(name, local_cache = True):
     """
     Returns the value with the given name.
+
+    :param local_cache: If `False`, the per instance cache is skipped and
+        the value is read from memcache or the datastore.
     """
 
+    # Per instance cache
+    if local_cache:
+        cached = _local_get(name)
+        if cached is not None:
+            return cached[1]
+
+    # Memcache
+    cached = memcache.get(MEMCACHE_PREFIX + name)
+    if cached is not None:
+        _local_set(name, cached)
+        return cached[1]
+
+    # Datastore
     named_value = get_named_value_raw(name)
     if named_value is not None:
+        _cache_set(named_value)
         return named_value.value
 
 
-def set_value(name, value):
-    """
-    Sets the value with the given name.
+@ndb.transactional
+def _update_value(key, function):
     """
+    Changes the value of an existing NamedValue entity (in a transaction)
 
-    # Get existing named value
-    named_value = get_named_value_raw(name)
+    :return: Changed NamedValue-Object or `None`, if it does not exist
+    """
 
+    named_value = key.get()
     if named_value is None:
-        # Create new named value
-        named_value = NamedValue()
-        named_value.name = name
-
-    # Edit value
-    named_value.value = value
+        return None
 
-    # Save
+    named_value.value = function(named_value.value)
+    named_value.version = (named_value.version or 0) + 1
     named_value.put()
 
     # Finished
     return named_value
 
 
-def increment(name):
+def _change_value(name, function, initial_value):
     """
-    Increments the value with the given name, if it is an integer.
+    Changes the value with the given name or creates a new NamedValue
     """
 
-    # Get existing named value
-    named_value = get_named_value_raw(name)
+    # Change existing named value
+    named_value = None
+    if name not in _global_keys:
+        get_named_value_raw(name)
+    if name in _global_keys:
+        named_value = _update_value(_global_keys[name], function)
+        if named_value is None:
+            del _global_keys[name]
 
     if named_value is None:
         # Create new named value
         named_value = NamedValue()
         named_value.name = name
-        named_value.value = 0
+        named_value.value = function(initial_value)
+        named_value.version = 1
+        named_value.put()
+        _global_keys[name] = named_value.key
 
-    # Edit value
-    named_value.value += 1
-
-    # Save
-    named_value.put()
+    # Cache set
+    _cache_set(named_value)
 
     # Finished
     return named_value
 
 
-def decrement(name):
+def update_value(name, function, initial_value = None):
     """
-    Decrements the value with the given name, if it is an integer.
+    Changes the value with the given name in a transaction (read and write).
+
+    :param function: Gets the current value (or *initial_value*) and
+        returns the new value. Can be called more than once (retries).
     """
 
-    # Get existing named value
-    named_value = get_named_value_raw(name)
+    return _change_value(name, function, initial_value)
 
-    if named_value is None:
-        # Create new named value
-        named_value = NamedValue()
-        named_value.name = name
-        named_value.value = 1
 
-    # Edit value
-    named_value.value -= 1
+def set_value(name, value):
+    """
+    Sets the value with the given name.
+    """
 
-    # Save
-    named_value.put()
+    return _change_value(name, lambda old_value: value, None)
 
-    # Finished
-    return named_value
+
+def increment(name):
+    """
+    Increments the value with the given name, if it is an integer.
+    """
+
+    return _change_value(name, lambda old_value: old_value + 1, 0)
+
+
+def decrement(name):
+    """
+    Decrements the value with the given name, if it is an integer.
+    """
+
+    return _change_value(name, lambda old_value: old_value - 1, 1)
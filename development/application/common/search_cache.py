@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Memcache for the results of address searches
+
+A result (document ids, total quantity, next cursor) is cached under the
+signature of the query and the current "index generation". Every write to
+the "Address" search index increments the generation, so all cached
+results become invalid at once and no old result is ever served.
+
+The generation starts with a timestamp (not with 0), so that a generation
+is never used again after the memcache was flushed.
+
+The lifetime of the results is configured with the INI-setting
+*search_cache.seconds* (0 switches the cache off).
+"""
+
+import time
+import hashlib
+import cherrypy
+from google.appengine.api import memcache
+
+GENERATION = "address_search:generation"
+MEMCACHE_PREFIX = "address_search:"
+DEFAULT_SECONDS = 600
+
+
+def get_cache_seconds():
+    return int(cherrypy.config.get("search_cache.seconds", DEFAULT_SECONDS) or 0)
+
+
+def _initial_generation():
+    return int(time.time() * 1000)
+
+
+def get_generation():
+    """
+    Returns the current index generation
+    """
+
+    generation = memcache.get(GENERATION)
+    if generation is None:
+        memcache.add(GENERATION, _initial_generation())
+        generation = memcache.get(GENERATION)
+
+    # Finished
+    return generation
+
+
+def bump_generation():
+    """
+    Invalidates all cached search results (after writes to the search index)
+    """
+
+    memcache.incr(GENERATION, initial_value = _initial_generation())
+
+
+def get_signature(*parts):
+    """
+    Returns the normalized signature of a query
+
+    :param parts: All values, which change the result (index name, query string,
+        sorting, offset, limit, cursor, returned fields)
+    """
+
+    return hashlib.md5(repr(parts)).hexdigest()
+
+
+def _key(signature, generation):
+    return u"{prefix}{generation}:{signature}".format(
+        prefix = MEMCACHE_PREFIX,
+        generation = generation,
+        signature = signature
+    )
+
+
+def get_result(signature):
+    """
+    Returns the cached result (or `None`) and the current generation
+
+    :return: (<result>, <generation>); the generation must be given
+        to *set_result()*, so that a result, which was searched before an index
+        write, is not saved under the new generation.
+    """
+
+    if not get_cache_seconds():
+        return None, None
+
+    generation = get_generation()
+    if generation is None:
+        return None, None
+
+    # Finished
+    return memcache.get(_key(signature, generation)), generation
+
+
+def set_result(signature, generation, result):
+    """
+    Caches the result of a query
+    """
+
+    seconds = get_cache_seconds()
+    if not seconds or generation is None:
+        return
+
+    memcache.set(_key(signature, generation), result, time = seconds)
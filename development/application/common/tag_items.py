@@ -2,10 +2,7 @@
 # coding: utf-8
 
 from model.address import Address
-import named_values
-
-
-TAG_ITEMS = "tag_items"
+import facet_items
 
 
 def get_tag_items_direct():
@@ -24,53 +21,37 @@ def get_tag_items_direct():
     return tag_items
 
 
-def get_tag_items_cached():
-    """
-    Returns all used tag items as set.
+def get_tag_item_counts():
     """
+    Returns all used tag items with the number of addresses::
 
-    # Cache get
-    tag_items = named_values.get_value(name = TAG_ITEMS)
-    if tag_items is not None:
-        return tag_items
+        {<tag item>: <count>, ...}
 
-    # Fetch tag items direct from the Address model
-    tag_items = get_tag_items_direct()
+    Until the facet items are built (in the background), the counts
+    are `None`.
+    """
 
-    # Cache set
-    named_values.set_value(name = TAG_ITEMS, value = tag_items)
+    # Build the facet items once (deferred)
+    if not facet_items.is_ready(facet_items.TAG):
+        facet_items.start_rebuild_facet(facet_items.TAG)
+        return dict.fromkeys(get_tag_items_direct())
 
     # Finished
-    return tag_items
+    return facet_items.get_counts(facet_items.TAG)
 
 
-def update_tag_items_cache():
+def get_tag_items_cached():
     """
-    Updates the "tag_items" NamedValue entity
+    Returns all used tag items as set.
     """
 
-    # Cache set
-    named_values.set_value(name = TAG_ITEMS, value = get_tag_items_direct())
+    return set(get_tag_item_counts())
 
 
-def add_tag_items_to_cache(tag_items):
+def update_tag_items_cache():
     """
-    Add tag items to the cache
+    Recounts the tag facet items directly from the Address model
     """
 
-    if isinstance(tag_items, basestring):
-        tag_items = [tag_items]
-
-    # Cache get
-    cached_tag_items = named_values.get_value(name = TAG_ITEMS)
-    if cached_tag_items is None:
-        cached_tag_items = set()
-
-    # Add new tag items
-    for tag_item in tag_items:
-        cached_tag_items.add(tag_item)
-
-    # Cache set
-    named_values.set_value(name = TAG_ITEMS, value = cached_tag_items)
-
+    facet_items.rebuild_facet(facet_items.TAG)
 